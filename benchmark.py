@@ -0,0 +1,230 @@
+import argparse
+import datetime as dt
+import gc
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from TFM.build_datasets import build_datasets
+from TFM.feature_engineering import fillna_cols, trend_enrichment
+from TFM.feature_transformation import expand, get_all_times, pivoting_events, transform_features
+from TFM.instrumentation import peak_rss_mb
+from TFM.load_data import load_data
+from TFM.numpy_model import NumpyModel
+from TFM.sequence_padding import presequence_padding
+from TFM.synthetic import generate_events, generate_panel, write_shards
+from TFM.validation import get_shuffle_train, test_score
+
+
+NAMES = {'user_id': 'user_id', 'right_ts': 'right_ts', 'target': 'target',
+         'code': 'code'}
+
+STAGES = ['load_data', 'pivoting_events', 'expand', 'presequence_padding',
+          'fillna_cols', 'trend_enrichment', 'transform_features',
+          'build_datasets', 'get_shuffle_train', 'test_score']
+
+DEFAULT_SCALES = [(1000, 24), (10000, 36), (50000, 48)]
+
+
+def _random_model(feat_dict, random_s=0):
+    'Returns a NumpyModel of the generate_model network with random weights.'
+
+    rng = np.random.RandomState(random_s)
+    emb = [rng.randn(m[0], min(m)) for m in feat_dict['M']]
+    n_in = sum(min(m) for m in feat_dict['M']) + len(feat_dict['con_feats'])
+    lstms = []
+    for n, u in ((len(feat_dict['lstm_feats']), 80), (80, 32)):
+        lstms.append([rng.randn(n, 4 * u) * .1, rng.randn(u, 4 * u) * .1,
+                      np.zeros(4 * u)])
+    dense = []
+    for n, u in ((n_in + 32, 384), (384, 128), (128, 1)):
+        dense.append([rng.randn(n, u) * .05, np.zeros(u)])
+    return NumpyModel(emb, lstms, dense, feat_dict=feat_dict)
+
+
+def _measure(fn, repeat=1, memory=True):
+    '''
+    Runs fn and returns its output and the stage stats: best wall and CPU
+    time of repeat runs, and the peak traced allocation and peak RSS of an
+    extra run with tracemalloc (if memory).
+    '''
+
+    stats = {'wall_s': np.inf, 'cpu_s': np.inf}
+    for _ in range(repeat):
+        gc.collect()
+        t0, c0 = time.perf_counter(), time.process_time()
+        out = fn()
+        stats['wall_s'] = min(stats['wall_s'], time.perf_counter() - t0)
+        stats['cpu_s'] = min(stats['cpu_s'], time.process_time() - c0)
+    if memory:
+        del out
+        gc.collect()
+        tracemalloc.start()
+        out = fn()
+        stats['peak_alloc_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    stats['peak_rss_mb'] = peak_rss_mb()
+    return out, stats
+
+
+def run_scale(n_users, n_months, random_s=0, stages=None, repeat=1,
+              memory=True, verbose=True):
+    '''
+    Generates synthetic data of n_users and n_months and benchmarks the
+    pipeline stages on it, each stage taking the output of the previous
+    ones. Returns the list of stage results.
+    '''
+
+    stages = STAGES if stages is None else stages
+    uid, ts, target = NAMES['user_id'], NAMES['right_ts'], NAMES['target']
+    names = dict(user_id=uid, right_ts=ts)
+
+    panel = generate_panel(n_users, n_months, random_s=random_s,
+                           user_id=uid, right_ts=ts, target=target)
+    events = generate_events(n_users, n_months, random_s=random_s,
+                             user_id=uid, right_ts=ts, code=NAMES['code'])
+    tmp = tempfile.mkdtemp()
+    write_shards(panel, tmp, user_id=uid)
+
+    def run(stage, fn, rows_in, rows_out=len):
+        if stage not in stages:
+            return fn()
+        out, stats = _measure(fn, repeat=repeat, memory=memory)
+        stats.update({'users': n_users, 'months': n_months, 'stage': stage,
+                      'rows_in': int(rows_in), 'rows_out': int(rows_out(out))})
+        results.append(stats)
+        if verbose:
+            print('> {:<20} {:>9.3f}s wall {:>9.3f}s CPU {:>9} rows out'
+                  .format(stage, stats['wall_s'], stats['cpu_s'],
+                          stats['rows_out']))
+        return out
+
+    results = []
+    try:
+        df = run('load_data', lambda: load_data(
+            tmp, pref='data_', target=target, verbose=False, **names),
+            len(panel))
+    finally:
+        shutil.rmtree(tmp)
+
+    run('pivoting_events', lambda: pivoting_events(
+        events, 'sum', code=NAMES['code'], verbose=False, **names),
+        len(events))
+    run('expand', lambda: expand(
+        df[[uid, ts, 'visits', 'expense']], get_all_times(df, right_ts=ts),
+        **names), len(df))
+    df = run('presequence_padding', lambda: presequence_padding(
+        df, 6, target=target, verbose=False, **names), len(df))
+    df = run('fillna_cols', lambda: fillna_cols(
+        df, user_id=uid, fillna_val={target: 0., 'visits': 0.},
+        ffill_cols=['expense'],
+        bfill_cols=['age', 'gender', 'region', 'expense']), len(df))
+    df = run('trend_enrichment', lambda: trend_enrichment(
+        df, 'expense', right_ts=ts, q2cu=.99, show_plot=False), len(df))
+    df, feat_dict = run('transform_features', lambda: transform_features(
+        df, con_cols=['age'],
+        lstm_cols={'visits': (0, 20), 'expense': (0, 2000),
+                   'expense_mean': (None, None),
+                   'expense_mean_diff': (None, None)},
+        cat_cols={'gender': 2, 'region': 3}, verbose=False), len(df),
+        rows_out=lambda out: len(out[0]))
+    data_valid, data_test = run('build_datasets', lambda: build_datasets(
+        df, feat_dict, .8, 1, user_id=uid, target=target, verbose=False),
+        len(df), rows_out=lambda out: sum(len(d['y']) for d in out[1]))
+    run('get_shuffle_train', lambda: [dict(batch) for batch in
+        get_shuffle_train(data_test, 256, 1)],
+        sum(len(d['train_i']) for d in data_test))
+    model = _random_model(feat_dict, random_s=random_s)
+    run('test_score', lambda: test_score(model, data_valid, batch_size=4096),
+        sum(len(d['y']) for d in data_valid), rows_out=lambda out: 1)
+
+    return results
+
+
+def run_benchmarks(scales=DEFAULT_SCALES, random_s=0, stages=None, repeat=1,
+                   memory=True, output=None, verbose=True):
+    '''
+    Benchmarks the pipeline stages at several scales of synthetic data
+    ((users, months) pairs) and returns the results, which are written to
+    the output JSON file (if given) to be compared with later runs.
+    '''
+
+    results = []
+    for n_users, n_months in scales:
+        if verbose:
+            print('Scale: {} users x {} months'.format(n_users, n_months))
+        results += run_scale(n_users, n_months, random_s=random_s,
+                             stages=stages, repeat=repeat, memory=memory,
+                             verbose=verbose)
+
+    baseline = {
+        'meta': {
+            'date': dt.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'random_s': random_s,
+            'repeat': repeat
+        },
+        'results': results
+    }
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(baseline, f, indent=2)
+    return baseline
+
+
+def compare(baseline, current):
+    '''
+    Returns the wall time and peak allocation of the current results
+    relative to a baseline (dicts or JSON paths), per scale and stage.
+    '''
+
+    def frame(obj):
+        if isinstance(obj, str):
+            with open(obj) as f:
+                obj = json.load(f)
+        return pd.DataFrame(obj['results']) \
+            .set_index(['users', 'months', 'stage'])
+
+    base, cur = frame(baseline), frame(current)
+    cols = [c for c in ('wall_s', 'peak_alloc_mb') if c in base and c in cur]
+    return (cur[cols] / base[cols]).dropna(how='all') \
+        .add_suffix('_ratio')
+
+
+def main(argv=None):
+    '''
+    Benchmark command line.
+    Ex: python -m TFM.benchmark --scales 1000x24 10000x36 --output base.json
+    '''
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--scales', nargs='+',
+                        default=['{}x{}'.format(*s) for s in DEFAULT_SCALES],
+                        help='users x months pairs')
+    parser.add_argument('--stages', nargs='+', choices=STAGES)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--random-s', type=int, default=0)
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--compare', help='JSON baseline to compare with')
+    args = parser.parse_args(argv)
+
+    scales = [tuple(int(v) for v in s.split('x')) for s in args.scales]
+    baseline = run_benchmarks(scales, random_s=args.random_s,
+                              stages=args.stages, repeat=args.repeat,
+                              memory=not args.no_memory, output=args.output)
+    if args.compare:
+        print(compare(args.compare, baseline))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,163 @@
+from collections.abc import Mapping
 import numpy as np
-from TFM.settings import get_target_name, get_user_id_name
+import pandas as pd
+from TFM.instrumentation import instrument
+from TFM.settings import get_dtype_policy, get_target_name, get_user_id_name
 
+
+_ARRAY_KEYS = ('y', 'w', 'X_con', 'X_lstm', 'X_cat')
+_STATIC_KEYS = ('X_con', 'X_cat')
+
+
+class BucketView(Mapping):
+    '''
+    Read-only dict-like view of some rows and time-steps of a bucket.
+    Arrays are gathered from the base bucket only when they are accessed, so
+    the validation, test and training splits share one copy of the data.
+    Parameters:
+     > base: dict (or view) with the bucket arrays ('y', 'w', 'X_con',
+       'X_lstm', 'X_cat') and, optionally, the split indexes.
+     > rows: sequence indexes of the view. If None, all the sequences are
+       taken as a slice (no copy).
+     > steps: slice of time-steps of the view.
+     > keys: keys exposed by the view. Non-array keys are passed through.
+     > arrays: dict of already gathered arrays that take precedence over the
+       base ones.
+     > static: keys of the arrays without time axis (one row per sequence),
+       whose steps are not sliced. By default, those of the base view.
+    If the steps of the view stop before the end of the sequences (the p2p
+    horizon, e.g. slice(None, -p2p)) and the base has a '<key>_past'
+    version of a static array (its values at the last step before the
+    horizon), that version is taken, so the view never sees the profile of
+    the periods it hides.
+    '''
+
+    def __init__(self, base, rows=None, steps=slice(None), keys=_ARRAY_KEYS,
+                 arrays=None, static=None):
+        self.base = base
+        self.rows = rows
+        self.steps = steps
+        self._keys = tuple(keys)
+        self.arrays = arrays or {}
+        if static is None:
+            static = getattr(base, 'static', ())
+        self.static = tuple(static)
+
+    def _take(self, ar, static=False):
+        if static:
+            return ar if self.rows is None else ar[self.rows]
+        if self.rows is None:
+            return ar[:, self.steps]
+        return ar[self.rows, self.steps]
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if key in self.arrays:
+            return self.arrays[key]
+        static = key in self.static
+        name = key
+        if static and self.steps.stop is not None and self.steps.stop < 0 \
+                and key + '_past' in self.base:
+            name = key + '_past'
+        ar = self.base[name]
+        if key == 'X_cat':
+            return [self._take(a, static) for a in ar]
+        if key in _ARRAY_KEYS:
+            return self._take(ar, static)
+        return ar
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        n = len(self.base['y']) if self.rows is None else len(self.rows)
+        return '{}(sequences={}, steps={})'.format(
+            type(self).__name__, n, self.steps)
+
+
+def length_buckets(lengths, n_buckets, bs=None, train_p=1.):
+    '''
+    Returns the sorted maximum sequence lengths of at most n_buckets buckets
+    that minimise the padding steps of the sequences (each sequence is padded
+    up to the length of its bucket), by dynamic programming over the
+    distinct lengths.
+    Parameters:
+     > lengths: sequence length of every user.
+     > bs: batch size. If set, the steps of the training sequences dropped in
+       batches smaller than bs / 2 are added to the padding waste, so full
+       batches are favoured.
+     > train_p: proportion of the sequences used for training.
+    '''
+
+    vals, counts = np.unique(np.asarray(lengths), return_counts=True)
+    m = len(vals)
+    C = np.concatenate([[0], np.cumsum(counts)])
+    S = np.concatenate([[0], np.cumsum(counts * vals)])
+
+    # dp[k, j]: min waste of the j shortest lengths in k buckets
+    n_buckets = max(1, min(n_buckets, m))
+    dp = np.full((n_buckets + 1, m + 1), np.inf)
+    dp[0, 0] = 0
+    arg = np.zeros((n_buckets + 1, m + 1), dtype=np.int64)
+    for j in range(1, m + 1):
+        # cost of a bucket with the lengths i..j-1 for every i
+        i = np.arange(j)
+        n = C[j] - C[i]
+        cost = vals[j - 1] * n - (S[j] - S[i])
+        if bs is not None:
+            rest = (n * train_p).astype(np.int64) % bs
+            cost = cost + np.where(rest < bs / 2, rest, 0) * vals[j - 1]
+        for k in range(1, n_buckets + 1):
+            total = dp[k - 1, :j] + cost
+            arg[k, j] = np.argmin(total)
+            dp[k, j] = total[arg[k, j]]
+
+    k = int(np.argmin(dp[:, m]))
+    bounds = []
+    j = m
+    while k > 0:
+        bounds.append(vals[j - 1])
+        j = arg[k, j]
+        k -= 1
+    return np.array(bounds[::-1])
+
+
+def _bucket_array(ar, rows, n_seq, length, dest=None):
+    '''
+    Returns the rows of ar as a (n_seq, length, features) array. If dest is
+    given, rows are scattered to those flat positions of a zero-padded array.
+    '''
+
+    ar = ar[rows]
+    shape = ar.shape[1:] or (1,)
+    if dest is None:
+        return ar.reshape((n_seq, length) + shape)
+    out = np.zeros((n_seq * length,) + shape, dtype=ar.dtype)
+    out[dest] = ar.reshape((len(ar),) + shape)
+    return out.reshape((n_seq, length) + shape)
+
+
+def _bucket_views(bucket, p2p, static_keys):
+    'Returns the validation and test views of a bucket.'
+
+    past_keys = tuple(k + '_past' for k in static_keys)
+    # validation set (out-of-sample validation)
+    valid = BucketView(bucket, rows=bucket['valid_i'], steps=slice(None, -p2p),
+                       static=static_keys)
+
+    # test set (out-of-time validation)
+    test = BucketView(bucket, keys=_ARRAY_KEYS + ('train_i', 'pad_len')
+                      + past_keys, static=static_keys)
+    return valid, test
+
+
+@instrument(rows_out=lambda out: sum(len(d['y']) for d in out[1]))
 def build_datasets(df, feat_dict, train_p, p2p, user_id=None, target=None,
-    verbose=True):
+    n_buckets=None, bs=None, static=False, bounds=None, verbose=True):
     '''
     Returns validation and test sets for performing the out-of-sample and
     out-of-time validation methods.
@@ -12,11 +167,34 @@ def build_datasets(df, feat_dict, train_p, p2p, user_id=None, target=None,
      > con_feats: continuous features list
      > train_p: proportion of data used for training
      > p2p: periods to predict
+     > n_buckets: if set, sequences of similar lengths are grouped in (at
+       most) n_buckets buckets (see length_buckets) and pre-padded up to
+       the length of their bucket, with weight 0 and zero features in the
+       padded steps. By default, one bucket per sequence length.
+     > bs: batch size used to choose the bucket lengths (see length_buckets).
+     > bounds: bucket lengths to use instead of choosing them from the
+       sequences of df (e.g. chosen from the lengths of all the partitions
+       of the data). Overrides n_buckets.
+     > static: if True, the profile features (con_feats and cat_feats) are
+       taken once per user: X_con has shape (users, con_feats) and X_cat
+       arrays (users, 1), as expected by generate_model(..., static=True).
+       Test sets take them from the last period of each user. Validation
+       sets and training batches (which stop before the p2p horizon) take
+       them from the last period before the horizon ('X_con_past' and
+       'X_cat_past' of the test sets, see BucketView).
+    The rows of each user must be contiguous and sorted by time-stamp (as
+    returned by load_data or presequence_padding). Rows are stably sorted by
+    sequence length once, so every bucket is a contiguous slice.
+    Labels and continuous features take the float dtype of the dtype policy
+    and categorical features its int dtype (see settings.set_dtype_policy).
+    Each bucket is stored once; validation and test sets are lists of
+    BucketView, which gather their rows only when accessed. Test sets also
+    expose 'pad_len', the padded steps of every sequence.
     '''
 
     target = get_target_name(target=target)
     user_id = get_user_id_name(user_id=user_id)
-    
+
     con_feats = feat_dict['con_feats']
     lstm_feats = feat_dict['lstm_feats']
     cat_feats = feat_dict['cat_feats']
@@ -24,11 +202,42 @@ def build_datasets(df, feat_dict, train_p, p2p, user_id=None, target=None,
     data_valid = []
     data_test = []
 
-    user_len = df[user_id].value_counts().sort_values(ascending=False)
-    for length in user_len.unique():
-        uids = user_len[user_len == length].index.values
-        temp = df.loc[df[user_id].isin(uids)]
-        temp_size = len(uids)
+    # sequence length of every row, longest sequences first
+    codes = pd.factorize(df[user_id])[0]
+    seq_len = np.bincount(codes)
+    row_len = seq_len[codes]
+    if bounds is None and n_buckets is not None:
+        bounds = length_buckets(seq_len, n_buckets, bs=bs, train_p=train_p)
+    if bounds is None:
+        pad_len = row_len
+    else:
+        bounds = np.asarray(bounds)
+        pad_len = bounds[np.searchsorted(bounds, row_len)]
+    order = np.argsort(-pad_len, kind='mergesort')
+    row_len = row_len[order]
+    pad_len = pad_len[order]
+
+    # sequence of every row and position of the row in its sequence
+    first = np.concatenate([[True], codes[order][1:] != codes[order][:-1]])
+    seq_i = np.cumsum(first) - 1
+    step_i = np.arange(len(seq_i)) - np.flatnonzero(first)[seq_i]
+    last = np.concatenate([first[1:], [True]])
+
+    # one extraction per feature group, in bucket order
+    dtypes = get_dtype_policy()
+    Y = df[target].values[order].astype(dtypes['float'], copy=False)
+    W = df['weight'].values[order].astype(dtypes['weight'], copy=False)
+    CON = df[con_feats].values[order].astype(dtypes['float'], copy=False)
+    LSTM = df[lstm_feats].values[order].astype(dtypes['float'], copy=False)
+    CAT = df[cat_feats].values[order].astype(dtypes['int'], copy=False)
+
+    static_keys = _STATIC_KEYS if static else ()
+    pad_steps = 0
+    lengths, starts, counts = np.unique(-pad_len, return_index=True,
+                                        return_counts=True)
+    for length, start, n_rows in zip(-lengths, starts, counts):
+        rows = slice(start, start + n_rows)
+        temp_size = seq_i[start + n_rows - 1] - seq_i[start] + 1
         train_size = int(temp_size*train_p)
         valid_size = temp_size - train_size
 
@@ -37,32 +246,104 @@ def build_datasets(df, feat_dict, train_p, p2p, user_id=None, target=None,
         train_i = temp_i[:train_size]
         valid_i = temp_i[train_size:]
 
+        seq_pad = length - row_len[rows][step_i[rows] == 0]
+        pad_steps += seq_pad.sum()
         if verbose:
             print('> Sequence length: {} | Train / Validation size: {} / {} ({:.1%})' \
                   .format(length, train_size, valid_size, train_size/temp_size))
-        y = temp[target].values.reshape(temp_size, length, 1)
-        w = (temp['weight']).values.reshape(temp_size, length, 1)
-        X_con = temp[con_feats].values.reshape(temp_size, length, len(con_feats))
-        X_lstm = temp[lstm_feats].values.reshape(temp_size, length, len(lstm_feats))
-        X_cat = [temp[[i]].values.reshape(temp_size, length, 1) for i in cat_feats]
-
-        # validation set (out-of-sample validation)
-        data_valid.append({
-            'y': y[valid_i, :-p2p, :],
-            'w': w[valid_i, :-p2p, 0],
-            'X_con': X_con[valid_i, :-p2p, :],
-            'X_lstm': X_lstm[valid_i, :-p2p, :],
-            'X_cat': [ar[valid_i, :-p2p, :] for ar in X_cat]
-        })
-
-        # test set (out-of-time validation)
-        data_test.append({
-            'y': y[:, :, :],
+            if bounds is not None:
+                print('  > Padding: {:.1%}'.format(
+                    seq_pad.sum() / (temp_size*length)))
+        dest = None
+        if n_rows < temp_size*length:
+            dest = (seq_i[rows] - seq_i[start])*length + step_i[rows] \
+                + length - row_len[rows]
+        y = _bucket_array(Y, rows, temp_size, length, dest)
+        w = _bucket_array(W, rows, temp_size, length, dest)
+        X_lstm = _bucket_array(LSTM, rows, temp_size, length, dest)
+        if static:
+            profile_rows = start + np.flatnonzero(last[rows])
+            X_con = CON[profile_rows]
+            X_cat = CAT[profile_rows]
+            X_cat = [X_cat[:, i:i + 1] for i in range(len(cat_feats))]
+            # profile of the last step before the horizon (zeros if it is
+            # a padded step)
+            past = row_len[profile_rows] > p2p
+            X_con_past = np.zeros_like(X_con)
+            X_con_past[past] = CON[profile_rows[past] - p2p]
+            X_cat_past = np.zeros_like(CAT[profile_rows])
+            X_cat_past[past] = CAT[profile_rows[past] - p2p]
+            X_cat_past = [X_cat_past[:, i:i + 1]
+                          for i in range(len(cat_feats))]
+        else:
+            X_con = _bucket_array(CON, rows, temp_size, length, dest)
+            X_cat = _bucket_array(CAT, rows, temp_size, length, dest)
+            X_cat = [X_cat[:, :, i:i + 1] for i in range(len(cat_feats))]
+
+        bucket = {
+            'y': y,
             'w': w[:, :, 0],
-            'X_con': X_con[:, :, :],
-            'X_lstm': X_lstm[:, :, :],
-            'X_cat': [ar[:, :, :] for ar in X_cat],
-            'train_i': train_i
-        })
-    
-    return data_valid, data_test
\ No newline at end of file
+            'X_con': X_con,
+            'X_lstm': X_lstm,
+            'X_cat': X_cat,
+            'train_i': train_i,
+            'valid_i': valid_i,
+            'pad_len': seq_pad
+        }
+        if static:
+            bucket['X_con_past'] = X_con_past
+            bucket['X_cat_past'] = X_cat_past
+
+        valid, test = _bucket_views(bucket, p2p, static_keys)
+        data_valid.append(valid)
+        data_test.append(test)
+
+    if verbose and bounds is not None:
+        print('> Padding overhead: {:.1%} of the steps'.format(
+            pad_steps / (pad_steps + len(df))))
+
+    return data_valid, data_test
+
+
+def merge_datasets(data_tests, train_p, p2p):
+    '''
+    Merges the test sets returned by build_datasets for disjoint sets of
+    users (e.g. the partitions of run_partitioned) into single validation
+    and test sets: buckets of the same sequence length are concatenated, so
+    they are not split in smaller (and more often dropped) training batches,
+    and their sequences are shuffled and split again with train_p.
+    The partitions must share the bucket lengths (see the bounds argument
+    of build_datasets).
+    '''
+
+    groups = {}
+    for data_test in data_tests:
+        for d in data_test:
+            groups.setdefault(d['y'].shape[1], []).append(d)
+
+    data_valid, data_test = [], []
+    for length in sorted(groups, reverse=True):
+        views = groups[length]
+        arrays = ('y', 'w', 'X_con', 'X_lstm', 'pad_len')
+        lists = ('X_cat',)
+        if views[0].static:
+            arrays += ('X_con_past',)
+            lists += ('X_cat_past',)
+        bucket = {k: np.concatenate([d.base[k] for d in views])
+                  for k in arrays}
+        for k in lists:
+            bucket[k] = [np.concatenate(ar) for ar in
+                         zip(*[d.base[k] for d in views])]
+
+        temp_size = len(bucket['y'])
+        train_size = int(temp_size*train_p)
+        temp_i = np.arange(temp_size)
+        np.random.shuffle(temp_i)
+        bucket['train_i'] = temp_i[:train_size]
+        bucket['valid_i'] = temp_i[train_size:]
+
+        valid, test = _bucket_views(bucket, p2p, views[0].static)
+        data_valid.append(valid)
+        data_test.append(test)
+
+    return data_valid, data_test
@@ -0,0 +1,296 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from sklearn.externals import joblib
+from TFM.settings import get_code_name, get_dtype_policy, get_right_ts_name, get_target_name, get_user_id_name
+
+
+def _parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def fingerprint(obj):
+    '''
+    Returns a hex digest of the content of obj (dataframes, series, arrays
+    and nested lists / tuples / dicts of them or of plain values).
+    '''
+
+    h = hashlib.sha1()
+    _update(h, obj)
+    return h.hexdigest()
+
+
+def _update(h, obj):
+    if isinstance(obj, pd.DataFrame):
+        h.update(b'df')
+        h.update(repr([(str(c), str(t)) for c, t in obj.dtypes.items()])
+                 .encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, (pd.Series, pd.Index)):
+        h.update(b'se' + str(obj.dtype).encode() + str(obj.name).encode())
+        h.update(pd.util.hash_pandas_object(obj).values.tobytes())
+    elif isinstance(obj, np.ndarray):
+        h.update(b'ar' + str(obj.dtype).encode() + str(obj.shape).encode())
+        if obj.dtype.hasobject:
+            h.update(pd.util.hash_array(obj.ravel()).tobytes())
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        h.update(b'dict')
+        for k in sorted(obj, key=str):
+            _update(h, k)
+            _update(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'seq' + str(len(obj)).encode())
+        for o in obj:
+            _update(h, o)
+    else:
+        h.update(repr(obj).encode())
+
+
+def _code_digest(h, code):
+    'Updates h with the bytecode and constants of code (and nested code).'
+
+    h.update(code.co_code)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            _code_digest(h, const)
+        else:
+            h.update(repr(const).encode())
+
+
+def _global_names(code):
+    'Returns the global names used by code (and nested code).'
+
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _global_names(const)
+    return names
+
+
+def _function_digest(h, fn, seen=None):
+    '''
+    Updates h with the code and default values of fn, and with those of the
+    TFM functions and classes it refers to by global name, recursively.
+    '''
+
+    seen = set() if seen is None else seen
+    fn = inspect.unwrap(fn)
+    if id(fn) in seen:
+        return
+    seen.add(id(fn))
+
+    if inspect.isclass(fn):
+        h.update(('class ' + fn.__qualname__).encode())
+        for name, member in sorted(vars(fn).items()):
+            member = getattr(member, '__func__', member)
+            if inspect.isfunction(member):
+                h.update(name.encode())
+                _function_digest(h, member, seen)
+        return
+
+    h.update(fn.__qualname__.encode())
+    _code_digest(h, fn.__code__)
+    _update(h, fn.__defaults__)
+    _update(h, fn.__kwdefaults__)
+    for name in sorted(_global_names(fn.__code__)):
+        obj = fn.__globals__.get(name)
+        if (inspect.isfunction(obj) or inspect.isclass(obj)) \
+                and getattr(obj, '__module__', '').startswith('TFM.'):
+            _function_digest(h, obj, seen)
+
+
+def _settings_state():
+    'Returns the column names and the dtype policy set in settings.'
+
+    return {
+        'right_ts': get_right_ts_name(none_permitted=True),
+        'user_id': get_user_id_name(none_permitted=True),
+        'target': get_target_name(none_permitted=True),
+        'code': get_code_name(none_permitted=True),
+        'dtypes': get_dtype_policy()
+    }
+
+
+class StageCache(object):
+    '''
+    Content-addressed on-disk cache of the outputs of pipeline stages
+    (pivoting_events, expand, fillna_cols, presequence_padding,
+    transform_features, build_datasets...).
+    Outputs are keyed by a hash of the stage code, the fingerprint of the
+    input data, the parameters and the settings (column names and dtype
+    policy). The code hash covers:
+     > the bytecode, constants and default values of the stage.
+     > the same for the TFM functions and classes (all their methods) it
+       refers to by global name, recursively (e.g. the group_ops helpers of
+       fillna_cols).
+     > the pandas and numpy versions and the VERSION salt.
+    It does not cover functions reached in other ways (attributes of
+    modules or objects, callbacks passed as values) nor other libraries:
+    bump VERSION (or clear the cache) after changing those.
+    Dataframes are stored as Parquet when pyarrow is available, other
+    outputs with joblib. When the cache exceeds max_mb, the least recently
+    used entries are evicted.
+    Parameters:
+     > path: cache directory (created if needed).
+     > max_mb: size bound of the cache in MB.
+    Ex:
+        cache = StageCache('cache')
+        df = cache.call(fillna_cols, df, ffill_cols=['visits'])
+        expand = cache.wrap(expand)
+    Calls with inplace=True are never cached. Stages that draw random
+    numbers (build_datasets) are keyed on the numpy global random state
+    too, and the random state after the call is stored with the output: a
+    cache hit restores it, so later draws (e.g. the training shuffles) are
+    the same as in an uncached run.
+    '''
+
+    VERSION = 1
+    RANDOM_STAGES = ('build_datasets',)
+    IGNORED_PARAMS = ('verbose',)
+
+    def __init__(self, path, max_mb=2 ** 12):
+        self.path = path
+        self.max_bytes = max_mb * 2 ** 20
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def key(self, fn, args, kwargs):
+        'Returns the cache key of a call of the stage fn.'
+
+        params = {k: v for k, v in kwargs.items()
+                  if k not in self.IGNORED_PARAMS}
+        h = hashlib.sha1()
+        h.update(fn.__name__.encode())
+        h.update('{} {} {}'.format(self.VERSION, pd.__version__,
+                                   np.__version__).encode())
+        _function_digest(h, fn)
+        h.update(fingerprint(list(args)).encode())
+        h.update(fingerprint(params).encode())
+        h.update(json.dumps(_settings_state(), sort_keys=True,
+                            default=str).encode())
+        if fn.__name__ in self.RANDOM_STAGES:
+            h.update(fingerprint(list(np.random.get_state())).encode())
+        return '{}-{}'.format(fn.__name__, h.hexdigest())
+
+    def _entry(self, key):
+        for ext in ('.parquet', '.pkl'):
+            path = os.path.join(self.path, key + ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _write(self, key, out):
+        '''
+        Writes an entry to a temporary file of the cache directory and moves
+        it into place, so an interrupted write never leaves a partial entry.
+        '''
+
+        ext = '.pkl'
+        if isinstance(out, pd.DataFrame) and _parquet_available() \
+                and all(isinstance(c, str) for c in out.columns):
+            ext = '.parquet'
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=key, suffix='.tmp')
+        os.close(fd)
+        try:
+            if ext == '.parquet':
+                try:
+                    out.to_parquet(tmp)
+                except Exception:
+                    ext = '.pkl'
+            if ext == '.pkl':
+                joblib.dump(out, tmp)
+            path = os.path.join(self.path, key + ext)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return path
+
+    def _read(self, path):
+        if path.endswith('.parquet'):
+            return pd.read_parquet(path)
+        return joblib.load(path)
+
+    def call(self, fn, *args, **kwargs):
+        'Returns fn(*args, **kwargs), loading it from the cache if possible.'
+
+        if kwargs.get('inplace'):
+            return fn(*args, **kwargs)
+
+        key = self.key(fn, args, kwargs)
+        path = self._entry(key)
+        if path is not None:
+            try:
+                out = self._read(path)
+            except Exception:
+                # unreadable entries (e.g. corrupted files) are misses
+                os.remove(path)
+                path = None
+        if path is not None:
+            self.hits += 1
+            # the modification time is the recency of the entry
+            os.utime(path, None)
+            if fn.__name__ in self.RANDOM_STAGES:
+                np.random.set_state(out['random_state'])
+                out = out['output']
+            return out
+
+        self.misses += 1
+        out = fn(*args, **kwargs)
+        if fn.__name__ in self.RANDOM_STAGES:
+            self._write(key, {'output': out,
+                              'random_state': np.random.get_state()})
+        else:
+            self._write(key, out)
+        self.evict()
+        return out
+
+    def wrap(self, fn):
+        'Returns the cached version of the stage fn.'
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return self.call(fn, *args, **kwargs)
+        return wrapper
+
+    def entries(self):
+        'Returns the cache entries (path, size, last use), most recent first.'
+
+        entries = []
+        for file in os.listdir(self.path):
+            # temporary files of writes in progress
+            if file.endswith('.tmp'):
+                continue
+            path = os.path.join(self.path, file)
+            st = os.stat(path)
+            entries.append((path, st.st_size, st.st_mtime))
+        return sorted(entries, key=lambda e: e[2], reverse=True)
+
+    def size(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        'Removes the least recently used entries beyond the size bound.'
+
+        total = 0
+        for path, size, _ in self.entries():
+            total += size
+            if total > self.max_bytes:
+                os.remove(path)
+
+    def clear(self):
+        for file in os.listdir(self.path):
+            os.remove(os.path.join(self.path, file))
@@ -1,8 +1,11 @@
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from dateutil import relativedelta
 
 
+from TFM.instrumentation import instrument
+from TFM.group_ops import group_bfill, group_ffill, group_shift, user_offsets
+from TFM.quantile_sketch import TDigest
 from TFM.settings import get_right_ts_name, get_target_name, get_user_id_name, get_code_name
 
 
@@ -21,11 +24,25 @@ def add_prior_target(df, p2p, target=None, user_id=None):
     target = get_target_name(target=target)
     user_id = get_user_id_name(user_id=user_id)
 
-    df['prior_target'] = df.groupby(user_id)[target] \
-        .transform(pd.Series.shift, p2p).fillna(0.)
+    offsets = user_offsets(df, user_id=user_id)
+    if offsets is None:
+        df['prior_target'] = df.groupby(user_id)[target] \
+            .shift(p2p).fillna(0.)
+    else:
+        df['prior_target'] = group_shift(df, target, periods=p2p,
+                                         offsets=offsets).fillna(0.)
 
     
+@instrument()
 def adding_target(e, periods, p2p, test=False, user_id=None, right_ts=None):
+    '''
+    Adds the target column to the events dataframe: 1 for the periods of the
+    users with cancer starting p2p - 1 months before the end of their
+    (train or test) period, 0 otherwise.
+    Parameters:
+     > p2p: periods to predict. If it is a list of horizons, one column per
+       horizon is added ('target_<p2p>') in a single pass over the events.
+    '''
 
     user_id = get_user_id_name(user_id=user_id)
     right_ts = get_right_ts_name(right_ts=right_ts)
@@ -34,53 +51,75 @@ def adding_target(e, periods, p2p, test=False, user_id=None, right_ts=None):
     m = periods['end_type'] == 'cancer'
 
     m2 = (periods['dat_can'] >= periods['temp_can'])
-    target = periods.loc[m].copy()
+    target = periods.loc[m]
     if test:
-        target = target.loc[m2].copy()
-        target['c_year'] = target['test_dat_max'].apply(lambda x: x - relativedelta.relativedelta(months=p2p - 1))
+        target = target.loc[m2]
+        dat_max = 'test_dat_max'
     else:
-        target['c_year'] = target['train_dat_max'].apply(lambda x: x - relativedelta.relativedelta(months=p2p - 1))
-    
-    cancers_year = target.set_index(user_id)['c_year'].to_dict()
-    e['c_year'] = e[user_id].map(cancers_year).copy()
-    e['target'] = (e[right_ts] >= e['c_year']).astype(float)
-    e.drop(['c_year'], axis=1, inplace=True)
+        dat_max = 'train_dat_max'
+    # the last period of each user is kept (as with a dict)
+    target = target.drop_duplicates(user_id, keep='last') \
+        .set_index(user_id)[dat_max]
+
+    # index join of the events with the users with cancer, done once
+    # (users without cancer take the NaT appended at the end)
+    idx = target.index.get_indexer(e[user_id])
+
+    horizons = p2p if isinstance(p2p, (list, tuple)) else [p2p]
+    for h in horizons:
+        # vectorised month arithmetic (day clipped to the month length)
+        c_year = (target - pd.DateOffset(months=h - 1)).values
+        c_year = pd.Series(np.append(c_year, np.datetime64('NaT'))[idx],
+                           index=e.index)
+        col = 'target_{}'.format(h) if isinstance(p2p, (list, tuple)) \
+            else 'target'
+        e[col] = (e[right_ts] >= c_year).astype(float)
     del target
 
 
+@instrument()
 def fillna_cols(df0, user_id=None, fillna_val={}, ffill_cols=[], bfill_cols=[],
-                verbose=True):
+                inplace=False, verbose=True):
     '''
     Fills null values in a dataframe by using the chosen method.
     Parameters:
      > fillna_cols: dict with col name (key) and fillna value (value).
      > ffill_cols: fills null values using the forward method per user.
      > bfill_cols: fills null values using the backward method per user.
+     > inplace: if True, df0 is filled and returned without being copied.
+    If the rows of each user are contiguous, all the ffill (bfill) columns
+    are filled in a single vectorised pass.
     '''
 
     user_id = get_user_id_name(user_id=user_id)
 
-    df = df0.copy()
+    df = df0 if inplace else df0.copy()
 
-    for col, val in fillna_val.items():
-        if col in df.columns:
-            df[col].fillna(value=val, inplace=True)
+    fillna_val = {col: val for col, val in fillna_val.items()
+                  if col in df.columns}
+    if fillna_val:
+        df.fillna(value=fillna_val, inplace=True)
 
-    for col in ffill_cols:
-        if col in df.columns:
-            df[col] = df.groupby(user_id, sort=False)[col] \
-                .apply(lambda x: x.ffill())
+    ffill_cols = [col for col in ffill_cols if col in df.columns]
+    bfill_cols = [col for col in bfill_cols if col in df.columns]
+    if not (ffill_cols or bfill_cols):
+        return df
 
-    for col in bfill_cols:
-        if col in df.columns:
-            df[col] = df.groupby(user_id, sort=False)[col] \
-                .apply(lambda x: x.bfill())
+    offsets = user_offsets(df, user_id=user_id)
+    if offsets is None:
+        if ffill_cols:
+            df[ffill_cols] = df.groupby(user_id, sort=False)[ffill_cols].ffill()
+        if bfill_cols:
+            df[bfill_cols] = df.groupby(user_id, sort=False)[bfill_cols].bfill()
+    else:
+        group_ffill(df, ffill_cols, offsets=offsets, inplace=True)
+        group_bfill(df, bfill_cols, offsets=offsets, inplace=True)
 
     return df
 
 
 def clip_continuous_f(se0, q2cl=0, q2cu=1, neg_val=True, return_se1=False,
-                      return_lu=False, show_hist=False, bins=20):
+                      return_lu=False, show_hist=False, bins=20, sketch=None):
     '''
     Returns a clipped continuous feature.
     Alternatively, it returns the lower and upper clip values.
@@ -94,15 +133,29 @@ def clip_continuous_f(se0, q2cl=0, q2cu=1, neg_val=True, return_se1=False,
      > return_lu: returns the lower and upper clip values.
      > show_hist: plots the feature histogram for its non-zero values.
      > bins: number of bins in the histogram.
+     > sketch: TDigest of the non-zero values of the feature (see
+       fit_sketches). If given, the clip values are its approximate
+       quantiles, and se0 is not sorted nor copied.
     '''
 
-    se1 = se0[se0 != 0].copy()
-    l = se1.quantile(q=q2cl)
-    u = se1.quantile(q=q2cu)
+    se1 = None
+    if sketch is not None:
+        l, u = sketch.quantile([q2cl, q2cu])
+    else:
+        se1 = se0[se0 != 0].copy()
+        l = se1.quantile(q=q2cl)
+        u = se1.quantile(q=q2cu)
     if not neg_val:
         l = 0
+
+    if return_lu and not show_hist:
+        return (l, u)
+
     se0_clip = se0.clip(lower=l, upper=u)
-    se1.clip(lower=l, upper=u, inplace=True)
+    if return_se1 or show_hist:
+        if se1 is None:
+            se1 = se0[se0 != 0].copy()
+        se1.clip(lower=l, upper=u, inplace=True)
 
     # histogram
     if show_hist:
@@ -122,8 +175,204 @@ def clip_continuous_f(se0, q2cl=0, q2cu=1, neg_val=True, return_se1=False,
     return se0_clip
 
 
+def fit_sketches(chunks, cols, sketches=None, delta=1000):
+    '''
+    Returns a dict of columns and the TDigest sketches of their non-zero
+    values (the values clip_continuous_f takes the quantiles of).
+    Parameters:
+     > chunks: dataframe or iterable of dataframes (e.g. shards or user
+       partitions), added one at a time.
+     > cols: list of columns (or dict with columns as keys).
+     > sketches: dict of sketches to update (e.g. of former chunks).
+     > delta: compression of the new sketches (see TDigest).
+    Sketches of different partitions are combined with merge_sketches.
+    '''
+
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
+    sketches = dict(sketches or {})
+    for col in cols:
+        if col not in sketches:
+            sketches[col] = TDigest(delta=delta)
+    for chunk in chunks:
+        for col in cols:
+            v = chunk[col].values
+            sketches[col].update(v[v != 0])
+    return sketches
+
+
+def merge_sketches(sketches_list):
+    'Merges a list of dicts of sketches (see fit_sketches) column-wise.'
+
+    cols = sketches_list[0].keys()
+    return {col: TDigest.merge_all(sketches[col] for sketches in sketches_list)
+            for col in cols}
+
+
+def sketch_bounds(sketches, cols):
+    '''
+    Returns the approximate clip bounds (lower, upper) of a dict of columns
+    and clip specs (see fit_trends) from their sketches. Columns without
+    spec get (None, None), i.e. no clipping, so the result can be used as
+    the lstm_cols of transform_features.
+    Ex:
+        sketches = fit_sketches(chunks, ['visits', 'expense'])
+        lstm_cols = sketch_bounds(sketches, {'visits': {'q2cu': .99},
+                                             'expense': {'q2cu': .99}})
+    '''
+
+    return {col: clip_continuous_f(None, return_lu=True,
+                                   sketch=sketches[col], **spec)
+            if spec else (None, None)
+            for col, spec in cols.items()}
+
+
+def trend_bounds(df, cols, sketches=None):
+    '''
+    Returns the clip bounds (lower, upper) of the columns of a dict of clip
+    specs (see fit_trends). Columns without spec are not clipped.
+    If a dict of sketches is given (see fit_sketches), the bounds are their
+    approximate quantiles instead.
+    '''
+
+    if sketches is not None:
+        return {col: lu for col, lu in sketch_bounds(sketches, cols).items()
+                if cols[col]}
+    return {col: clip_continuous_f(df[col], return_lu=True, **spec)
+            for col, spec in cols.items() if spec}
+
+
+def trend_sums(df, cols, bounds={}, right_ts=None):
+    '''
+    Returns the active users (weight == 1) and the sums of the clipped cols
+    per period, computed with one groupby. Sums of different user
+    partitions can be added up before building the trend table (see
+    trends_from_sums).
+    Parameters:
+     > bounds: dict of columns and their clip bounds (see trend_bounds).
+    '''
+
+    right_ts = get_right_ts_name(right_ts=right_ts)
+
+    cols = list(cols)
+    active = df.loc[df['weight'] == 1, [right_ts] + cols].copy()
+    for col, (l, u) in bounds.items():
+        active[col] = active[col].clip(lower=l, upper=u)
+
+    groups = active.groupby(right_ts)
+    sums = groups[cols].sum()
+    sums.insert(0, 'users', groups.size())
+    return sums
+
+
+def trends_from_sums(sums):
+    '''
+    Returns the trend table (see fit_trends) of the per-period sums returned
+    by trend_sums (or of their sum over several partitions).
+    '''
+
+    sums = sums.sort_index()
+    users = sums['users']
+    means = sums.drop(columns=['users']).div(users, axis=0)
+
+    trend = pd.DataFrame({'users': users})
+    for col in means.columns:
+        trend[col + '_mean'] = means[col]
+        trend[col + '_mean_diff'] = means[col].diff().fillna(0)
+    return trend
+
+
+# clip spec of trend_enrichment by default (clipped to the range of the
+# non-zero values)
+_DEFAULT_CLIP = {'q2cl': 0, 'q2cu': 1, 'neg_val': True}
+
+
+def _trend_specs(cols):
+    '''
+    Returns the dict of clip specs of a list (clipped with the defaults of
+    trend_enrichment) or dict of trend columns.
+    '''
+
+    if isinstance(cols, dict):
+        return cols
+    return {col: dict(_DEFAULT_CLIP) for col in cols}
+
+
+def fit_trends(df, cols, right_ts=None, sketches=None):
+    '''
+    Returns the per-period trend table of several continuous features,
+    computed over the active user-periods (weight == 1) with one groupby.
+    Parameters:
+     > cols: list of columns or dict of columns (keys) and their clip specs
+       (values), i.e. dicts with the q2cl, q2cu and neg_val arguments of
+       clip_continuous_f. Columns of a list are clipped with the defaults of
+       trend_enrichment (to the range of their non-zero values), so their
+       trends are the same as with trend_enrichment. Columns of a dict with
+       an empty spec ({} or None) are not clipped.
+    The table is indexed by period and has the columns:
+     > users: active users per period.
+     > col_mean: global mean of the clipped col per period.
+     > col_mean_diff: difference of the global mean between periods.
+     > sketches: dict of sketches of the columns (see fit_sketches) giving
+       approximate clip bounds. By default, exact quantiles are used.
+    '''
+
+    specs = _trend_specs(cols)
+    bounds = trend_bounds(df, specs, sketches=sketches)
+    sums = trend_sums(df, specs, bounds=bounds, right_ts=right_ts)
+    return trends_from_sums(sums)
+
+
+def apply_trends(df0, trend, right_ts=None, inplace=False):
+    '''
+    Adds the columns of a trend table (see fit_trends) to a dataframe with a
+    single index join on the period. Periods out of the table get NaN.
+    '''
+
+    right_ts = get_right_ts_name(right_ts=right_ts)
+
+    df = df0 if inplace else df0.copy()
+    idx = trend.index.get_indexer(df[right_ts])
+    for c in trend.columns:
+        if c != 'users':
+            df[c] = np.append(trend[c].values, np.nan)[idx]
+    return df
+
+
+@instrument()
+def trend_enrichment_batch(df0, cols, right_ts=None, drop_clip=True,
+                           inplace=False, sketches=None):
+    '''
+    Enriches dataset with global trend data for several continuous features
+    at once (see trend_enrichment).
+    Parameters:
+     > cols: list of columns or dict of columns and clip specs (see
+       fit_trends).
+     > drop_clip: If False, the clipped cols (col_clip) are added.
+     > inplace: If True, df0 is enriched without being copied.
+     > sketches: dict of sketches of the columns (see fit_sketches) giving
+       approximate clip bounds.
+    Returns the enriched dataset and the fitted trend table, which can be
+    applied to new data with apply_trends.
+    '''
+
+    right_ts = get_right_ts_name(right_ts=right_ts)
+
+    trend = fit_trends(df0, cols, right_ts=right_ts, sketches=sketches)
+    df = df0 if inplace else df0.copy()
+    if not drop_clip:
+        for col, spec in _trend_specs(cols).items():
+            if not spec:
+                df[col + '_clip'] = df[col]
+                continue
+            df[col + '_clip'] = clip_continuous_f(
+                df[col], sketch=(sketches or {}).get(col), **spec)
+    apply_trends(df, trend, right_ts=right_ts, inplace=True)
+    return df, trend
+
+
 def trend_enrichment(df0, col, right_ts=None, q2cl=0, q2cu=1, neg_val=True,
-                     drop_clip=True, show_plot=True, bins=20):
+                     drop_clip=True, show_plot=True, bins=20, sketch=None):
     '''
     Enriches dataset with global trend data for the chosen
     continuous feature.
@@ -135,41 +384,26 @@ def trend_enrichment(df0, col, right_ts=None, q2cl=0, q2cu=1, neg_val=True,
      > neg_val: If True, negative values are coherent for col.
      > drop_clip: If True, the clipped col is excluded from the resulting
        dataset.
+     > sketch: TDigest of the non-zero values of col (see fit_sketches)
+       giving approximate clip bounds.
 
     The added columns are:
      > col_clip: clipped col (optional).
      > col_mean: global mean of col per period.
      > col_mean_diff: difference of the global mean between periods.
+    Use trend_enrichment_batch to enrich several columns at once.
     '''
 
     right_ts = get_right_ts_name(right_ts=right_ts)
 
-    df = df0.copy()
-
-    # clip continuous feature
-    df[col + '_clip'], se1 = clip_continuous_f(df[col], q2cl=q2cl, q2cu=q2cu,
-                                               neg_val=neg_val,
-                                               return_se1=True)
-
-    # compute trend
-    active_users = df.loc[df['weight'] == 1][right_ts].value_counts()
-    global_col = df.loc[df['weight'] == 1] \
-        .groupby(right_ts)[col + '_clip'].sum()
-    trend = pd.concat([
-        active_users, global_col
-    ], axis=1).sort_index()
-    trend.columns = ['users', col]
-    trend[col + '_mean'] = trend[col] / trend['users']
-    trend[col + '_mean_diff'] = trend[col + '_mean'].diff().fillna(0)
-
-    for c in [col + '_mean', col + '_mean_diff']:
-        d = trend[c].to_dict()
-        df[c] = df[right_ts].map(d)
-
-    if drop_clip:
-        df.drop(columns=col + '_clip', inplace=True)
+    spec = {'q2cl': q2cl, 'q2cu': q2cu, 'neg_val': neg_val}
+    sketches = None if sketch is None else {col: sketch}
+    df, trend = trend_enrichment_batch(df0, {col: spec}, right_ts=right_ts,
+                                       drop_clip=drop_clip, sketches=sketches)
 
     if show_plot:
+        _, se1 = clip_continuous_f(df0[col], return_se1=True, sketch=sketch,
+                                   **spec)
         fig, axs = plt.subplots(1, 2, figsize=(15, 5))
 
         ax0 = se1.hist(ax=axs[0], bins=bins)
@@ -180,6 +414,7 @@ def trend_enrichment(df0, col, right_ts=None, q2cl=0, q2cu=1, neg_val=True,
         ax1 = trend[col + '_mean'].plot(ax=axs[1])
         ax1.set_title('Periodic {} per user'.format(col))
         ax1.set_ylabel('(Clipped) {}'.format(col))
+        del se1
 
-    del se1, active_users, global_col, trend, d
+    del trend
     return df
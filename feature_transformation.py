@@ -1,7 +1,12 @@
-from sklearn.preprocessing import LabelEncoder, Imputer, MinMaxScaler
+from sklearn.externals import joblib
 from TFM.feature_engineering import clip_continuous_f
-from TFM.settings import get_right_ts_name, get_target_name, get_user_id_name, get_code_name
+from TFM.instrumentation import instrument
+from TFM.load_data import code_mask
+from TFM.quantile_sketch import TDigest
+from TFM.settings import get_dtype_policy, get_right_ts_name, get_target_name, get_user_id_name, get_code_name
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 
 def has_nulls(s):
@@ -9,20 +14,267 @@ def has_nulls(s):
 
 
 def is_binary(s):
-    return sorted(s.unique()) == [0, 1]
+    u = s.unique()
+    return len(u) == 2 and sorted(u) == [0, 1]
 
 
+class FeatureTransformer(object):
+    '''
+    Fitted preprocessing of transform_features, so that it can be saved and
+    applied to new data (e.g. monthly scoring) without refitting.
+    Continuous and LSTM features are imputed (strategy) and min-max scaled
+    (unless binary) as a single 2D array. LSTM features are clipped before
+    fitting the scaling. Categorical features are label encoded; values
+    unseen when fitting take a reserved index (the number of classes), so M
+    has room for it in the embeddings.
+    M holds the (input, output) dims of each embedding: the input dim is the
+    number of classes + 1 and the output dim is min(classes, cat_cols[f]),
+    as before the reserved index was added. Embedding weights trained
+    without the reserved index have one input row less and must be padded
+    with a row (e.g. of zeros) to be loaded.
+    Parameters:
+     > con_cols: list of continuous columns
+     > lstm_cols: list / dict of LSTM continuous columns (keys) and their lower and
+       upper clip values (values).
+     > cat_cols: dict of categorical columns (keys) and
+       the number of features to be returned.
+     > strategy: 'median', 'mean' or 'most_frequent'.
+    '''
+
+    def __init__(self, con_cols=[], lstm_cols=[], cat_cols={},
+                 strategy='median'):
+        self.con_cols = list(con_cols)
+        self.lstm_cols = lstm_cols
+        self.cat_cols = cat_cols
+        self.strategy = strategy
+
+    @property
+    def lstm_col_list(self):
+        return list(self.lstm_cols)
+
+    @property
+    def num_cols(self):
+        return self.con_cols + self.lstm_col_list
+
+    @property
+    def feat_dict(self):
+        return {
+            'con_feats': ['con__' + f for f in self.con_cols],
+            'lstm_feats': ['con__' + f for f in self.lstm_col_list],
+            'cat_feats': ['cat__' + f for f in self.cat_cols.keys()],
+            # the embedding output dim, min(M), ignores the unknown slot
+            'M': [(len(self.classes_[f]) + 1,
+                   min(len(self.classes_[f]), self.cat_cols[f]))
+                  for f in self.cat_cols.keys()]
+        }
+
+    def _fill_value(self, s):
+        if self.strategy == 'mean':
+            return s.mean()
+        if self.strategy == 'most_frequent':
+            return s.mode().iloc[0]
+        return s.median()
+
+    def fit(self, df, verbose=True):
+
+        clip = isinstance(self.lstm_cols, dict)
+        n = len(self.num_cols)
+        self.fill_ = np.zeros(n)
+        self.scale_ = np.ones(n)
+        self.min_ = np.zeros(n)
+
+        if verbose:
+            print('> Preprocessing continuous and LSTM features...')
+        for i, f in enumerate(self.num_cols):
+            s = df[f]
+            self.fill_[i] = self._fill_value(s)
+            if has_nulls(s):
+                s = s.fillna(self.fill_[i])
+            if not is_binary(s):
+                if clip and i >= len(self.con_cols):
+                    s = s.clip(self.lstm_cols[f][0], self.lstm_cols[f][1])
+                # same parameters as MinMaxScaler()
+                data_range = s.max() - s.min()
+                self.scale_[i] = 1. / (data_range if data_range != 0 else 1.)
+                self.min_[i] = 0 - s.min() * self.scale_[i]
+            if verbose:
+                print('  > {}'.format(f))
+
+        if verbose:
+            print()
+            print('> Preprocessing categorical features...')
+        # same classes as LabelEncoder()
+        self.classes_ = {}
+        for f in self.cat_cols.keys():
+            self.classes_[f] = np.unique(df[f].values)
+            if verbose:
+                print('  > {}'.format(f))
+
+        return self
+
+    def partial_stats(self, df, sketch=False):
+        '''
+        Returns the statistics of a partition of the data (e.g. a set of
+        users) needed to fit the transformer. Statistics of several
+        partitions are combined with merge_stats and fitted with fit_stats,
+        so the data never has to be in a single dataframe.
+        If sketch, medians are approximated with a TDigest instead of
+        keeping the values.
+        '''
+
+        stats = {'num': {}, 'cat': {}}
+        for f in self.num_cols:
+            v = df[f].values
+            v = v[~pd.isnull(v)].astype(float)
+            st = {
+                'rows': len(df),
+                'n': len(v),
+                'sum': v.sum(),
+                'min': v.min() if len(v) else np.inf,
+                'max': v.max() if len(v) else -np.inf,
+                # is_binary only needs up to 3 distinct values
+                'uniques': np.unique(v)[:3]
+            }
+            if self.strategy == 'median':
+                if sketch:
+                    st['sketch'] = TDigest(v)
+                else:
+                    st['values'] = v
+            elif self.strategy == 'most_frequent':
+                st['counts'] = pd.Series(v).value_counts()
+            stats['num'][f] = st
+        for f in self.cat_cols.keys():
+            stats['cat'][f] = np.unique(df[f].values)
+        return stats
+
+    @staticmethod
+    def merge_stats(stats_list):
+        'Combines the partial_stats of several partitions.'
+
+        merged = {'num': {}, 'cat': {}}
+        for f in stats_list[0]['num']:
+            parts = [stats['num'][f] for stats in stats_list]
+            st = {
+                'rows': sum(p['rows'] for p in parts),
+                'n': sum(p['n'] for p in parts),
+                'sum': sum(p['sum'] for p in parts),
+                'min': min(p['min'] for p in parts),
+                'max': max(p['max'] for p in parts),
+                'uniques': np.unique(np.concatenate(
+                    [p['uniques'] for p in parts]))[:3]
+            }
+            if 'values' in parts[0]:
+                st['values'] = np.concatenate([p['values'] for p in parts])
+            if 'sketch' in parts[0]:
+                st['sketch'] = TDigest.merge_all(p['sketch'] for p in parts)
+            if 'counts' in parts[0]:
+                st['counts'] = pd.concat([p['counts'] for p in parts]) \
+                    .groupby(level=0).sum()
+            merged['num'][f] = st
+        for f in stats_list[0]['cat']:
+            merged['cat'][f] = np.unique(np.concatenate(
+                [stats['cat'][f] for stats in stats_list]))
+        return merged
+
+    def fit_stats(self, stats, verbose=True):
+        '''
+        Fits the transformer from (merged) partial_stats, with the same
+        parameters as fit (up to floating point rounding of the mean).
+        '''
+
+        clip = isinstance(self.lstm_cols, dict)
+        n = len(self.num_cols)
+        self.fill_ = np.zeros(n)
+        self.scale_ = np.ones(n)
+        self.min_ = np.zeros(n)
+
+        for i, f in enumerate(self.num_cols):
+            st = stats['num'][f]
+            if self.strategy == 'mean':
+                self.fill_[i] = st['sum'] / st['n']
+            elif self.strategy == 'most_frequent':
+                counts = st['counts'].sort_index()
+                self.fill_[i] = counts.idxmax()
+            elif 'sketch' in st:
+                self.fill_[i] = st['sketch'].quantile(.5)
+            else:
+                self.fill_[i] = np.median(st['values'])
+            lo, hi, uniques = st['min'], st['max'], st['uniques']
+            if st['n'] < st['rows']:
+                lo, hi = min(lo, self.fill_[i]), max(hi, self.fill_[i])
+                uniques = np.unique(np.append(uniques, self.fill_[i]))
+            if not (len(uniques) == 2 and sorted(uniques) == [0, 1]):
+                if clip and i >= len(self.con_cols):
+                    l, u = self.lstm_cols[f]
+                    if l is not None:
+                        lo, hi = max(lo, l), max(hi, l)
+                    if u is not None:
+                        lo, hi = min(lo, u), min(hi, u)
+                data_range = hi - lo
+                self.scale_[i] = 1. / (data_range if data_range != 0 else 1.)
+                self.min_[i] = 0 - lo * self.scale_[i]
+            if verbose:
+                print('  > {}'.format(f))
+
+        self.classes_ = dict(stats['cat'])
+        return self
+
+    def transform(self, df0, drop_cols=True):
+        '''
+        Returns the dataframe with the transformed features ('con__' and
+        'cat__' columns), with the float and int dtypes of the dtype policy.
+        '''
+
+        dtypes = get_dtype_policy()
+        con = pd.DataFrame(index=df0.index)
+        if self.num_cols:
+            X = df0[self.num_cols].values.astype(dtypes['float'])
+            nulls = np.isnan(X)
+            if nulls.any():
+                X[nulls] = np.broadcast_to(self.fill_, X.shape)[nulls]
+            X *= self.scale_
+            X += self.min_
+            con = pd.DataFrame(X, index=df0.index,
+                               columns=['con__' + f for f in self.num_cols])
+
+        for f in self.cat_cols.keys():
+            codes = pd.Categorical(df0[f], categories=self.classes_[f]).codes
+            con['cat__' + f] = np.where(codes < 0, len(self.classes_[f]),
+                                        codes).astype(dtypes['int'])
+
+        if drop_cols:
+            cols = self.num_cols + list(self.cat_cols.keys())
+            df0 = df0.drop(columns=cols)
+        return pd.concat([df0, con], axis=1)
+
+    def fit_transform(self, df0, drop_cols=True, verbose=True):
+        return self.fit(df0, verbose=verbose).transform(df0,
+                                                        drop_cols=drop_cols)
+
+    def save(self, path):
+        joblib.dump(self, path)
+
+    @classmethod
+    def load(cls, path):
+        return joblib.load(path)
+
+
+@instrument()
 def transform_features(df0, con_cols=[], lstm_cols=[], cat_cols={},
-                       strategy='median', drop_cols=True, verbose=True):
+                       strategy='median', drop_cols=True,
+                       return_transformer=False, verbose=True):
     '''
     Returns:
      > dataframe with transformed features
      > feat_dict with lists of continuous, LSTM and categorical features and M
+     > the fitted FeatureTransformer (if return_transformer), which can be
+       saved and applied to new data without refitting.
     If necessary, it applies 2 transformers to the continuous and LSTM features:
      > Imputer()
      > MinMaxScaler()
     Clips LSTM features before fitting the MinMaxScaler().
-    Applies a label encoder to the categorical columns.
+    Applies a label encoder to the categorical columns (unseen values take a
+    reserved index).
     Parameters:
      > con_cols: list of continuous columns
      > lstm_cols: list / dict of LSTM continuous columns (keys) and their lower and
@@ -33,116 +285,91 @@ def transform_features(df0, con_cols=[], lstm_cols=[], cat_cols={},
      > drop_cols: if True, the original columns are excluded.
     '''
 
-    df = df0.copy()
+    ft = FeatureTransformer(con_cols=con_cols, lstm_cols=lstm_cols,
+                            cat_cols=cat_cols, strategy=strategy)
+    df = ft.fit_transform(df0, drop_cols=drop_cols, verbose=verbose)
 
-    # User profile continuous features
-    if verbose:
-        print('> Preprocessing continuous features...')
-    con_features = []
-    for f in con_cols:
-        if has_nulls(df[f]):
-            t1 = Imputer(strategy=strategy)
-            df['con__' + f] = t1.fit_transform(df[[f]])
-        else:
-            df['con__' + f] = df[f]
-        if not is_binary(df['con__' + f]):
-            t2 = MinMaxScaler()
-            df['con__' + f] = t2.fit_transform(df[['con__' + f]])
-        con_features.append('con__' + f)
-        if verbose:
-            print('  > {}'.format(f))
-
-    # LSTM / sequence continuous features
-    if verbose:
-        print()
-        print('> Preprocessing LSTM continuous features...')
-    lstm_features = []
+    if return_transformer:
+        return df, ft.feat_dict, ft
+    return df, ft.feat_dict
 
-    clip = isinstance(lstm_cols, dict)
-    if clip:
-        lstm_col_list = list(lstm_cols.keys())
-    else:
-        lstm_col_list = lstm_cols
 
-    for f in lstm_col_list:
+def get_all_times(events, right_ts=None):
 
-        if has_nulls(df[f]):
-            t1 = Imputer(strategy=strategy)
-            df['con__' + f] = t1.fit_transform(df[[f]])
-        else:
-            df['con__' + f] = df[f]
+    right_ts = get_right_ts_name(right_ts=right_ts)
+    time_index = pd.DataFrame(sorted(events[right_ts].unique()), columns=[right_ts])
+    del events
+    return time_index
 
-        if not is_binary(df['con__' + f]):
-            if clip:
-                s = df[['con__' + f]].clip(lstm_cols[f][0],
-                                           lstm_cols[f][1])
-            else:
-                s = df[['con__' + f]]
-            t2 = MinMaxScaler()
-            t2.fit(s)
-            df['con__' + f] = t2.transform(df[['con__' + f]])
 
-        lstm_features.append('con__' + f)
-        if verbose:
-            print('  > {}'.format(f))
+def _expand_users(keyed, users, times, cols, user_id, right_ts, start=0):
+    '''
+    Returns the user x time grid of the given users with the data in keyed
+    (indexed by user_id and right_ts) aligned to it.
+    '''
 
-    # User profile categorical features
-    if verbose:
-        print()
-        print('> Preprocessing categorical features...')
-    cat_features = []
-    M = []
-
-    for f in cat_cols.keys():
-        le = LabelEncoder()
-        df['cat__' + f] = le.fit_transform(df[f])
-        m = df['cat__' + f].max() + 1
-        cat_features.append('cat__' + f)
-        M.append((m, cat_cols[f]))
-        if verbose:
-            print('  > {}'.format(f))
+    grid = pd.MultiIndex.from_product([users, times], names=[user_id, right_ts])
+    if keyed.index.is_unique:
+        df_expanded = keyed.reindex(grid).reset_index()
+    else:
+        df_expanded = pd.DataFrame(index=grid).reset_index() \
+            .merge(keyed.reset_index(), on=[user_id, right_ts], how='left')
+    df_expanded = df_expanded[[right_ts, user_id] + cols]
+    df_expanded.index = pd.RangeIndex(start, start + len(df_expanded))
+    return df_expanded
 
-    if drop_cols:
-        df.drop(columns=con_cols + lstm_col_list + list(cat_cols.keys()),
-                inplace=True)
 
-    feat_dict = {
-        'con_feats': con_features,
-        'lstm_feats': lstm_features,
-        'cat_feats': cat_features,
-        'M': M
-    }
+def iter_expand(df, time_index, chunk_size, user_id=None, right_ts=None):
+    '''
+    Yields the expanded dataframe (see expand) in chunks of chunk_size users,
+    so the whole expanded panel never has to fit in memory.
+    '''
 
-    return df, feat_dict
+    user_id = get_user_id_name(user_id=user_id)
+    right_ts = get_right_ts_name(right_ts=right_ts)
 
+    df = df.reset_index()
+    cols = [c for c in df.columns if c not in (user_id, right_ts)]
+    times = time_index[right_ts].values
 
-def get_all_times(events, right_ts=None):
+    # rows grouped by user chunk (users in order of appearance)
+    codes, users = pd.factorize(df[user_id])
+    chunk = codes // chunk_size
+    order = np.argsort(chunk, kind='mergesort')
+    bounds = np.searchsorted(chunk[order], np.arange(len(users) // chunk_size + 2))
+    keyed = df.take(order).set_index([user_id, right_ts])
+    del df
 
-    right_ts = get_right_ts_name(right_ts=right_ts)
-    time_index = pd.DataFrame(sorted(events[right_ts].unique()), columns=[right_ts])
-    del events
-    return time_index
+    start = 0
+    for k in range(0, len(users), chunk_size):
+        i, j = bounds[k // chunk_size], bounds[k // chunk_size + 1]
+        df_expanded = _expand_users(keyed.iloc[i:j], users[k:k + chunk_size],
+                                    times, cols, user_id, right_ts,
+                                    start=start)
+        start += len(df_expanded)
+        yield df_expanded
 
 
+@instrument()
 def expand(df, time_index, user_id=None, right_ts=None):
-    'Returns: a dataframe with all the missing dates fully with missing data'
+    '''
+    Returns: a dataframe with all the missing dates fully with missing data.
+    The user x time grid is built at once from the unique users and
+    time_index and aligned with the data. Use iter_expand to get it in chunks
+    of users.
+    '''
 
     user_id = get_user_id_name(user_id=user_id)
     right_ts = get_right_ts_name(right_ts=right_ts)
 
-    df.reset_index(inplace=True)
-    df_expanded = []
-    for i in df[user_id].unique():
-        ti = time_index.copy()
-        ti[user_id] = i
-        df_expanded.append(ti)
-    df_expanded = pd.concat(df_expanded, axis=0)
-
-    # Merge index with event data
-    df_expanded = df_expanded.merge(df, on=[user_id, right_ts], how='left', copy=False)
-
+    df = df.reset_index()
+    cols = [c for c in df.columns if c not in (user_id, right_ts)]
+    users = df[user_id].unique()
+    keyed = df.set_index([user_id, right_ts])
     del df
-    return df_expanded
+
+    return _expand_users(keyed, users, time_index[right_ts].values, cols,
+                         user_id, right_ts)
 
 
 def adding_columns(chunk, list_type, verbose=True):
@@ -160,24 +387,29 @@ def adding_columns(chunk, list_type, verbose=True):
     del disjoint_list
 
 
-def generating_catalegs(events_type, code=None):
+def generating_catalegs(events_type, code=None, code_dict=None):
+    '''
+    Returns the sorted list of codes in events_type, excluding cancers other
+    than melanoma. With a CodeDictionary (or a categorical code column) the
+    exclusion is computed over the unique codes only.
+    '''
 
     code = get_code_name(code=code)
 
-    list_type = events_type[code].unique().tolist()
-
-    #print('Number of columns of this type: ', len(list_type))
-    cancer_mask = events_type[code].str[:3] != 'd_C'
-    melanoma = events_type[code].str[:5] == 'd_C44'
-    list_type = events_type[cancer_mask | melanoma].groupby([code])[code].size().to_frame('N')
+    if code_dict is not None:
+        ids = np.unique(code_dict.ids(events_type[code]))
+        ids = ids[ids >= 0]
+        keep = ~code_dict.mask(ids, 'cancer') | code_dict.mask(ids, 'melanoma')
+        return sorted(code_dict.codes[i] for i in ids[keep])
 
-    #print('Number of columns of this type wo cancers: ', len(list_type))
-
-    list_type.reset_index(inplace=True)
-    list_type = list_type[code].tolist()
+    cancer_mask = ~code_mask(events_type[code], 'd_C')
+    melanoma = code_mask(events_type[code], 'd_C44')
+    list_type = sorted(events_type.loc[cancer_mask | melanoma, code]
+                       .dropna().unique())
     return list_type
 
 
+@instrument()
 def pivoting_events(events, agg_function, user_id=None, right_ts=None, code=None, verbose=True):
 
     user_id = get_user_id_name(user_id=user_id)
@@ -194,3 +426,96 @@ def pivoting_events(events, agg_function, user_id=None, right_ts=None, code=None
         print(input_data.shape)
     del events
     return input_data
+
+
+@instrument()
+def pivoting_events_sparse(events, agg_function, vocabulary, values=None,
+                           user_id=None, right_ts=None, code=None,
+                           verbose=True):
+    '''
+    Sparse version of pivoting_events with columns fixed to a code
+    vocabulary, so every chunk returns the same columns in the same order
+    (no adding_columns pass is needed).
+    Returns:
+     > CSR matrix of shape (user-periods, len(vocabulary)). Implicit entries
+       are user-period-codes without events (NaN in pivoting_events).
+     > MultiIndex (user_id, right_ts) of the matrix rows, sorted.
+    Parameters:
+     > agg_function: 'count', 'sum' or 'mean'. Null values are ignored:
+       user-periods without non-null values are dropped (as by
+       pivoting_events) and cells with only null values are implicit
+       entries.
+     > vocabulary: list of codes (e.g. from generating_catalegs). Events with
+       codes out of the vocabulary are dropped.
+     > values: column to aggregate. By default, the only column which is not
+       user_id, right_ts or code.
+    '''
+
+    user_id = get_user_id_name(user_id=user_id)
+    right_ts = get_right_ts_name(right_ts=right_ts)
+    code = get_code_name(code=code)
+
+    if agg_function not in ('count', 'sum', 'mean'):
+        msg = "\nUnknown aggregation function '{}'.".format(agg_function)
+        msg += "\nChoose one of: 'count', 'sum', 'mean'."
+        raise ValueError(msg)
+
+    if values is None:
+        values = [c for c in events.columns if c not in (user_id, right_ts, code)]
+        if len(values) != 1:
+            msg = "\nThe column to aggregate is ambiguous: {}.".format(values)
+            msg += "\nPass it to the function as 'values'."
+            raise ValueError(msg)
+        values = values[0]
+
+    # events with a code of the vocabulary and a non-null value (null
+    # values are not aggregated)
+    m = events[code].isin(vocabulary).values
+    val = events[values].values[m].astype(float)
+    not_null = ~np.isnan(val)
+    idx = np.flatnonzero(m)[not_null]
+    val = val[not_null]
+
+    # integer codes of the columns (fixed vocabulary) and rows
+    col = pd.Categorical(events[code].values[idx], categories=vocabulary) \
+        .codes.astype(np.int64)
+    u_code, u_uniq = pd.factorize(events[user_id].values[idx], sort=True)
+    t_code, t_uniq = pd.factorize(events[right_ts].values[idx], sort=True)
+    row_key, row = np.unique(u_code.astype(np.int64) * len(t_uniq) + t_code,
+                             return_inverse=True)
+    index = pd.MultiIndex.from_arrays([u_uniq[row_key // len(t_uniq)],
+                                       t_uniq[row_key % len(t_uniq)]],
+                                      names=[user_id, right_ts])
+
+    # aggregation per (row, col) cell
+    n_cols = len(vocabulary)
+    cell, cell_i = np.unique(row.astype(np.int64) * n_cols + col,
+                             return_inverse=True)
+    if agg_function == 'count':
+        data = np.bincount(cell_i, minlength=len(cell)).astype(float)
+    else:
+        data = np.bincount(cell_i, weights=val, minlength=len(cell))
+        if agg_function == 'mean':
+            data /= np.bincount(cell_i, minlength=len(cell))
+
+    indptr = np.searchsorted(cell // n_cols, np.arange(len(index) + 1))
+    input_data = sparse.csr_matrix((data, cell % n_cols, indptr),
+                                   shape=(len(index), n_cols))
+    if verbose:
+        print(input_data.nnz)
+        print(input_data.shape)
+    del events
+    return input_data, index
+
+
+def sparse_events_frame(input_data, index, vocabulary):
+    '''
+    Returns the output of pivoting_events_sparse as a pandas sparse frame
+    (implicit entries are 0).
+    '''
+
+    if hasattr(pd.DataFrame, 'sparse'):
+        return pd.DataFrame.sparse.from_spmatrix(input_data, index=index,
+                                                 columns=vocabulary)
+    return pd.SparseDataFrame(input_data, index=index, columns=vocabulary,
+                              default_fill_value=0)
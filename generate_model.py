@@ -1,10 +1,40 @@
-from keras.layers import Concatenate, Conv1D, Dense, Dropout, Embedding, Input, LeakyReLU, LSTM, Reshape
+from keras import backend as K
+from keras.layers import Concatenate, Conv1D, Dense, Dropout, Embedding, Input, Lambda, LeakyReLU, LSTM, Reshape
 from keras.models import Model
 from keras.optimizers import RMSprop, Adam
 from keras.regularizers import L1L2
 
 
-def generate_model(feat_dict):
+def _broadcast_time(x):
+    'Repeats the (batch, features) profile over the time-steps of a sequence.'
+
+    profile, seq = x
+    return K.expand_dims(profile, 1) * K.ones_like(seq[:, :, :1])
+
+
+def _broadcast_time_shape(input_shape):
+    profile_shape, seq_shape = input_shape
+    return (seq_shape[0], seq_shape[1], profile_shape[-1])
+
+
+def broadcast_profile(profile, seq, name=None):
+    '''
+    Returns the static profile tensor (batch, features) broadcast across the
+    time-steps of seq (batch, time, ...).
+    '''
+
+    return Lambda(_broadcast_time, output_shape=_broadcast_time_shape,
+                  name=name)([profile, seq])
+
+
+def generate_model(feat_dict, static=False):
+    '''
+    Returns the compiled LSTM model. Parameters:
+     > static: if True, the profile features (categorical and continuous
+       inputs) are fed once per user with shapes (1,) and (n_con_feats,),
+       as returned by build_datasets(..., static=True). They are embedded
+       once and broadcast across time inside the graph.
+    '''
 
     con_feats = feat_dict['con_feats']
     lstm_feats = feat_dict['lstm_feats']
@@ -12,15 +42,17 @@ def generate_model(feat_dict):
 
     # Initialize input
     INPUT = [[], [], []]
+    steps = () if static else (None,)
 
     # A) USER PROFILE FEATURE LAYERS
     # categorical features
     for i, m in enumerate(M):
-        INPUT[0].append(Input(shape=(None, 1), name='cat_' + str(i) + '_input'))
+        INPUT[0].append(Input(shape=steps + (1,), name='cat_' + str(i) + '_input'))
         INPUT[1].append(Embedding(m[0], min(m), name='cat_' + str(i) + '_embedding')(INPUT[0][-1]))
-        INPUT[2].append(Reshape((-1, min(m)), name='cat_' + str(i) + '_reshape')(INPUT[1][-1]))
+        emb_shape = (min(m),) if static else (-1, min(m))
+        INPUT[2].append(Reshape(emb_shape, name='cat_' + str(i) + '_reshape')(INPUT[1][-1]))
     # continuous features
-    cont_input = Input(shape=(None, len(con_feats)), name='cont_input')
+    cont_input = Input(shape=steps + (len(con_feats),), name='cont_input')
     INPUT[2].append(cont_input)
     # input concatenation
     concat1 = Concatenate(name='profile_concat')(INPUT[2])
@@ -33,7 +65,11 @@ def generate_model(feat_dict):
     # lstm2 from input lstm1
     lstm2 = LSTM(32, recurrent_regularizer=L1L2(), dropout=.1, return_sequences=True,
                  name='lstm_layer_2')(lstm1)
-    concat2 = Concatenate(name='profile_lstm_concat')(INPUT[2] + [lstm2])
+    if static:
+        profile = broadcast_profile(concat1, lstm2, name='profile_broadcast')
+        concat2 = Concatenate(name='profile_lstm_concat')([profile, lstm2])
+    else:
+        concat2 = Concatenate(name='profile_lstm_concat')(INPUT[2] + [lstm2])
 
     # C) DENSE LAYERS
     # dns1 from concat2
@@ -60,18 +96,82 @@ def generate_model(feat_dict):
     return model
 
 
-def generate_model2(con_cols, lstm_list, M, cells):
+def generate_step_model(model, feat_dict, static=False):
+    '''
+    Returns an inference copy of a model built with generate_model whose
+    LSTM layers take their initial hidden and cell states as inputs and
+    return their final states, so sequences can be advanced from stored
+    states (see stateful_scoring). The trained weights are copied by layer
+    name.
+    Inputs: generate_model inputs + [h1, c1, h2, c2].
+    Outputs: [prediction, h1, c1, h2, c2].
+    '''
+
+    con_feats = feat_dict['con_feats']
+    lstm_feats = feat_dict['lstm_feats']
+    M = feat_dict['M']
+
+    INPUT = [[], [], []]
+    steps = () if static else (None,)
+
+    # A) USER PROFILE FEATURE LAYERS
+    for i, m in enumerate(M):
+        emb_shape = (min(m),) if static else (-1, min(m))
+        INPUT[0].append(Input(shape=steps + (1,), name='cat_' + str(i) + '_input'))
+        INPUT[1].append(Embedding(m[0], min(m), name='cat_' + str(i) + '_embedding')(INPUT[0][-1]))
+        INPUT[2].append(Reshape(emb_shape, name='cat_' + str(i) + '_reshape')(INPUT[1][-1]))
+    cont_input = Input(shape=steps + (len(con_feats),), name='cont_input')
+    INPUT[2].append(cont_input)
+
+    # B) LSTM LAYERS (states in and out)
+    lstm_input = Input(shape=(None, len(lstm_feats)), name='lstm_input')
+    STATES = [Input(shape=(n,), name='{}_{}'.format(layer, s))
+              for layer, n in (('lstm_layer_1', 80), ('lstm_layer_2', 32))
+              for s in ('h', 'c')]
+    lstm1, h1, c1 = LSTM(80, return_sequences=True, return_state=True,
+                         name='lstm_layer_1')(lstm_input,
+                                              initial_state=STATES[:2])
+    lstm2, h2, c2 = LSTM(32, return_sequences=True, return_state=True,
+                         name='lstm_layer_2')(lstm1, initial_state=STATES[2:])
+    if static:
+        concat1 = Concatenate(name='profile_concat')(INPUT[2])
+        profile = broadcast_profile(concat1, lstm2, name='profile_broadcast')
+        concat2 = Concatenate(name='profile_lstm_concat')([profile, lstm2])
+    else:
+        concat2 = Concatenate(name='profile_lstm_concat')(INPUT[2] + [lstm2])
+
+    # C) DENSE LAYERS (dropout is inactive at inference)
+    dns1 = LeakyReLU()(Dense(128 * 3, name='dense_layer_1')(concat2))
+    dns2 = LeakyReLU()(Dense(128 * 1, name='dense_layer_2')(dns1))
+    dns3 = Dense(1, name='dense_layer_3')(dns2)
+
+    step_model = Model(INPUT[0] + [cont_input, lstm_input] + STATES,
+                       [dns3, h1, c1, h2, c2])
+    for layer in step_model.layers:
+        if layer.get_weights():
+            layer.set_weights(model.get_layer(layer.name).get_weights())
+
+    return step_model
+
+
+def generate_model2(con_cols, lstm_list, M, cells, static=False):
+    '''
+    Returns the compiled LSTM classifier. If static, the profile features are
+    fed once per user (see generate_model).
+    '''
 
     # Initialize input
     k = 0
     inputs = [[], [], []]
+    steps = () if static else (None,)
     for m in M:
-        inputs[0].append(Input(shape=(None, 1)))
+        emb_shape = (min(m[0], m[1]),) if static else (-1, min(m[0], m[1]))
+        inputs[0].append(Input(shape=steps + (1,)))
         inputs[1].append(Embedding(m[0], min(m[0], m[1]))(inputs[0][-1]))
-        inputs[2].append(Reshape((-1, min(m[0], m[1])))(inputs[1][-1]))
+        inputs[2].append(Reshape(emb_shape)(inputs[1][-1]))
         k += min(m[0], m[1])
 
-    cont_input = Input(shape=(None, len(con_cols)), name='cont_input')
+    cont_input = Input(shape=steps + (len(con_cols),), name='cont_input')
     inputs[2].append(cont_input)
     # input concatenation
     concat1 = Concatenate(name='profile_concat')(inputs[2])
@@ -83,7 +183,11 @@ def generate_model2(con_cols, lstm_list, M, cells):
                 recurrent_regularizer=L1L2(l1=0.0))(lstm_input)
     lstm1 = LSTM(12, return_sequences=True, input_shape=(None, k), stateful=False, dropout=0.1,
                 recurrent_regularizer=L1L2(l1=0.0))(lstm)
-    lstm2 = Concatenate(axis=-1)(inputs[2] + [lstm1])
+    if static:
+        profile = broadcast_profile(concat1, lstm1)
+        lstm2 = Concatenate(axis=-1)([profile, lstm1])
+    else:
+        lstm2 = Concatenate(axis=-1)(inputs[2] + [lstm1])
     print(k)
     # Dense layers
     dns1 = Dense(128, activation='relu')(lstm2)
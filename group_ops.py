@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+from TFM.settings import get_user_id_name
+
+
+def user_offsets(df, user_id=None):
+    '''
+    Returns the offsets of the user blocks of a panel whose rows are
+    contiguous per user (e.g. sorted by user and time-stamp): the rows of the
+    i-th user are offsets[i]:offsets[i + 1].
+    Returns None if the rows of some user are not contiguous.
+    '''
+
+    user_id = get_user_id_name(user_id=user_id)
+
+    users = df[user_id].values
+    change = np.flatnonzero(users[1:] != users[:-1]) + 1
+    offsets = np.concatenate([[0], change, [len(users)]]).astype(np.int64)
+    if len(users) and len(offsets) - 1 != len(pd.unique(users)):
+        return None
+    return offsets
+
+
+def _get_offsets(df, offsets=None, user_id=None):
+
+    if offsets is None:
+        offsets = user_offsets(df, user_id=user_id)
+    if offsets is None:
+        msg = "\nThe rows of each user are not contiguous."
+        msg += "\nSort the dataframe by user (and time-stamp) first."
+        raise ValueError(msg)
+    return offsets
+
+
+def _row_bounds(offsets):
+    'Returns the first and last row of the user block of every row.'
+
+    sizes = np.diff(offsets)
+    return np.repeat(offsets[:-1], sizes), np.repeat(offsets[1:] - 1, sizes)
+
+
+def _fill_index(mask, offsets, backward=False):
+    '''
+    Returns, for every row and column, the row of the last (first, if
+    backward) non-null value of its user block, or the row itself if there
+    is none. mask is the 2D not-null mask of the columns.
+    '''
+
+    n = len(mask)
+    rows = np.arange(n)[:, None]
+    first, last = _row_bounds(offsets)
+    if backward:
+        idx = np.where(mask, rows, n)
+        idx = np.minimum.accumulate(idx[::-1], axis=0)[::-1]
+        valid = idx <= last[:, None]
+    else:
+        idx = np.where(mask, rows, -1)
+        idx = np.maximum.accumulate(idx, axis=0)
+        valid = idx >= first[:, None]
+    return np.where(valid, idx, rows)
+
+
+def _group_fill(df, cols, offsets, backward, inplace):
+
+    cols = list(cols)
+    out = df if inplace else pd.DataFrame(index=df.index)
+    if cols and len(df):
+        idx = _fill_index(df[cols].notnull().values, offsets,
+                          backward=backward)
+        for j, col in enumerate(cols):
+            se = df[col]
+            out[col] = pd.Series(se.values[idx[:, j]], index=df.index,
+                                 dtype=se.dtype)
+    return out
+
+
+def group_ffill(df, cols, offsets=None, user_id=None, inplace=False):
+    '''
+    Forward fills the null values of several columns per user in a single
+    vectorised pass over a panel with contiguous user blocks.
+    Returns a dataframe with the filled cols. If inplace, the columns of df
+    are overwritten (no copy of df) and df is returned.
+    '''
+
+    offsets = _get_offsets(df, offsets=offsets, user_id=user_id)
+    return _group_fill(df, cols, offsets, False, inplace)
+
+
+def group_bfill(df, cols, offsets=None, user_id=None, inplace=False):
+    '''
+    Backward fills the null values of several columns per user in a single
+    vectorised pass (see group_ffill).
+    '''
+
+    offsets = _get_offsets(df, offsets=offsets, user_id=user_id)
+    return _group_fill(df, cols, offsets, True, inplace)
+
+
+def group_lags(df, cols, lags=(1,), offsets=None, user_id=None,
+               fill_value=np.nan, names='{}_lag{}'):
+    '''
+    Returns a dataframe with several lags of several columns per user, shifted
+    within the user blocks of a panel with contiguous user blocks.
+    Parameters:
+     > lags: list of lags (negative values are leads).
+     > fill_value: value of the periods without a lagged value.
+     > names: format of the new column names (column, lag).
+    '''
+
+    offsets = _get_offsets(df, offsets=offsets, user_id=user_id)
+
+    rows = np.arange(len(df))
+    first, last = _row_bounds(offsets)
+    out = pd.DataFrame(index=df.index)
+    for lag in lags:
+        src = rows - lag
+        valid = (src >= first) & (src <= last)
+        src = np.where(valid, src, rows)
+        for col in cols:
+            se = pd.Series(df[col].values[src], index=df.index,
+                           dtype=df[col].dtype)
+            out[names.format(col, lag)] = se.where(valid, fill_value)
+    return out
+
+
+def group_shift(df, col, periods=1, offsets=None, user_id=None,
+                fill_value=np.nan):
+    '''
+    Returns the column shifted per user (equivalent to
+    df.groupby(user_id)[col].shift(periods) on contiguous user blocks).
+    '''
+
+    return group_lags(df, [col], lags=[periods], offsets=offsets,
+                      user_id=user_id, fill_value=fill_value,
+                      names='{}').iloc[:, 0]
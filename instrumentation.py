@@ -0,0 +1,204 @@
+import functools
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+_STATE = {
+    'enabled': False,
+    'callbacks': [],
+    'tracemalloc': False,
+    # peak traced memory of the inner stages of every open stage
+    'peaks': []
+}
+
+# the peak of every stage needs tracemalloc.reset_peak (Python 3.9+)
+_RESET_PEAK = hasattr(tracemalloc, 'reset_peak')
+
+
+def peak_rss_mb():
+    '''
+    Returns the peak resident set size of the current process in MB (None
+    where the resource module is not available, i.e. on Windows).
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux and BSD report kilobytes
+    if sys.platform == 'darwin':
+        return peak / 2 ** 20
+    return peak / 2 ** 10
+
+
+def enable(callback=None, log_path=None, trace_memory=False):
+    '''
+    Enables the instrumentation of the pipeline stages. Every stage record
+    (a dict, see stage) is passed to the callbacks.
+    Parameters:
+     > callback: function called with each record. Ex: records.append
+     > log_path: if given, records are appended to this file as JSON lines.
+     > trace_memory: if True, the traced allocation of every stage and its
+       peak (Python 3.9+) are recorded with tracemalloc (slower).
+    Ex: records = []; enable(records.append)
+    '''
+
+    if callback is not None:
+        _STATE['callbacks'].append(callback)
+    if log_path is not None:
+        _STATE['callbacks'].append(json_log(log_path))
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _STATE['tracemalloc'] = trace_memory
+    _STATE['enabled'] = True
+
+
+def disable():
+    'Disables the instrumentation and removes the callbacks.'
+
+    if _STATE['tracemalloc'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _STATE.update({'enabled': False, 'callbacks': [], 'tracemalloc': False,
+                   'peaks': []})
+
+
+def is_enabled():
+    return _STATE['enabled']
+
+
+def json_log(path):
+    'Returns a callback that appends each record to path as a JSON line.'
+
+    def callback(record):
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+    return callback
+
+
+def print_record(record):
+    'Callback that prints a one-line summary of each record.'
+
+    line = '[{}] {:.3f}s wall | {:.3f}s CPU | rows {} -> {}'.format(
+        record['stage'], record['wall_s'], record['cpu_s'],
+        record.get('rows_in'), record.get('rows_out'))
+    if record['peak_rss_delta_mb'] is not None:
+        line += ' | peak RSS +{:.1f} MB'.format(record['peak_rss_delta_mb'])
+    print(line)
+
+
+def _n_rows(obj):
+    'Returns the number of rows of a dataframe or array (None otherwise).'
+
+    if isinstance(obj, tuple) and obj:
+        obj = obj[0]
+    if hasattr(obj, 'shape') and len(getattr(obj, 'shape', ())):
+        return int(obj.shape[0])
+    return None
+
+
+def _first_rows(*args, **kwargs):
+    return _n_rows(args[0]) if args else None
+
+
+class _NullStage(object):
+    'No-op stage of the disabled instrumentation.'
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+@contextmanager
+def _stage(name, rows_in=None, **info):
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+    record.update(info)
+    rss0 = peak_rss_mb()
+    trace = _STATE['tracemalloc'] and tracemalloc.is_tracing()
+    if trace:
+        mem0, peak0 = tracemalloc.get_traced_memory()
+        # the peak of the enclosing stage so far is kept before resetting it
+        if _STATE['peaks']:
+            _STATE['peaks'][-1] = max(_STATE['peaks'][-1], peak0)
+        _STATE['peaks'].append(0)
+        if _RESET_PEAK:
+            tracemalloc.reset_peak()
+    t0, c0 = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = time.perf_counter() - t0
+        record['cpu_s'] = time.process_time() - c0
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['peak_rss_delta_mb'] = None if rss0 is None \
+            else record['peak_rss_mb'] - rss0
+        if trace:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, _STATE['peaks'].pop())
+            if _STATE['peaks']:
+                _STATE['peaks'][-1] = max(_STATE['peaks'][-1], peak)
+            record['alloc_delta_mb'] = (current - mem0) / 2 ** 20
+            # without reset_peak, peak is the peak of the whole process
+            record['alloc_peak_mb'] = (peak - mem0) / 2 ** 20 \
+                if _RESET_PEAK else None
+        for callback in _STATE['callbacks']:
+            callback(record)
+
+
+def stage(name, rows_in=None, **info):
+    '''
+    Context manager that records a pipeline stage when the instrumentation
+    is enabled (a no-op otherwise). It yields the record, a dict with:
+     > stage, rows_in, rows_out (to be set in the block) and info.
+     > wall_s, cpu_s: wall and CPU time.
+     > peak_rss_mb, peak_rss_delta_mb: peak RSS and its growth in the stage
+       (None on Windows).
+     > alloc_delta_mb, alloc_peak_mb: traced allocation and its peak in the
+       stage (if trace_memory). The peak is None before Python 3.9, where
+       tracemalloc cannot reset it.
+    Ex:
+        with stage('pivot', rows_in=len(events)) as record:
+            df = pivot(events)
+            record['rows_out'] = len(df)
+    '''
+
+    if not _STATE['enabled']:
+        return _NULL_STAGE
+    return _stage(name, rows_in=rows_in, **info)
+
+
+def instrument(name=None, rows_in=_first_rows, rows_out=_n_rows):
+    '''
+    Decorator that records every call of a function as a stage (see stage).
+    Parameters:
+     > name: stage name. By default, the function name.
+     > rows_in: function of the call arguments returning the input rows. By
+       default, the rows of the first argument.
+     > rows_out: function of the output returning the output rows.
+    When the instrumentation is disabled, the cost is a single check.
+    '''
+
+    def decorator(fn):
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _STATE['enabled']:
+                return fn(*args, **kwargs)
+            with _stage(stage_name,
+                        rows_in=rows_in(*args, **kwargs)) as record:
+                out = fn(*args, **kwargs)
+                record['rows_out'] = rows_out(out)
+            return out
+        return wrapper
+    return decorator
@@ -1,65 +1,393 @@
+import inspect
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from sklearn.externals import joblib
-from TFM.settings import get_right_ts_name, get_target_name, get_user_id_name, get_code_name
+from TFM.instrumentation import instrument, peak_rss_mb
+from TFM.settings import apply_dtype_policy, get_dtype_policy, get_right_ts_name, get_target_name, get_user_id_name, get_code_name
 
 
+_FILE_FORMATS = {
+    'pkl': '.pkl',
+    'parquet': '.parquet',
+    'feather': '.feather'
+}
+
+
+def _read_feather(path, columns=None):
+    'Reads a Feather file. pandas < 0.24 cannot read only some columns.'
+
+    if 'columns' in inspect.signature(pd.read_feather).parameters:
+        return pd.read_feather(path, columns=columns)
+    temp = pd.read_feather(path)
+    return temp[columns] if columns else temp
+
+
+def _read_shard(path, cols=None, target=None, user_id=None, sample_ids=None,
+                dtypes=None, hash_sample=None):
+    '''
+    Reads a single shard keeping only the chosen columns and the user-periods
+    with a non-null target. Columnar formats only read the chosen columns.
+    If sample_ids is given, only the rows of those users are kept.
+    If hash_sample (random_s, sample_s, sample_p) is given, only the rows of
+    the users whose salted hash is under the sample_p threshold and among
+    the sample_s smallest of the shard are kept (see _hash_sample_ids).
+    If dtypes is given, the shard is downcast to the dtype policy.
+    '''
+
+    if path.endswith('.parquet'):
+        temp = pd.read_parquet(path, columns=cols)
+    elif path.endswith('.feather'):
+        temp = _read_feather(path, columns=cols)
+    else:
+        temp = joblib.load(path)
+        if cols:
+            temp = temp[cols]
+
+    if target is not None:
+        temp = temp.loc[temp[target].notnull()]
+
+    if sample_ids is not None:
+        temp = temp.loc[temp[user_id].isin(sample_ids)]
+
+    if hash_sample is not None:
+        uids = _hash_sample_ids(pd.unique(temp[user_id].values), *hash_sample)
+        temp = temp.loc[temp[user_id].isin(uids)]
+
+    if dtypes is not None:
+        temp = apply_dtype_policy(temp, dtypes=dtypes, exclude=[user_id])
+
+    return temp
+
+
+def _hash_ids(ids, random_s=None):
+    '''
+    Returns a deterministic uint64 hash of the user ids salted with random_s,
+    so the same users are chosen regardless of the shard they are read from.
+    '''
+
+    seed = 0 if random_s is None else int(random_s)
+    h = pd.util.hash_array(np.asarray(ids))
+    return pd.util.hash_array(h ^ np.uint64(seed % 2 ** 64))
+
+
+def _hash_sample_ids(uids, random_s=None, sample_s=None, sample_p=None):
+    '''
+    Returns the unique user ids whose salted hash is under the sample_p
+    fraction of the hash range (if sample_p) and among the sample_s
+    smallest (if sample_s).
+    Since the global sample_s smallest hashes are among the sample_s
+    smallest of every shard, shards can be filtered one at a time before
+    the final selection.
+    '''
+
+    h = _hash_ids(uids, random_s=random_s)
+    if sample_p is not None:
+        keep = h <= np.uint64(min(int(sample_p * 2 ** 64), 2 ** 64 - 1))
+        uids, h = uids[keep], h[keep]
+    if sample_s and sample_s < len(uids):
+        uids = uids[np.argpartition(h, sample_s)[:sample_s]]
+    return uids
+
+
+def _sample_user_ids(paths, sample_s, random_s=None, user_id=None,
+                     target=None, sample_p=None, n_jobs=1, backend='thread'):
+    '''
+    First pass of the sampled load of columnar shards: reads only the user
+    id and target columns and picks the sample_s users with the smallest
+    salted hash.
+    '''
+
+    cols = [user_id, target]
+    shards = _read_shards(paths, cols=cols, target=target, user_id=user_id,
+                          hash_sample=(random_s, sample_s, sample_p),
+                          n_jobs=n_jobs, backend=backend)
+    uids = pd.unique(np.concatenate(
+        [pd.unique(temp[user_id].values) for temp in shards]))
+    del shards
+
+    return _hash_sample_ids(uids, random_s=random_s, sample_s=sample_s)
+
+
+def _is_sorted(df, keys):
+    'Checks whether a dataframe is lexicographically sorted by two keys.'
+
+    if len(df) < 2:
+        return True
+    k0 = df[keys[0]].values
+    k1 = df[keys[1]].values
+    eq = k0[1:] == k0[:-1]
+    return bool(np.all((k0[1:] > k0[:-1]) | (eq & (k1[1:] >= k1[:-1]))))
+
+
+def _merge_sorted_shards(df_list, keys):
+    '''
+    Combines shards already sorted by keys without a full re-sort.
+    Both keys are mapped to their rank among the unique values, and a stable
+    (run-aware) sort over the combined rank merges the k pre-sorted runs.
+    '''
+
+    df = pd.concat(df_list)
+    if len(df_list) < 2 or _is_sorted(df, keys):
+        return df
+
+    k0 = df[keys[0]].values
+    k1 = df[keys[1]].values
+    u0 = pd.unique(k0)
+    u0.sort()
+    u1 = pd.unique(k1)
+    u1.sort()
+    rank = np.searchsorted(u0, k0).astype(np.int64) * len(u1)
+    rank += np.searchsorted(u1, k1)
+    return df.take(np.argsort(rank, kind='mergesort'))
+
+
+def _list_shards(input_path, pref=None, file_format='pkl'):
+
+    if file_format not in _FILE_FORMATS:
+        msg = "\nUnknown file format '{}'.".format(file_format)
+        msg += "\nChoose one of: {}.".format(', '.join(sorted(_FILE_FORMATS)))
+        raise ValueError(msg)
+
+    ext = _FILE_FORMATS[file_format]
+    file_list = sorted(os.listdir(input_path))
+    return [file for file in file_list
+            if ((pref is None) or file.startswith(pref)) and file.endswith(ext)]
+
+
+def _read_shards(paths, cols=None, target=None, user_id=None, sample_ids=None,
+                 dtypes=None, hash_sample=None, n_jobs=1, backend='thread'):
+    'Reads shards in order, optionally in parallel.'
+
+    if n_jobs == 1 or len(paths) < 2:
+        return (_read_shard(path, cols, target, user_id, sample_ids, dtypes,
+                            hash_sample)
+                for path in paths)
+
+    if backend == 'process':
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+    else:
+        executor = ThreadPoolExecutor(max_workers=n_jobs)
+    n = len(paths)
+    with executor:
+        return list(executor.map(_read_shard, paths, [cols] * n,
+                                 [target] * n, [user_id] * n,
+                                 [sample_ids] * n, [dtypes] * n,
+                                 [hash_sample] * n))
+
+
+@instrument()
 def load_data(input_path, pref=None, right_ts=None, user_id=None, target=None,
-    cols=None, sample_s=None, random_s=None, verbose=True):
+    cols=None, sample_s=None, random_s=None, file_format='pkl', n_jobs=1,
+    backend='thread', dtypes=None, sample_p=None, verbose=True):
     '''
-    Loads and concatenates dataframes stored as pickles.
+    Loads and concatenates dataframes stored as pickles or in a columnar
+    format (Parquet / Feather).
     Parameters:
      > cols: columns to load keep.
-     > random_s: size of sample data.
+     > sample_s: number of users to sample.
+     > sample_p: fraction of users to sample (about sample_p of the users,
+       chosen by hash without counting them first).
+     > random_s: seed used to hash the user ids when sampling.
+     > file_format: 'pkl', 'parquet' or 'feather'. Columnar formats only read
+       the chosen cols from disk.
+     > n_jobs: number of shards read in parallel.
+     > backend: 'thread' or 'process' pool used when n_jobs > 1.
+     > dtypes: dict of dtype overrides ('float', 'int'). By default, the
+       policy set with set_dtype_policy. Each shard is downcast when read.
+    Shards already sorted by user and time-stamp are merged instead of being
+    re-sorted.
+    Sampled users are picked deterministically by hashing their ids with
+    random_s, so the same users are chosen with any format:
+     > sample_p: users are filtered by hash while each shard is read.
+     > sample_s, columnar formats: a first pass reads only the user id and
+       target columns to pick the users, and a second pass loads only the
+       rows of those users.
+     > sample_s, pickles: pickles cannot be read by column, so a single pass
+       keeps the sample_s smallest hashes of each shard and the final
+       sample is chosen among them.
     '''
-    
+
     right_ts = get_right_ts_name(right_ts=right_ts)
     target = get_target_name(target=target)
     user_id = get_user_id_name(user_id=user_id)
+    keys = [user_id, right_ts]
 
     if verbose:
         print('Loading data...')
-    file_list = sorted(os.listdir(input_path))
+    file_list = _list_shards(input_path, pref=pref, file_format=file_format)
+    paths = [os.path.join(input_path, file) for file in file_list]
     df_list = []
 
-    for file in file_list:
-        c1 = (file.startswith(pref)) or (pref is None)
-        if c1 and file.endswith('.pkl'):
-            temp = joblib.load(input_path + file)
-            if cols:
-                df_list.append(temp[cols].copy())
-            else:
-                df_list.append(temp.copy())
-            if verbose:
-                print('> File "{}" loaded.'.format(file))
-    del temp
-    df = pd.concat(df_list).sort_values([user_id, right_ts])
-    
-    if verbose:
-        print()
-        print('> Removing user-periods with null target...')
-    df = df.loc[df[target].notnull()]
-    
-    if sample_s:
+    sample_ids, hash_sample = None, None
+    if sample_s and file_format != 'pkl':
         if verbose:
             print('> Selecting sample data...')
-            print()
-        sample_ids = df[user_id].drop_duplicates() \
-            .sample(sample_s, random_state=random_s)
-        df = df.loc[df[user_id].isin(sample_ids)]
+        sample_ids = _sample_user_ids(paths, sample_s, random_s=random_s,
+                                      user_id=user_id, target=target,
+                                      sample_p=sample_p, n_jobs=n_jobs,
+                                      backend=backend)
+    elif sample_s or sample_p is not None:
+        hash_sample = (random_s, sample_s, sample_p)
+
+    # null targets and non-sampled users are removed per shard
+    shards = _read_shards(paths, cols=cols, target=target, user_id=user_id,
+                          sample_ids=sample_ids,
+                          dtypes=get_dtype_policy(dtypes),
+                          hash_sample=hash_sample, n_jobs=n_jobs,
+                          backend=backend)
+    for file, temp in zip(file_list, shards):
+        df_list.append(temp)
+        if verbose:
+            print('> File "{}" loaded.'.format(file))
+    del shards
+
+    if hash_sample is not None and sample_s and len(df_list) > 1:
+        uids = pd.unique(np.concatenate(
+            [pd.unique(temp[user_id].values) for temp in df_list]))
+        uids = _hash_sample_ids(uids, random_s=random_s, sample_s=sample_s)
+        df_list = [temp.loc[temp[user_id].isin(uids)] for temp in df_list]
+
+    if all(_is_sorted(temp, keys) for temp in df_list):
+        df = _merge_sorted_shards(df_list, keys)
+    else:
+        df = pd.concat(df_list).sort_values(keys)
+    del df_list
 
     if verbose:
+        print()
         print('> Unique users ({}): {}'.format(
             user_id, df[user_id].unique().size))
         aux = df[right_ts].dt.date.unique()
         print('> Periods: {} ({} - {})'.format(
             aux.size, aux.min(), aux.max()))
         print('> User-periods: {}'.format(len(df)))
-    
+        if peak_rss_mb() is not None:
+            print('> Peak memory: {:.1f} MB'.format(peak_rss_mb()))
+
     return df
 
 
-def getting_events(events_type, c, user_id=None, code=None):
+def convert_shards(input_path, output_path, pref=None, file_format='parquet',
+                   right_ts=None, user_id=None, verbose=True):
+    '''
+    Rewrites the pickled shards in a columnar format, sorted by user and
+    time-stamp, so that load_data can read only the needed columns and merge
+    the shards without re-sorting them.
+    '''
+
+    right_ts = get_right_ts_name(right_ts=right_ts)
+    user_id = get_user_id_name(user_id=user_id)
+
+    ext = _FILE_FORMATS[file_format]
+    for file in _list_shards(input_path, pref=pref, file_format='pkl'):
+        temp = joblib.load(os.path.join(input_path, file)) \
+            .sort_values([user_id, right_ts]).reset_index(drop=True)
+        out = os.path.join(output_path, file[:-len('.pkl')] + ext)
+        if file_format == 'parquet':
+            temp.to_parquet(out)
+        else:
+            temp.to_feather(out)
+        if verbose:
+            print('> File "{}" written.'.format(out))
+
+
+class CodeDictionary(object):
+    '''
+    Dictionary of event codes with stable int32 ids and precomputed per-code
+    flags. Codes are converted to a Categorical once, so filters on them are
+    integer lookups over the categories instead of string operations on every
+    event. New codes are appended, so ids do not change across chunks and the
+    dictionary can be saved and reused across runs.
+    Flags (code prefixes):
+     > cancer: 'd_C'
+     > melanoma: 'd_C44'
+    '''
+
+    PREFIXES = {
+        'cancer': 'd_C',
+        'melanoma': 'd_C44'
+    }
+
+    def __init__(self, codes=()):
+        self.codes = []
+        self.flags = {f: np.zeros(0, dtype=bool) for f in self.PREFIXES}
+        self._ids = {}
+        self.update(codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def update(self, codes):
+        'Adds the unseen codes to the dictionary.'
+
+        new = [c for c in pd.unique(pd.Series(codes).dropna().values)
+               if c not in self._ids]
+        if not new:
+            return self
+        self._ids.update(zip(new, range(len(self.codes),
+                                        len(self.codes) + len(new))))
+        self.codes.extend(new)
+        se = pd.Series(new, dtype=object).astype(str)
+        for f, pref in self.PREFIXES.items():
+            self.flags[f] = np.concatenate([
+                self.flags[f], se.str.startswith(pref).values])
+        return self
+
+    def encode(self, codes):
+        '''
+        Returns the codes as a Categorical with the dictionary categories
+        (unseen codes are added first).
+        '''
+
+        if isinstance(codes, pd.Series) and hasattr(codes, 'cat') \
+                and list(codes.cat.categories) == self.codes:
+            return codes.values
+        self.update(codes)
+        return pd.Categorical(codes, categories=self.codes)
+
+    def ids(self, codes):
+        'Returns the int32 ids of the codes (-1 for nulls).'
+        return self.encode(codes).codes.astype(np.int32)
+
+    def mask(self, ids, flag):
+        'Returns the boolean mask of the code ids with the chosen flag.'
+        # nulls (id -1) take the appended False
+        return np.append(self.flags[flag], False)[ids]
+
+    def save(self, path):
+        joblib.dump({'codes': self.codes, 'flags': self.flags}, path)
+
+    @classmethod
+    def load(cls, path):
+        d = joblib.load(path)
+        code_dict = cls()
+        code_dict.codes = list(d['codes'])
+        code_dict.flags = d['flags']
+        code_dict._ids = dict(zip(code_dict.codes, range(len(code_dict.codes))))
+        return code_dict
+
+
+def code_mask(codes, pref):
+    '''
+    Returns the mask of the codes starting with pref. String operations run
+    over the categories only if codes is categorical.
+    '''
+
+    if hasattr(codes, 'cat'):
+        flags = codes.cat.categories.astype(str).str.startswith(pref)
+        return np.append(flags, False)[codes.cat.codes.values]
+    return (codes.str[:len(pref)] == pref).values
+
+
+@instrument()
+def getting_events(events_type, c, user_id=None, code=None, code_dict=None):
+    '''
+    Returns the events of the chosen users, excluding cancers other than
+    melanoma. If a CodeDictionary is given (or the code column is
+    categorical), the exclusion is an integer lookup.
+    '''
 
     user_id = get_user_id_name(user_id=user_id)
     code = get_code_name(code=code)
@@ -67,9 +395,14 @@ def getting_events(events_type, c, user_id=None, code=None):
     m = events_type[user_id].isin(c)
     events_chosen = events_type.loc[m]
 
-    cancer_mask = events_chosen[code].str[:3] == 'd_C'
-    melanoma = events_chosen[code].str[:5] == 'd_C44'
-    
+    if code_dict is not None:
+        ids = code_dict.ids(events_chosen[code])
+        cancer_mask = code_dict.mask(ids, 'cancer')
+        melanoma = code_dict.mask(ids, 'melanoma')
+    else:
+        cancer_mask = code_mask(events_chosen[code], 'd_C')
+        melanoma = code_mask(events_chosen[code], 'd_C44')
+
     events_chosen = events_chosen.loc[~cancer_mask|melanoma]
 
     events_chosen.reset_index(drop=True, inplace=True)
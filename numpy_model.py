@@ -0,0 +1,307 @@
+import argparse
+import sys
+import time
+import numpy as np
+
+
+_LSTM_LAYERS = ('lstm_layer_1', 'lstm_layer_2')
+_DENSE_LAYERS = ('dense_layer_1', 'dense_layer_2', 'dense_layer_3')
+_FEAT_KEYS = ('con_feats', 'lstm_feats', 'cat_feats')
+
+
+def _check_feat_dict(feat_dict):
+    'Raises a ValueError if feat_dict lacks the feature lists of the inputs.'
+
+    missing = [k for k in _FEAT_KEYS if k not in (feat_dict or {})]
+    if missing:
+        msg = "\nThe feat_dict of the model lacks: {}.".format(
+            ', '.join(missing))
+        msg += "\nThey are needed to build the inputs of score_last: export"
+        msg += " the model with the feat_dict of transform_features (see"
+        msg += " NumpyModel.from_keras)."
+        raise ValueError(msg)
+
+
+def _sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def _hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0., 1.)
+
+
+_ACTIVATIONS = {
+    'sigmoid': _sigmoid,
+    'hard_sigmoid': _hard_sigmoid,
+    'tanh': np.tanh,
+    'linear': lambda x: x
+}
+
+
+class NumpyModel(object):
+    '''
+    NumPy forward pass of the network of generate_model (categorical
+    embeddings, two LSTM layers and three dense layers with LeakyReLU), so
+    scoring jobs do not need to import Keras / TensorFlow.
+    Weights are exported once from the trained Keras model (from_keras) and
+    saved in a .npz file (save / load).
+    Parameters:
+     > embeddings: list of embedding matrices of the categorical features.
+     > lstms: list of (kernel, recurrent_kernel, bias) of the LSTM layers,
+       with the Keras gate order (i, f, c, o).
+     > dense: list of (kernel, bias) of the dense layers.
+     > alphas: LeakyReLU slopes after the first dense layers.
+     > activation, recurrent_activation: LSTM activations.
+     > static: if True, the profile inputs are fed once per user (see
+       generate_model).
+     > feat_dict: feat_dict of transform_features. Its feature lists
+       (con_feats, lstm_feats and cat_feats) are saved with the weights and
+       required by save, load and score_last.
+    '''
+
+    def __init__(self, embeddings, lstms, dense, alphas=(0.3, 0.3),
+                 activation='tanh', recurrent_activation='hard_sigmoid',
+                 static=False, feat_dict=None):
+        self.embeddings = [np.asarray(e, dtype=np.float32) for e in embeddings]
+        self.lstms = [tuple(np.asarray(w, dtype=np.float32) for w in l)
+                      for l in lstms]
+        self.dense = [tuple(np.asarray(w, dtype=np.float32) for w in d)
+                      for d in dense]
+        self.alphas = tuple(alphas)
+        self.activation = activation
+        self.recurrent_activation = recurrent_activation
+        self.static = static
+        self.feat_dict = feat_dict or {}
+
+    @classmethod
+    def from_keras(cls, model, feat_dict):
+        '''
+        Exports the weights of a trained generate_model model, with the
+        feat_dict of its inputs.
+        '''
+
+        _check_feat_dict(feat_dict)
+        embeddings = []
+        while True:
+            try:
+                layer = model.get_layer('cat_{}_embedding'.format(
+                    len(embeddings)))
+            except ValueError:
+                break
+            embeddings.append(layer.get_weights()[0])
+
+        lstms = [model.get_layer(name).get_weights() for name in _LSTM_LAYERS]
+        lstm_config = model.get_layer(_LSTM_LAYERS[0]).get_config()
+        dense = [model.get_layer(name).get_weights() for name in _DENSE_LAYERS]
+        # Keras 3 renames alpha and batch_input_shape
+        alphas = [float(layer.get_config().get(
+            'alpha', layer.get_config().get('negative_slope')))
+            for layer in model.layers if type(layer).__name__ == 'LeakyReLU']
+        config = model.get_layer('cont_input').get_config()
+        shape = config.get('batch_input_shape', config.get('batch_shape'))
+
+        return cls(embeddings, lstms, dense, alphas=alphas,
+                   activation=lstm_config['activation'],
+                   recurrent_activation=lstm_config['recurrent_activation'],
+                   static=len(shape) == 2, feat_dict=feat_dict)
+
+    def save(self, path):
+        _check_feat_dict(self.feat_dict)
+        arrays = {'emb_{}'.format(i): e for i, e in enumerate(self.embeddings)}
+        for i, l in enumerate(self.lstms):
+            for j, w in enumerate(l):
+                arrays['lstm_{}_{}'.format(i, j)] = w
+        for i, d in enumerate(self.dense):
+            for j, w in enumerate(d):
+                arrays['dense_{}_{}'.format(i, j)] = w
+        for key in _FEAT_KEYS:
+            arrays[key] = np.array(self.feat_dict[key], dtype=str)
+        np.savez(path, alphas=np.array(self.alphas),
+                 activations=np.array([self.activation,
+                                       self.recurrent_activation]),
+                 static=np.array(self.static), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        f = np.load(path)
+        _check_feat_dict(f.files)
+        n_emb = len([k for k in f.files if k.startswith('emb_')])
+        return cls([f['emb_{}'.format(i)] for i in range(n_emb)],
+                   [[f['lstm_{}_{}'.format(i, j)] for j in range(3)]
+                    for i in range(len(_LSTM_LAYERS))],
+                   [[f['dense_{}_{}'.format(i, j)] for j in range(2)]
+                    for i in range(len(_DENSE_LAYERS))],
+                   alphas=f['alphas'].tolist(),
+                   activation=str(f['activations'][0]),
+                   recurrent_activation=str(f['activations'][1]),
+                   static=bool(f['static']),
+                   feat_dict={k: f[k].tolist() for k in _FEAT_KEYS})
+
+    @property
+    def state_dims(self):
+        return tuple(n for l in self.lstms for n in (l[1].shape[0],) * 2)
+
+    def _lstm(self, x, kernel, recurrent, bias, h=None, c=None):
+        act = _ACTIVATIONS[self.activation]
+        rec_act = _ACTIVATIONS[self.recurrent_activation]
+        n, T, _ = x.shape
+        u = recurrent.shape[0]
+        if h is None:
+            h = np.zeros((n, u), dtype=np.float32)
+            c = np.zeros((n, u), dtype=np.float32)
+
+        # input projection of every time-step in one matrix multiply
+        z = (x.reshape(n * T, -1) @ kernel + bias).reshape(n, T, 4 * u)
+        out = np.empty((n, T, u), dtype=np.float32)
+        for t in range(T):
+            g = z[:, t] + h @ recurrent
+            i = rec_act(g[:, :u])
+            f = rec_act(g[:, u:2 * u])
+            c = f * c + i * act(g[:, 2 * u:3 * u])
+            h = rec_act(g[:, 3 * u:]) * act(c)
+            out[:, t] = h
+        return out, h, c
+
+    def _forward(self, X, states=None, last_only=False):
+        n_cat = len(self.embeddings)
+        X_cat, X_con, X_lstm = X[:n_cat], X[n_cat], X[n_cat + 1]
+        X_lstm = np.asarray(X_lstm, dtype=np.float32)
+        n, T = X_lstm.shape[:2]
+
+        seq = X_lstm
+        new_states = []
+        for k, (kernel, recurrent, bias) in enumerate(self.lstms):
+            h, c = (None, None) if states is None else states[2 * k:2 * k + 2]
+            seq, h, c = self._lstm(seq, kernel, recurrent, bias, h, c)
+            new_states += [h, c]
+
+        X_con = np.asarray(X_con, dtype=np.float32)
+        if last_only:
+            # the dense layers only run on the last time-step
+            X_cat = X_cat if self.static else [x[:, -1:] for x in X_cat]
+            X_con = X_con if self.static else X_con[:, -1:]
+            seq = seq[:, -1:]
+            T = 1
+        profile = [e[np.asarray(x).reshape(x.shape[:-1]).astype(np.int64)]
+                   for e, x in zip(self.embeddings, X_cat)]
+        profile.append(X_con)
+        if self.static:
+            profile = np.concatenate(profile, axis=-1)[:, None, :]
+            profile = np.broadcast_to(profile, (n, T, profile.shape[-1]))
+            x = np.concatenate([profile, seq], axis=-1)
+        else:
+            x = np.concatenate(profile + [seq], axis=-1)
+
+        x = x.reshape(n * T, -1)
+        for k, (kernel, bias) in enumerate(self.dense):
+            x = x @ kernel + bias
+            if k < len(self.alphas):
+                x = np.where(x > 0, x, self.alphas[k] * x)
+        return x.reshape(n, T, -1), new_states
+
+    def predict(self, X, batch_size=4096, states=None, return_states=False,
+                last_only=False):
+        '''
+        Returns the predictions (sequences, steps, 1) for the list of inputs
+        of the Keras model (categorical inputs, cont_input, lstm_input).
+        Parameters:
+         > states: initial LSTM states (h1, c1, h2, c2), as stored by
+           stateful_scoring.StateStore. By default, zeros.
+         > return_states: also returns the final LSTM states.
+         > last_only: only the last time-step is predicted (sequences, 1, 1).
+        '''
+
+        n = len(X[-1])
+        out, out_states = [], []
+        for start in range(0, n, batch_size):
+            rows = slice(start, start + batch_size)
+            batch_states = None if states is None \
+                else [s[rows] for s in states]
+            y, s = self._forward([x[rows] for x in X], batch_states,
+                                 last_only=last_only)
+            out.append(y)
+            out_states.append(s)
+        y = np.concatenate(out) if out else np.zeros((0, 0, 1), np.float32)
+        if return_states:
+            return y, [np.concatenate(s) for s in zip(*out_states)]
+        return y
+
+
+def compare_with_keras(model, numpy_model, X, batch_size=4096):
+    'Returns the maximum absolute difference of both models on X.'
+
+    y_keras = model.predict(X, batch_size=batch_size)
+    return float(np.abs(y_keras - numpy_model.predict(X, batch_size)).max())
+
+
+def score_last(numpy_model, df, user_id, batch_size=4096):
+    '''
+    Returns the score of the last period of every user of a transformed
+    panel whose rows are contiguous per user and sorted by time-stamp.
+    Users with the same sequence length are scored together.
+    '''
+
+    import pandas as pd
+
+    fd = numpy_model.feat_dict
+    users = df[user_id].values
+    first = np.concatenate([[True], users[1:] != users[:-1]])
+    starts = np.flatnonzero(first)
+    lengths = np.diff(np.append(starts, len(users)))
+
+    CAT = df[fd['cat_feats']].values
+    CON = df[fd['con_feats']].values
+    LSTM = df[fd['lstm_feats']].values
+    scores = np.empty(len(starts), dtype=np.float32)
+    for length in np.unique(lengths):
+        seqs = np.flatnonzero(lengths == length)
+        rows = (starts[seqs][:, None] + np.arange(length)).ravel()
+        n = len(seqs)
+        if numpy_model.static:
+            last = starts[seqs] + length - 1
+            X_cat = [CAT[last, i:i + 1] for i in range(CAT.shape[1])]
+            X_con = CON[last]
+        else:
+            cat = CAT[rows].reshape(n, length, -1)
+            X_cat = [cat[:, :, i:i + 1] for i in range(CAT.shape[1])]
+            X_con = CON[rows].reshape(n, length, -1)
+        X_lstm = LSTM[rows].reshape(n, length, -1)
+        y = numpy_model.predict(X_cat + [X_con, X_lstm],
+                                batch_size=batch_size, last_only=True)
+        scores[seqs] = y[:, -1, 0]
+    return pd.DataFrame({user_id: users[starts], 'score': scores})
+
+
+def main(argv=None):
+    '''
+    Scoring command line: scores the last period of every user of a
+    transformed panel (pickle or Parquet) with an exported model.
+    Ex: python -m TFM.numpy_model model.npz data.parquet scores.csv
+    '''
+
+    t0 = time.time()
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('model', help='.npz file saved by NumpyModel.save')
+    parser.add_argument('input', help='transformed panel (.pkl / .parquet)')
+    parser.add_argument('output', help='output .csv file')
+    parser.add_argument('--user-id', default='user_id')
+    parser.add_argument('--batch-size', type=int, default=4096)
+    args = parser.parse_args(argv)
+
+    import pandas as pd
+
+    numpy_model = NumpyModel.load(args.model)
+    if args.input.endswith('.parquet'):
+        df = pd.read_parquet(args.input)
+    else:
+        df = pd.read_pickle(args.input)
+    t1 = time.time()
+    result = score_last(numpy_model, df, args.user_id,
+                        batch_size=args.batch_size)
+    result.to_csv(args.output, index=False)
+    print('> Users scored: {} | Start-up and load: {:.2f}s | Scoring: {:.2f}s'
+          .format(len(result), t1 - t0, time.time() - t1))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
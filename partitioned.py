@@ -0,0 +1,247 @@
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from TFM.build_datasets import build_datasets, length_buckets, merge_datasets
+from TFM.feature_engineering import apply_trends, clip_continuous_f, fillna_cols, fit_sketches, merge_sketches, sketch_bounds, trend_bounds, trend_sums, trends_from_sums
+from TFM.feature_transformation import FeatureTransformer
+from TFM.load_data import _hash_ids, _list_shards, _read_shard, load_data
+from TFM.sequence_padding import presequence_padding
+from TFM.settings import get_dtype_policy, get_right_ts_name, get_target_name, get_user_id_name, set_dtype_policy
+
+
+def _part_path(work_path, stage, p):
+    return os.path.join(work_path, '{}_{}.pkl'.format(stage, p))
+
+
+def _split_shard(shard, work_path, n_partitions, user_id, target):
+    'Splits a shard (index, path) in files of hash-partitioned users.'
+
+    s, path = shard
+    temp = _read_shard(path, target=target)
+    part = _hash_ids(temp[user_id].values) % np.uint64(n_partitions)
+    for p in range(n_partitions):
+        part_dir = os.path.join(work_path, 'part_{}'.format(p))
+        temp.loc[part == p].reset_index(drop=True) \
+            .to_pickle(os.path.join(part_dir, 'shard_{}.pkl'.format(s)))
+    return len(temp)
+
+
+def _load_partition(p, work_path, names, dtypes):
+    'Loads a partition and returns its periods and maximum sequence length.'
+
+    set_dtype_policy(**dtypes)
+    df = load_data(os.path.join(work_path, 'part_{}'.format(p)),
+                   verbose=False, **names)
+    shutil.rmtree(os.path.join(work_path, 'part_{}'.format(p)))
+    df.to_pickle(_part_path(work_path, 'prep', p))
+    max_len = df[names['user_id']].value_counts().max() if len(df) else 0
+    return df[names['right_ts']].unique(), max_len
+
+
+def _prepare_partition(p, work_path, names, dtypes, val, periods, max_len,
+                       fillna, trend_cols, sketch):
+    '''
+    Pads and fills a partition, and returns the non-zero values of the trend
+    columns or their sketches (to compute the global clip bounds).
+    '''
+
+    set_dtype_policy(**dtypes)
+    df = pd.read_pickle(_part_path(work_path, 'prep', p))
+    if val is not None:
+        df = presequence_padding(df, val, periods=periods, max_len=max_len,
+                                 verbose=False, **names)
+    if fillna:
+        df = fillna_cols(df, user_id=names['user_id'], inplace=True,
+                         verbose=False, **fillna)
+    df.to_pickle(_part_path(work_path, 'prep', p))
+    if sketch:
+        return fit_sketches(df, trend_cols)
+    return {col: df[col].values[df[col].values != 0] for col in trend_cols}
+
+
+def _partition_trend_sums(p, work_path, right_ts, trend_cols, bounds):
+    df = pd.read_pickle(_part_path(work_path, 'prep', p))
+    return trend_sums(df, trend_cols, bounds=bounds, right_ts=right_ts)
+
+
+def _partition_stats(p, work_path, right_ts, trend, ft, sketch, lstm_specs):
+    '''
+    Adds the global trends to a partition and returns its scaler stats and
+    the sketches of the LSTM columns with clip specs.
+    '''
+
+    df = pd.read_pickle(_part_path(work_path, 'prep', p))
+    if trend is not None:
+        apply_trends(df, trend, right_ts=right_ts, inplace=True)
+        df.to_pickle(_part_path(work_path, 'prep', p))
+    return ft.partial_stats(df, sketch=sketch), fit_sketches(df, lstm_specs)
+
+
+def _transform_partition(p, work_path, output_path, dtypes, ft):
+    set_dtype_policy(**dtypes)
+    df = ft.transform(pd.read_pickle(_part_path(work_path, 'prep', p)))
+    path = os.path.join(output_path, 'part_{}.pkl'.format(p))
+    df.to_pickle(path)
+    os.remove(_part_path(work_path, 'prep', p))
+    return path
+
+
+def run_partitioned(input_path, output_path, n_partitions, pref=None,
+                    file_format='pkl', val=None, fillna=None, trend_cols=None,
+                    con_cols=[], lstm_cols=[], cat_cols={}, strategy='median',
+                    sketch=True, n_jobs=None, right_ts=None, user_id=None,
+                    target=None, verbose=True):
+    '''
+    Runs the preprocessing chain (padding, filling, trend enrichment and
+    feature transformation) on hash-partitioned users in a process pool, so
+    only one partition per process has to fit in memory.
+    Global statistics are merged across partitions:
+     > trend_enrichment: clip bounds and per-period means.
+     > transform_features: fill values, scalers and classes.
+    Parameters:
+     > n_partitions: number of user partitions.
+     > val: sequence length multiple of presequence_padding (None: no
+       padding).
+     > fillna: dict of fillna_cols arguments (fillna_val, ffill_cols,
+       bfill_cols).
+     > trend_cols: dict of columns and clip specs (see fit_trends).
+     > con_cols, lstm_cols, cat_cols, strategy: see transform_features.
+       The values of lstm_cols can also be clip specs (dicts with q2cl, q2cu
+       and neg_val, see clip_continuous_f), whose bounds are computed with
+       sketches merged across partitions.
+     > sketch: if True, the clip bounds of trend_cols and the medians are
+       approximated with TDigest sketches merged across partitions. If
+       False, they are exact, but every non-zero value of each trend column
+       (and every value of each column, for strategy='median') is sent to
+       the main process and concatenated there: the memory of whole columns
+       is needed again.
+     > n_jobs: number of processes.
+    Returns the paths of the transformed partitions (one file per
+    partition, see build_partitioned_datasets), the feat_dict, the fitted
+    FeatureTransformer and the trend table.
+    '''
+
+    names = {
+        'right_ts': get_right_ts_name(right_ts=right_ts),
+        'user_id': get_user_id_name(user_id=user_id),
+        'target': get_target_name(target=target)
+    }
+    dtypes = get_dtype_policy()
+    trend_cols = trend_cols or {}
+    parts = range(n_partitions)
+    work_path = os.path.join(output_path, '_work')
+    # created before the shards are split in parallel
+    for p in parts:
+        part_dir = os.path.join(work_path, 'part_{}'.format(p))
+        if not os.path.exists(part_dir):
+            os.makedirs(part_dir)
+
+    file_list = _list_shards(input_path, pref=pref, file_format=file_format)
+    paths = [os.path.join(input_path, file) for file in file_list]
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        def run(fn, items, *args):
+            # the same args are passed with every item
+            n = len(items)
+            return list(executor.map(fn, items, *[[a] * n for a in args]))
+
+        if verbose:
+            if not sketch:
+                print('> WARNING: sketch=False gathers whole columns in the '
+                      'main process.')
+            print('> Partitioning {} shards in {} partitions...'.format(
+                len(paths), n_partitions))
+        rows = run(_split_shard, list(enumerate(paths)), work_path,
+                   n_partitions, names['user_id'], names['target'])
+
+        if verbose:
+            print('> Loading partitions...')
+        loaded = run(_load_partition, parts, work_path, names, dtypes)
+        periods = np.unique(np.concatenate([l[0] for l in loaded]))
+        max_len = max(l[1] for l in loaded)
+
+        if verbose:
+            print('> Padding and filling partitions...')
+        values = run(_prepare_partition, parts, work_path, names, dtypes, val,
+                     periods, max_len, fillna, list(trend_cols), sketch)
+
+        trend = None
+        if trend_cols:
+            if verbose:
+                print('> Merging trends...')
+            if sketch:
+                bounds = trend_bounds(None, trend_cols,
+                                      sketches=merge_sketches(values))
+            else:
+                bounds = {}
+                for col, spec in trend_cols.items():
+                    if spec:
+                        se = pd.Series(np.concatenate([v[col]
+                                                       for v in values]))
+                        bounds[col] = clip_continuous_f(se, return_lu=True,
+                                                        **spec)
+            sums = run(_partition_trend_sums, parts, work_path,
+                       names['right_ts'], list(trend_cols), bounds)
+            sums = pd.concat(sums).groupby(level=0).sum()
+            trend = trends_from_sums(sums)
+        del values
+
+        if verbose:
+            print('> Merging feature statistics...')
+        lstm_specs = {}
+        if isinstance(lstm_cols, dict):
+            lstm_specs = {col: spec for col, spec in lstm_cols.items()
+                          if isinstance(spec, dict)}
+        ft = FeatureTransformer(con_cols=con_cols, lstm_cols=lstm_cols,
+                                cat_cols=cat_cols, strategy=strategy)
+        out = run(_partition_stats, parts, work_path, names['right_ts'],
+                  trend, ft, sketch, list(lstm_specs))
+        if lstm_specs:
+            sketches = merge_sketches([o[1] for o in out])
+            ft.lstm_cols = dict(lstm_cols, **sketch_bounds(sketches,
+                                                           lstm_specs))
+        ft.fit_stats(FeatureTransformer.merge_stats([o[0] for o in out]),
+                     verbose=False)
+
+        if verbose:
+            print('> Transforming partitions...')
+        out_paths = run(_transform_partition, parts, work_path, output_path,
+                        dtypes, ft)
+
+    shutil.rmtree(work_path)
+    if verbose:
+        print('> User-periods: {} read, in {} partitions'.format(
+            sum(rows), n_partitions))
+    return out_paths, ft.feat_dict, ft, trend
+
+
+def build_partitioned_datasets(paths, feat_dict, train_p, p2p, user_id=None,
+                               target=None, n_buckets=None, bs=None,
+                               **kwargs):
+    '''
+    Returns the validation and test sets (see build_datasets) of the
+    partitions written by run_partitioned, built one partition at a time.
+    Buckets of the same sequence length are merged across partitions (see
+    merge_datasets), so batches are as full as in a single-frame run. With
+    n_buckets, the bucket lengths are chosen from the sequence lengths of
+    all the partitions, read in a first pass.
+    '''
+
+    user_id = get_user_id_name(user_id=user_id)
+
+    bounds = None
+    if n_buckets is not None:
+        lengths = [pd.read_pickle(path)[user_id].value_counts().values
+                   for path in paths]
+        bounds = length_buckets(np.concatenate(lengths), n_buckets, bs=bs,
+                                train_p=train_p)
+
+    data_tests = []
+    for path in paths:
+        _, test = build_datasets(pd.read_pickle(path), feat_dict, train_p,
+                                 p2p, user_id=user_id, target=target,
+                                 bounds=bounds, **kwargs)
+        data_tests.append(test)
+    return merge_datasets(data_tests, train_p, p2p)
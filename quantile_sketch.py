@@ -0,0 +1,130 @@
+import numpy as np
+
+
+class TDigest(object):
+    '''
+    Mergeable quantile sketch (merging t-digest) of a continuous feature.
+    Values are added chunk by chunk and sketches of different chunks or
+    partitions are merged, so quantiles never need all the values at once.
+    Centroids are kept small in the tails, where the relative error of the
+    clip quantiles (q2cl, q2cu) matters most.
+    Parameters:
+     > values: optional first chunk of values.
+     > delta: compression. The sketch keeps at most about delta / 2
+       centroids and its rank error is below 1 / delta around the median and
+       much lower in the tails.
+     > buffer_size: values are compressed when more than buffer_size
+       centroids are stored. By default, 10 * delta. Up to buffer_size values,
+       quantiles are exact.
+    Ex:
+        sketch = TDigest()
+        for chunk in chunks:
+            sketch.update(chunk['expense'])
+        l, u = sketch.quantile([.01, .99])
+    '''
+
+    def __init__(self, values=None, delta=1000, buffer_size=None):
+        self.delta = delta
+        self.buffer_size = buffer_size or 10 * delta
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+        if values is not None:
+            self.update(values)
+
+    @property
+    def n(self):
+        'Number of values added to the sketch.'
+        return self.weights.sum()
+
+    def __len__(self):
+        return len(self.means)
+
+    def update(self, values):
+        'Adds the non-null values of an array / series to the sketch.'
+
+        v = np.asarray(values, dtype=float).ravel()
+        v = v[~np.isnan(v)]
+        if not len(v):
+            return self
+        self.min = min(self.min, v.min())
+        self.max = max(self.max, v.max())
+        self._add(v, np.ones(len(v)))
+        return self
+
+    def merge(self, *others):
+        'Adds the centroids of other sketches to the sketch.'
+
+        for other in others:
+            if not len(other):
+                continue
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._add(other.means, other.weights)
+        # compressed centroids of different sketches overlap
+        if (self.weights > 1).any():
+            self.compress()
+        return self
+
+    @classmethod
+    def merge_all(cls, sketches):
+        'Returns a new sketch merging a list of sketches.'
+
+        sketches = list(sketches)
+        delta = max([s.delta for s in sketches] or [1000])
+        return cls(delta=delta).merge(*sketches)
+
+    def _add(self, means, weights):
+        self.means = np.concatenate([self.means, means])
+        self.weights = np.concatenate([self.weights, weights])
+        if len(self.means) > self.buffer_size:
+            self.compress()
+        else:
+            order = np.argsort(self.means)
+            self.means, self.weights = self.means[order], self.weights[order]
+
+    def compress(self):
+        '''
+        Merges adjacent centroids with the k1 scale function (arcsine): each
+        centroid spans at most one unit of delta / (2 pi) * asin(2q - 1).
+        '''
+
+        order = np.argsort(self.means)
+        means, weights = self.means[order], self.weights[order]
+        cum = np.cumsum(weights)
+        q_left = (cum - weights) / cum[-1]
+        # k goes from -delta / 4 to delta / 4: a centroid starts at every
+        # integer step of k, i.e. at the quantiles of the inverse of k
+        steps = np.arange(1, int(np.ceil(self.delta / 2.)))
+        q_steps = (np.sin(2 * np.pi * steps / self.delta - np.pi / 2) + 1) / 2
+        starts = np.unique(np.r_[0, np.searchsorted(q_left, q_steps)])
+        starts = starts[starts < len(means)]
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(weights * means, starts) / self.weights
+        return self
+
+    def quantile(self, q):
+        '''
+        Returns the quantile(s) q of the values, interpolated linearly
+        between the centroids as pandas does between values. Returns NaN if
+        the sketch is empty.
+        '''
+
+        scalar = np.ndim(q) == 0
+        q = np.atleast_1d(np.asarray(q, dtype=float))
+        if not len(self):
+            out = np.full(len(q), np.nan)
+        else:
+            w = self.weights
+            n = w.sum()
+            # rank of the centroid means, as the mean rank of their values
+            ranks = np.cumsum(w) - (w + 1) / 2.
+            x = np.r_[0., ranks, n - 1]
+            y = np.r_[self.min, self.means, self.max]
+            out = np.interp(q * (n - 1), x, y)
+        return out[0] if scalar else out
+
+    def __repr__(self):
+        return 'TDigest(n={:.0f}, centroids={}, delta={})'.format(
+            self.n, len(self), self.delta)
@@ -1,12 +1,20 @@
+import numpy as np
 import pandas as pd
-from TFM.settings import get_right_ts_name, get_target_name, get_user_id_name
+from TFM.instrumentation import instrument
+from TFM.settings import get_dtype_policy, get_right_ts_name, get_target_name, get_user_id_name
 
 
+@instrument()
 def presequence_padding(df0, val, right_ts=None, user_id=None, target=None,
-                        verbose=True):
+                        periods=None, max_len=None, verbose=True):
     '''
     Transforms data such that each sequence has a length equal to a multiple of
     a choosen value.
+    The padded (user_id, time-stamp) index is built for all the users in one
+    vectorised pass and merged once with the data.
+    Parameters:
+     > periods, max_len: time-stamps and maximum sequence length of the whole
+       data, when df0 is a partition of its users. By default, those of df0.
     '''
     
     right_ts = get_right_ts_name(right_ts=right_ts)
@@ -15,13 +23,13 @@ def presequence_padding(df0, val, right_ts=None, user_id=None, target=None,
     
     df = df0.copy()
 
-    unique_ts = sorted(df[right_ts].unique())
+    unique_ts = sorted(df[right_ts].unique() if periods is None else periods)
     d = dict(zip(unique_ts, range(len(unique_ts))))
     ts_list = sorted(list(d.keys()))
     df['time_i'] = df[right_ts].map(d)
     
     user_len = df[user_id].value_counts().to_frame(name='len0')
-    u = user_len['len0'].max()
+    u = user_len['len0'].max() if max_len is None else max_len
     user_len['len1'] = (val*(((user_len['len0'] - 1)//val) + 1)).clip_upper(u)
 
     if verbose:
@@ -33,24 +41,32 @@ def presequence_padding(df0, val, right_ts=None, user_id=None, target=None,
         print('> Final sequence lengths:   {}'.format(fs))
         print('> Creating "indexes" (user_id & time-stamp)...')
     
-    USER_TS = []
-    
-    for length in sorted(user_len['len1'].unique()):
-        uids = user_len.loc[user_len['len1'] == length].index
-        temp = df.loc[df[user_id].isin(uids)].copy()
-        
-        for uid in uids:
-            mti = temp.loc[temp[user_id] == uid, 'time_i'].max()
-            ts = ts_list[(mti - length + 1):(mti + 1)]
-            user_ts = pd.DataFrame({user_id: uid, right_ts: ts})
-            USER_TS.append(user_ts)
-    
+    # users ordered by padded length, keeping the value_counts order within
+    user_len = user_len.iloc[np.argsort(user_len['len1'].values,
+                                        kind='mergesort')]
+    length = user_len['len1'].values
+    mti = df.groupby(user_id)['time_i'].max().reindex(user_len.index).values
+
+    # slice ts_list[(mti - length + 1):(mti + 1)] of every user at once
+    n_ts = len(ts_list)
+    start = mti - length + 1
+    start = np.maximum(np.where(start < 0, start + n_ts, start), 0)
+    size = np.maximum(mti + 1 - start, 0)
+    offset = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+    ts_i = np.repeat(start, size) + offset
+
+    USER_TS = pd.DataFrame({
+        user_id: np.repeat(user_len.index.values, size),
+        right_ts: np.asarray(ts_list)[ts_i]
+    }, columns=[user_id, right_ts])
+
     if verbose:
         print('> Merging "indexes" with session data...')
-    df = pd.concat(USER_TS).merge(df, on=[right_ts, user_id], how='left')
-    
+    df = USER_TS.merge(df, on=[right_ts, user_id], how='left')
+
     df.drop(columns=['time_i'], inplace=True)
-    df['weight'] = df[target].notnull().astype(int)
+    df['weight'] = df[target].notnull() \
+        .astype(get_dtype_policy()['weight'])
     del USER_TS
     
     return df
\ No newline at end of file
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 _RIGHT_TS_NAME = None
 _USER_ID_NAME = None
 _TARGET_NAME = None
@@ -61,3 +64,64 @@ def get_code_name(code=None, none_permitted=False):
         msg += "\n\nYou can also just pass it to the function as 'user_id'."
         raise ValueError(msg)
     return _CODE_NAME
+
+
+_DTYPE_POLICY = {}
+
+DTYPE_POLICIES = {
+    'default': {'float': 'float64', 'int': 'int64', 'weight': 'int64'},
+    'compact': {'float': 'float32', 'int': 'int32', 'weight': 'uint8'}
+}
+
+
+def set_dtype_policy(policy='default', **dtypes):
+    '''
+    Sets the dtypes used along the pipeline (load_data, presequence_padding,
+    transform_features, build_datasets...).
+    Parameters:
+     > policy: 'default' (pandas / numpy defaults) or 'compact' (float32
+       features, int32 integers and labels, uint8 weights).
+     > dtypes: overrides of the policy dtypes ('float', 'int', 'weight').
+
+    Ex: set_dtype_policy('compact')
+    '''
+    global _DTYPE_POLICY
+    if policy not in DTYPE_POLICIES:
+        msg = "\nUnknown dtype policy '{}'.".format(policy)
+        msg += "\nChoose one of: {}.".format(', '.join(sorted(DTYPE_POLICIES)))
+        raise ValueError(msg)
+    _DTYPE_POLICY = dict(DTYPE_POLICIES[policy], **dtypes)
+
+
+def get_dtype_policy(dtypes=None):
+    if dtypes:
+        return dict(DTYPE_POLICIES['default'], **dtypes)
+    return dict(DTYPE_POLICIES['default'], **_DTYPE_POLICY)
+
+
+def apply_dtype_policy(df, dtypes=None, exclude=()):
+    '''
+    Returns the dataframe with its float and integer columns downcast to the
+    dtypes of the policy (df itself if nothing is downcast). Integer columns
+    are only downcast if their values fit in the new dtype. A 'weight'
+    column of 0 / 1 values takes the weight dtype.
+    '''
+    dtypes = get_dtype_policy(dtypes)
+    float_dt = np.dtype(dtypes['float'])
+    int_dt = np.dtype(dtypes['int'])
+    weight_dt = np.dtype(dtypes['weight'])
+    casts = {}
+    for col in df.columns:
+        if col in exclude:
+            continue
+        dt = df[col].dtype
+        if col == 'weight':
+            if dt != weight_dt and np.isin(df[col].values, (0, 1)).all():
+                casts[col] = weight_dt
+        elif dt.kind == 'f' and dt.itemsize > float_dt.itemsize:
+            casts[col] = float_dt
+        elif dt.kind in 'iu' and dt.itemsize > int_dt.itemsize and len(df):
+            info = np.iinfo(int_dt)
+            if df[col].min() >= info.min and df[col].max() <= info.max:
+                casts[col] = int_dt
+    return df.astype(casts) if casts else df
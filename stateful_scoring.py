@@ -0,0 +1,165 @@
+import os
+import numpy as np
+import pandas as pd
+from sklearn.externals import joblib
+from TFM.settings import get_user_id_name
+
+
+# hidden and cell state sizes of lstm_layer_1 and lstm_layer_2
+STATE_DIMS = (80, 80, 32, 32)
+
+
+class StateStore(object):
+    '''
+    Memory-mapped store of the LSTM states of every user, keyed by user id.
+    States are kept in a float32 file of shape (users, sum(state_dims)) and
+    the user ids in a pickled index, so a scoring job only reads and writes
+    the rows of the users it scores. Unseen users get zero states (the
+    initial LSTM states). In memory, the row of every user is kept in a
+    dict, so adding users costs the same whatever the size of the store.
+    Parameters:
+     > path: directory of the store (created if needed).
+     > state_dims: sizes of the state arrays (h1, c1, h2, c2).
+    '''
+
+    def __init__(self, path, state_dims=STATE_DIMS):
+        self.path = path
+        self.state_dims = tuple(state_dims)
+        self.width = sum(self.state_dims)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._ids = []
+        if os.path.exists(self._ids_path):
+            self._ids = joblib.load(self._ids_path).tolist()
+        self._rows = {uid: row for row, uid in enumerate(self._ids)}
+        self._open(len(self._ids))
+
+    @property
+    def ids(self):
+        'User ids of the store rows.'
+        return pd.Index(self._ids)
+
+    @property
+    def _ids_path(self):
+        return os.path.join(self.path, 'ids.pkl')
+
+    @property
+    def _states_path(self):
+        return os.path.join(self.path, 'states.dat')
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _open(self, n_rows):
+        'Maps the states file, growing it to (at least) n_rows.'
+
+        size = max(n_rows, 1) * self.width * 4
+        with open(self._states_path, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self.states = np.memmap(self._states_path, dtype=np.float32,
+                                mode='r+', shape=(max(n_rows, 1), self.width))
+
+    def _get_rows(self, ids):
+        'Returns the rows of the users (-1 for unseen users).'
+        return np.fromiter((self._rows.get(uid, -1) for uid in ids),
+                           dtype=np.int64, count=len(ids))
+
+    def _split(self, ar):
+        return np.split(ar, np.cumsum(self.state_dims)[:-1], axis=1)
+
+    def get(self, ids):
+        'Returns the list of state arrays (h1, c1, h2, c2) of the users.'
+
+        rows = self._get_rows(pd.Index(ids).tolist())
+        ar = np.zeros((len(rows), self.width), dtype=np.float32)
+        known = rows >= 0
+        ar[known] = self.states[rows[known]]
+        return self._split(ar)
+
+    def set(self, ids, states):
+        '''
+        Stores the list of state arrays of the users (new users are added).
+        If a user appears several times, its last states are kept.
+        '''
+
+        ids = pd.Index(ids)
+        states = np.concatenate(states, axis=1)
+        if ids.has_duplicates:
+            last = ~ids.duplicated(keep='last')
+            ids = ids[last]
+            states = states[last]
+        ids = ids.tolist()
+        rows = self._get_rows(ids)
+        new = np.flatnonzero(rows < 0)
+        if len(new):
+            rows[new] = len(self._ids) + np.arange(len(new))
+            for i, row in zip(new, rows[new]):
+                self._rows[ids[i]] = row
+                self._ids.append(ids[i])
+            if len(self._ids) > len(self.states):
+                # the file grows geometrically
+                self.states.flush()
+                self._open(2 * len(self._ids))
+        self.states[rows] = states
+
+    def save(self):
+        self.states.flush()
+        joblib.dump(self.ids, self._ids_path)
+
+
+def _period_inputs(df, feat_dict, static=False):
+    'Returns the model inputs of one period (one row per user).'
+
+    n = len(df)
+    steps = () if static else (1,)
+    X_cat = [df[[f]].values.reshape((n,) + steps + (1,))
+             for f in feat_dict['cat_feats']]
+    X_con = df[feat_dict['con_feats']].values.reshape(
+        (n,) + steps + (len(feat_dict['con_feats']),))
+    X_lstm = df[feat_dict['lstm_feats']].values.reshape(
+        n, 1, len(feat_dict['lstm_feats']))
+    return X_cat + [X_con, X_lstm]
+
+
+def score_period(step_model, store, df, feat_dict, user_id=None,
+                 batch_size=4096, static=False, save=True, verbose=True):
+    '''
+    Scores a new period advancing every user by one LSTM step from its
+    stored states, and stores the new states. A period costs one step per
+    user, whatever the length of the user histories.
+    Parameters:
+     > step_model: model returned by generate_step_model.
+     > store: StateStore of the users.
+     > df: transformed features of the period, one row per user.
+     > static: if True, the profile features are fed once per user (see
+       generate_model).
+     > save: if True, the store index is saved after scoring.
+    To build the store from the history, score the past periods in order.
+    Returns the scores as a series indexed by user id.
+    '''
+
+    user_id = get_user_id_name(user_id=user_id)
+
+    ids = df[user_id].values
+    if len(pd.unique(ids)) != len(ids):
+        msg = "\nThe period has several rows for some users."
+        msg += "\nPass one row per user."
+        raise ValueError(msg)
+
+    scores = np.empty(len(df), dtype=np.float32)
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start:start + batch_size]
+        batch_ids = batch[user_id].values
+        out = step_model.predict(
+            _period_inputs(batch, feat_dict, static=static)
+            + store.get(batch_ids), batch_size=batch_size)
+        scores[start:start + len(batch)] = out[0][:, -1, 0]
+        store.set(batch_ids, out[1:])
+
+    if verbose:
+        print('> Users scored: {} | Stored users: {}'.format(len(df),
+                                                            len(store)))
+    if save:
+        store.save()
+    return pd.Series(scores, index=pd.Index(ids, name=user_id))
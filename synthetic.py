@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+_CODES = ['d_A09', 'd_E11', 'd_F32', 'd_I10', 'd_J06', 'd_K21', 'd_M54',
+          'd_N39', 'd_R51', 'd_Z00']
+_CANCER_CODES = ['d_C18', 'd_C34', 'd_C50', 'd_C44']
+
+
+def _user_histories(rng, n_users, n_months, min_len):
+    'Returns the history length and the last month of every user.'
+
+    lengths = rng.randint(min(min_len, n_months), n_months + 1, size=n_users)
+    # most users are active until the last month
+    last = np.where(rng.rand(n_users) < .8, n_months - 1,
+                    rng.randint(lengths - 1, n_months))
+    return lengths, last
+
+
+def generate_panel(n_users=1000, n_months=24, min_len=3, null_p=.05,
+                   start='2015-01-01', random_s=0, user_id='user_id',
+                   right_ts='right_ts', target='target'):
+    '''
+    Returns a seeded synthetic user-period panel with the schema used along
+    the pipeline, sorted by user and month:
+     > user_id, right_ts (month start), target (monthly expense) and weight.
+     > age and gender, region: continuous and categorical profile features.
+     > visits, expense: sequence features (with null_p missing values).
+    Parameters:
+     > n_users: number of users.
+     > n_months: number of months. Every user has a history of min_len to
+       n_months consecutive months.
+    '''
+
+    rng = np.random.RandomState(random_s)
+    lengths, last = _user_histories(rng, n_users, n_months, min_len)
+    n = lengths.sum()
+
+    users = np.repeat(np.arange(n_users), lengths)
+    step = np.arange(n) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    month = np.repeat(last - lengths + 1, lengths) + step
+    months = pd.date_range(start, periods=n_months, freq='MS')
+
+    activity = rng.gamma(2., 1., size=n_users)[users]
+    visits = rng.poisson(activity).astype(float)
+    expense = np.round(visits * rng.lognormal(3., .5, size=n), 2)
+
+    df = pd.DataFrame({
+        user_id: users,
+        right_ts: months.values[month],
+        'age': rng.randint(18, 90, size=n_users)[users].astype(float),
+        'gender': rng.choice(['F', 'M'], size=n_users)[users],
+        'region': rng.choice(['N', 'S', 'E', 'W', 'C'], size=n_users)[users],
+        'visits': visits,
+        'expense': expense
+    }, columns=[user_id, right_ts, 'age', 'gender', 'region', 'visits',
+                'expense'])
+    df[target] = expense * rng.lognormal(0., .3, size=n)
+    for col in ('visits', 'expense'):
+        df.loc[rng.rand(n) < null_p, col] = np.nan
+    df['weight'] = 1
+    return df
+
+
+def generate_events(n_users=1000, n_months=24, min_len=3, events_p=1.5,
+                    cancer_p=.01, start='2015-01-01', random_s=0,
+                    user_id='user_id', right_ts='right_ts', code='code'):
+    '''
+    Returns seeded synthetic diagnosis events (user_id, right_ts, code and
+    value = 1) of the users of generate_panel (same seed and sizes). Codes
+    are 'd_'-prefixed and include cancer codes ('d_C', melanoma 'd_C44')
+    with probability cancer_p.
+    Parameters:
+     > events_p: mean number of events per user-period.
+    '''
+
+    rng = np.random.RandomState(random_s)
+    lengths, last = _user_histories(rng, n_users, n_months, min_len)
+    users = np.repeat(np.arange(n_users), lengths)
+    step = np.arange(len(users)) - np.repeat(np.cumsum(lengths) - lengths,
+                                             lengths)
+    month = np.repeat(last - lengths + 1, lengths) + step
+    months = pd.date_range(start, periods=n_months, freq='MS')
+
+    rng = np.random.RandomState(random_s + 1)
+    n_events = rng.poisson(events_p, size=len(users))
+    rows = np.repeat(np.arange(len(users)), n_events)
+    codes = np.where(rng.rand(len(rows)) < cancer_p,
+                     rng.choice(_CANCER_CODES, size=len(rows)),
+                     rng.choice(_CODES, size=len(rows)))
+    return pd.DataFrame({
+        user_id: users[rows],
+        right_ts: months.values[month[rows]],
+        code: codes,
+        'value': 1
+    }, columns=[user_id, right_ts, code, 'value'])
+
+
+def write_shards(df, output_path, n_shards=4, pref='data_', user_id='user_id',
+                 file_format='pkl'):
+    '''
+    Writes the panel in n_shards files of disjoint users (as read by
+    load_data). Returns the list of paths.
+    '''
+
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    shard = pd.factorize(df[user_id])[0] * n_shards // max(df[user_id].nunique(), 1)
+    paths = []
+    for i in range(n_shards):
+        temp = df.loc[shard == i].reset_index(drop=True)
+        path = os.path.join(output_path, '{}{}.{}'.format(pref, i, file_format))
+        if file_format == 'parquet':
+            temp.to_parquet(path)
+        elif file_format == 'feather':
+            temp.to_feather(path)
+        else:
+            temp.to_pickle(path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,96 @@
+import importlib.machinery
+import os
+import sys
+import types
+import numpy as np
+import pandas as pd
+import pytest
+
+
+# the repository is the TFM package: it is made importable as TFM from a
+# checkout of any name
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+try:
+    import TFM  # noqa: F401
+except ImportError:
+    spec = importlib.machinery.ModuleSpec('TFM', None, is_package=True)
+    spec.submodule_search_locations = [ROOT]
+    module = types.ModuleType('TFM')
+    module.__spec__ = spec
+    module.__path__ = [ROOT]
+    sys.modules['TFM'] = module
+
+
+def _histories(n_users, n_months, random_s):
+    'Returns the user and the month of every row of consecutive histories.'
+
+    rng = np.random.RandomState(random_s)
+    lengths = rng.randint(2, n_months + 1, size=n_users)
+    last = np.where(rng.rand(n_users) < .8, n_months - 1,
+                    rng.randint(lengths - 1, n_months))
+    users = np.repeat(np.arange(n_users), lengths)
+    step = np.arange(len(users)) - np.repeat(np.cumsum(lengths) - lengths,
+                                             lengths)
+    month = np.repeat(last - lengths + 1, lengths) + step
+    months = pd.date_range('2015-01-01', periods=n_months, freq='MS')
+    return users, months.values[month]
+
+
+@pytest.fixture(autouse=True)
+def settings():
+    'Column names of the test data and the default dtype policy.'
+    from TFM.settings import set_col_names, set_dtype_policy
+    set_col_names(right_ts='right_ts', user_id='user_id', target='target',
+                  code='code')
+    set_dtype_policy('default')
+    yield
+    set_col_names()
+    set_dtype_policy('default')
+
+
+@pytest.fixture
+def panel():
+    '''
+    Small seeded user-period panel sorted by user and month, with profile
+    (age, gender, region) and sequence (visits, expense) features.
+    '''
+    users, months = _histories(60, 12, 0)
+    rng = np.random.RandomState(1)
+    n, n_users = len(users), users.max() + 1
+    visits = rng.poisson(rng.gamma(2., 1., size=n_users)[users]).astype(float)
+    expense = np.round(visits * rng.lognormal(3., .5, size=n), 2)
+    df = pd.DataFrame({
+        'user_id': users,
+        'right_ts': months,
+        'age': rng.randint(18, 90, size=n_users)[users].astype(float),
+        'gender': rng.choice(['F', 'M'], size=n_users)[users],
+        'region': rng.choice(['N', 'S', 'E', 'W', 'C'], size=n_users)[users],
+        'visits': visits,
+        'expense': expense
+    }, columns=['user_id', 'right_ts', 'age', 'gender', 'region', 'visits',
+                'expense'])
+    df['target'] = expense * rng.lognormal(0., .3, size=n)
+    for col in ('visits', 'expense'):
+        df.loc[rng.rand(n) < .05, col] = np.nan
+    df['weight'] = 1
+    return df
+
+
+@pytest.fixture
+def events():
+    'Diagnosis events (1.5 per user-period, 20% cancer codes) of panel.'
+    users, months = _histories(60, 12, 0)
+    rng = np.random.RandomState(2)
+    rows = np.repeat(np.arange(len(users)),
+                     rng.poisson(1.5, size=len(users)))
+    codes = np.where(rng.rand(len(rows)) < .2,
+                     rng.choice(['d_C18', 'd_C34', 'd_C44', 'd_C50'],
+                                size=len(rows)),
+                     rng.choice(['d_A09', 'd_E11', 'd_I10', 'd_J06', 'd_Z00'],
+                                size=len(rows)))
+    return pd.DataFrame({
+        'user_id': users[rows],
+        'right_ts': months[rows],
+        'code': codes,
+        'value': 1
+    }, columns=['user_id', 'right_ts', 'code', 'value'])
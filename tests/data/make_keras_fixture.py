@@ -0,0 +1,94 @@
+'''
+Writes the Keras parity fixtures of test_numpy_model: for static=False and
+static=True, a network with the layers (names, order and activations) of
+generate_model with random weights is built with Keras, exported with
+NumpyModel.from_keras and saved next to random inputs and the Keras
+predictions on them.
+Layer sizes are smaller than in generate_model to keep the files small,
+and the LSTM recurrent activation is 'sigmoid' (hard_sigmoid differs
+between Keras 2 and Keras 3).
+Ex (from the directory above the repository, with Keras installed):
+    python -m TFM.tests.data.make_keras_fixture
+'''
+
+import os
+import numpy as np
+import keras
+from keras.layers import Concatenate, Dense, Dropout, Embedding, Input, Lambda, LeakyReLU, LSTM, Reshape
+from keras.models import Model
+from TFM.numpy_model import NumpyModel
+
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+FEAT_DICT = {'con_feats': ['age'], 'lstm_feats': ['visits', 'expense'],
+             'cat_feats': ['gender', 'region'], 'M': [(3, 2), (6, 5)]}
+
+
+def _broadcast_time(x):
+    profile, seq = x
+    return keras.ops.expand_dims(profile, 1) \
+        * keras.ops.ones_like(seq[:, :, :1])
+
+
+def build_model(static, units=(8, 4), dense=(12, 6)):
+    steps = () if static else (None,)
+    cat_inputs, profile = [], []
+    for i, m in enumerate(FEAT_DICT['M']):
+        cat_inputs.append(Input(shape=steps + (1,),
+                                name='cat_{}_input'.format(i)))
+        emb = Embedding(m[0], min(m), name='cat_{}_embedding'.format(i))(
+            cat_inputs[-1])
+        emb_shape = (min(m),) if static else (-1, min(m))
+        profile.append(Reshape(emb_shape, name='cat_{}_reshape'.format(i))(
+            emb))
+    cont_input = Input(shape=steps + (len(FEAT_DICT['con_feats']),),
+                       name='cont_input')
+    profile.append(cont_input)
+
+    lstm_input = Input(shape=(None, len(FEAT_DICT['lstm_feats'])),
+                       name='lstm_input')
+    lstm1 = LSTM(units[0], recurrent_activation='sigmoid',
+                 return_sequences=True, name='lstm_layer_1')(lstm_input)
+    lstm2 = LSTM(units[1], recurrent_activation='sigmoid',
+                 return_sequences=True, name='lstm_layer_2')(lstm1)
+    if static:
+        concat1 = Concatenate(name='profile_concat')(profile)
+        profile = Lambda(_broadcast_time, name='profile_broadcast')(
+            [concat1, lstm2])
+        concat2 = Concatenate(name='profile_lstm_concat')([profile, lstm2])
+    else:
+        concat2 = Concatenate(name='profile_lstm_concat')(profile + [lstm2])
+
+    x = LeakyReLU()(Dense(dense[0], name='dense_layer_1')(concat2))
+    x = LeakyReLU()(Dense(dense[1], name='dense_layer_2')(Dropout(.1)(x)))
+    out = Dense(1, name='dense_layer_3')(Dropout(.2)(x))
+    return Model(cat_inputs + [cont_input, lstm_input], out)
+
+
+def inputs(n, T, static, rng):
+    shape = (n, 1) if static else (n, T, 1)
+    X_cat = [rng.randint(0, m[0], shape) for m in FEAT_DICT['M']]
+    X_con = rng.normal(size=shape[:-1] + (len(FEAT_DICT['con_feats']),))
+    X_lstm = rng.normal(size=(n, T, len(FEAT_DICT['lstm_feats'])))
+    return [x.astype(np.float32) for x in X_cat + [X_con, X_lstm]]
+
+
+def main():
+    rng = np.random.RandomState(0)
+    for static in (False, True):
+        model = build_model(static)
+        # non-zero biases and larger weights than the initialisation
+        for layer in model.layers:
+            layer.set_weights([w + rng.normal(0., .3, w.shape)
+                               for w in layer.get_weights()])
+        name = 'keras_static' if static else 'keras'
+        NumpyModel.from_keras(model, FEAT_DICT).save(
+            os.path.join(PATH, name + '_model.npz'))
+        X = inputs(16, 7, static, rng)
+        np.savez(os.path.join(PATH, name + '_io.npz'),
+                 y=model.predict(X, verbose=0),
+                 **{'X_{}'.format(i): x for i, x in enumerate(X)})
+
+
+if __name__ == '__main__':
+    main()
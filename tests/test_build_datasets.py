@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+import pytest
+from TFM.build_datasets import BucketView, build_datasets, length_buckets, merge_datasets
+
+
+FEAT_DICT = {'con_feats': ['age'], 'lstm_feats': ['visits', 'expense'],
+             'cat_feats': ['gender', 'region']}
+P2P = 2
+
+
+@pytest.fixture
+def df(panel):
+    for col in FEAT_DICT['cat_feats']:
+        panel[col] = pd.factorize(panel[col])[0]
+    return panel.fillna(0.)
+
+
+def _reference_datasets(df, train_p, p2p):
+    'Per-length loop of the original build_datasets.'
+
+    data_valid, data_test = [], []
+    user_len = df['user_id'].value_counts().sort_values(ascending=False)
+    for length in user_len.unique():
+        uids = user_len[user_len == length].index.values
+        temp = df.loc[df['user_id'].isin(uids)]
+        temp_size = len(uids)
+        temp_i = np.arange(temp_size)
+        np.random.shuffle(temp_i)
+        train_i = temp_i[:int(temp_size*train_p)]
+        valid_i = temp_i[int(temp_size*train_p):]
+
+        def seq(cols):
+            return temp[cols].values.reshape(temp_size, length, len(cols))
+        y, w = seq(['target']), seq(['weight'])
+        X_con, X_lstm = seq(FEAT_DICT['con_feats']), seq(FEAT_DICT['lstm_feats'])
+        X_cat = [seq([c]) for c in FEAT_DICT['cat_feats']]
+        data_valid.append({
+            'y': y[valid_i, :-p2p], 'w': w[valid_i, :-p2p, 0],
+            'X_con': X_con[valid_i, :-p2p], 'X_lstm': X_lstm[valid_i, :-p2p],
+            'X_cat': [ar[valid_i, :-p2p] for ar in X_cat]
+        })
+        data_test.append({
+            'y': y, 'w': w[:, :, 0], 'X_con': X_con, 'X_lstm': X_lstm,
+            'X_cat': X_cat, 'train_i': train_i
+        })
+    return data_valid, data_test
+
+
+def _assert_sets_equal(data, expected):
+    assert len(data) == len(expected)
+    for d, e in zip(data, expected):
+        for key in e:
+            if key == 'X_cat':
+                for a, b in zip(d[key], e[key]):
+                    np.testing.assert_array_equal(a, b)
+            else:
+                np.testing.assert_array_equal(d[key], e[key])
+
+
+def test_build_datasets(df):
+    np.random.seed(0)
+    data_valid, data_test = build_datasets(df, FEAT_DICT, .8, P2P,
+                                           verbose=False)
+    np.random.seed(0)
+    expected_valid, expected_test = _reference_datasets(df, .8, P2P)
+    _assert_sets_equal(data_valid, expected_valid)
+    _assert_sets_equal(data_test, expected_test)
+    # no bucketing: no padding
+    assert all(not d['pad_len'].any() for d in data_test)
+
+
+def test_build_datasets_buckets(df):
+    lengths = df['user_id'].value_counts()
+    bounds = length_buckets(lengths.values, 3)
+    assert len(bounds) <= 3 and bounds[-1] == lengths.max()
+
+    _, data_test = build_datasets(df, FEAT_DICT, .8, P2P, n_buckets=3,
+                                  verbose=False)
+    assert sorted(d['y'].shape[1] for d in data_test) == sorted(bounds)
+    seq_len = np.concatenate([d['y'].shape[1] - d['pad_len']
+                              for d in data_test])
+    assert sorted(seq_len) == sorted(lengths.values)
+    for d in data_test:
+        length = d['y'].shape[1]
+        # padded steps are pre-padded with weight and features 0
+        pad = np.arange(length) < d['pad_len'][:, None]
+        assert not d['w'][pad].any() and not d['X_lstm'][pad].any()
+        assert (d['w'][~pad] == 1).all()
+
+
+def test_build_datasets_static(df):
+    # a profile feature that changes over time: the step of each row
+    df['age'] = df.groupby('user_id').cumcount().astype(float)
+    data_valid, data_test = build_datasets(df, FEAT_DICT, .8, P2P,
+                                           static=True, verbose=False)
+    for v, d in zip(data_valid, data_test):
+        n, length = d['y'].shape[:2]
+        assert d['X_con'].shape == (n, 1)
+        assert all(x.shape == (n, 1) for x in d['X_cat'])
+        # test sets see the last period, validation sets and training
+        # batches the last period before the horizon (zeros if there is none)
+        past = max(length - P2P - 1, 0)
+        np.testing.assert_array_equal(d['X_con'][:, 0], length - 1)
+        np.testing.assert_array_equal(v['X_con'][:, 0], past)
+        batch = BucketView(d, rows=d['train_i'], steps=slice(None, -P2P))
+        np.testing.assert_array_equal(batch['X_con'][:, 0], past)
+        assert all(x.shape == (len(d['train_i']), 1) for x in batch['X_cat'])
+
+
+def test_merge_datasets(df):
+    bounds = length_buckets(df['user_id'].value_counts().values, 3)
+    parts = [df.loc[df['user_id'] % 3 == p] for p in range(3)]
+    data_tests = [build_datasets(part, FEAT_DICT, .8, P2P, bounds=bounds,
+                                 verbose=False)[1] for part in parts]
+    data_valid, data_test = merge_datasets(data_tests, .8, P2P)
+    _, whole = build_datasets(df, FEAT_DICT, .8, P2P, bounds=bounds,
+                              verbose=False)
+
+    assert [d['y'].shape for d in data_test] == [d['y'].shape for d in whole]
+    for d, e in zip(data_test, whole):
+        # same sequences, in partition order
+        assert sorted(map(bytes, d['X_lstm'])) == sorted(map(bytes, e['X_lstm']))
+        assert len(d['train_i']) == len(e['train_i'])
+    for v, d in zip(data_valid, data_test):
+        assert len(v['y']) + len(d['train_i']) == len(d['y'])
+        assert v['y'].shape[1] == d['y'].shape[1] - P2P
+
+
+def test_merge_datasets_static(df):
+    df['age'] = df.groupby('user_id').cumcount().astype(float)
+    bounds = length_buckets(df['user_id'].value_counts().values, 3)
+    parts = [df.loc[df['user_id'] % 3 == p] for p in range(3)]
+    data_tests = [build_datasets(part, FEAT_DICT, .8, P2P, bounds=bounds,
+                                 static=True, verbose=False)[1]
+                  for part in parts]
+    data_valid, data_test = merge_datasets(data_tests, .8, P2P)
+    for v, d in zip(data_valid, data_test):
+        # last step before the horizon of the (pre-padded) sequences
+        seq_len = d['y'].shape[1] - d['pad_len']
+        np.testing.assert_array_equal(d['X_con'][:, 0], seq_len - 1)
+        np.testing.assert_array_equal(
+            v['X_con'][:, 0],
+            np.maximum(seq_len - P2P - 1, 0)[d.base['valid_i']])
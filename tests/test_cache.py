@@ -0,0 +1,72 @@
+import os
+import numpy as np
+import pandas as pd
+from TFM.build_datasets import build_datasets
+from TFM.cache import StageCache, fingerprint
+from TFM.feature_engineering import fillna_cols
+
+
+FEAT_DICT = {'con_feats': ['age'], 'lstm_feats': ['visits'], 'cat_feats': []}
+
+
+def test_fingerprint(panel):
+    assert fingerprint(panel) == fingerprint(panel.copy())
+    other = panel.copy()
+    other.loc[0, 'visits'] = -1
+    assert fingerprint(panel) != fingerprint(other)
+    assert fingerprint(panel) != fingerprint(panel.astype({'age': 'float32'}))
+
+
+def test_hit_and_miss(tmpdir, panel):
+    cache = StageCache(str(tmpdir))
+    out = cache.call(fillna_cols, panel, ffill_cols=['visits'], verbose=False)
+    hit = cache.call(fillna_cols, panel, ffill_cols=['visits'], verbose=True)
+    pd.testing.assert_frame_equal(hit, out)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.call(fillna_cols, panel, ffill_cols=['expense'], verbose=False)
+    assert cache.misses == 2
+    # inplace calls are never cached
+    cache.call(fillna_cols, panel.copy(), ffill_cols=['visits'], inplace=True)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_random_state_restored(tmpdir, panel):
+    stage = StageCache(str(tmpdir)).wrap(build_datasets)
+    df = panel.fillna(0.)
+
+    draws = []
+    for _ in range(2):
+        np.random.seed(0)
+        _, data_test = stage(df, FEAT_DICT, .8, 2, verbose=False)
+        draws.append(np.random.rand(3))
+    np.testing.assert_array_equal(draws[0], draws[1])
+
+
+def test_corrupted_entry(tmpdir, panel):
+    cache = StageCache(str(tmpdir))
+    out = cache.call(fillna_cols, panel, ffill_cols=['visits'], verbose=False)
+    for path, _, _ in cache.entries():
+        with open(path, 'wb') as f:
+            f.write(b'corrupted')
+    again = cache.call(fillna_cols, panel, ffill_cols=['visits'],
+                       verbose=False)
+    pd.testing.assert_frame_equal(again, out)
+    assert cache.misses == 2
+
+
+def test_key_covers_defaults(tmpdir, panel):
+    cache = StageCache(str(tmpdir))
+
+    def stage(df, value=0.):
+        return df.fillna(value)
+    key = cache.key(stage, (panel,), {})
+    stage.__defaults__ = (1.,)
+    assert cache.key(stage, (panel,), {}) != key
+
+
+def test_eviction(tmpdir, panel):
+    cache = StageCache(str(tmpdir), max_mb=0)
+    cache.call(fillna_cols, panel, ffill_cols=['visits'], verbose=False)
+    assert cache.entries() == []
+    assert not [f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp')]
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+from dateutil import relativedelta
+from TFM.feature_engineering import adding_target, clip_continuous_f, fit_sketches, fit_trends, merge_sketches, sketch_bounds, trend_enrichment, trend_enrichment_batch
+
+
+def _periods(users):
+    'Train / test periods of the users, with month-end dates.'
+
+    rng = np.random.RandomState(0)
+    n = len(users)
+    train_max = pd.Timestamp('2015-12-31') \
+        - pd.to_timedelta(rng.randint(0, 200, n), unit='D')
+    return pd.DataFrame({
+        'user_id': users,
+        'end_type': rng.choice(['cancer', 'censored'], size=n),
+        'dat_can': pd.Timestamp('2015-06-01')
+        + pd.to_timedelta(rng.randint(0, 60, n), unit='D'),
+        'temp_can': pd.Timestamp('2015-07-01'),
+        'train_dat_max': train_max,
+        'test_dat_max': train_max + pd.Timedelta(days=31)
+    })
+
+
+def _reference_target(e, periods, p2p, test):
+    'relativedelta and dict mapping of the original adding_target.'
+
+    target = periods.loc[periods['end_type'] == 'cancer'].copy()
+    dat_max = 'train_dat_max'
+    if test:
+        target = target.loc[target['dat_can'] >= target['temp_can']]
+        dat_max = 'test_dat_max'
+    c_year = target[dat_max].apply(
+        lambda x: x - relativedelta.relativedelta(months=p2p - 1))
+    c_year = e['user_id'].map(dict(zip(target['user_id'], c_year)))
+    return (e['right_ts'] >= c_year).astype(float)
+
+
+@pytest.mark.parametrize('test', [False, True])
+@pytest.mark.parametrize('p2p', [1, 3])
+def test_adding_target(events, test, p2p):
+    periods = _periods(events['user_id'].unique())
+    e = events.copy()
+    adding_target(e, periods, p2p, test=test)
+    expected = _reference_target(events, periods, p2p, test)
+    np.testing.assert_array_equal(e['target'].values, expected.values)
+
+
+def test_adding_target_horizons(events):
+    periods = _periods(events['user_id'].unique())
+    e = events.copy()
+    adding_target(e, periods, [1, 3])
+    for h in (1, 3):
+        expected = _reference_target(events, periods, h, False)
+        np.testing.assert_array_equal(e['target_{}'.format(h)].values,
+                                      expected.values)
+
+
+def test_trend_enrichment_batch(panel):
+    df = panel.fillna(0.)
+    # columns of a list are clipped as by trend_enrichment
+    out, trend = trend_enrichment_batch(df, ['visits', 'expense'],
+                                        drop_clip=False)
+    for col in ('visits', 'expense'):
+        expected = trend_enrichment(df, col, drop_clip=False, show_plot=False)
+        pd.testing.assert_series_equal(out[col + '_clip'],
+                                       expected[col + '_clip'])
+        pd.testing.assert_series_equal(out[col + '_mean'],
+                                       expected[col + '_mean'])
+    assert out['expense_clip'].min() > 0
+
+    # columns with an empty spec are not clipped
+    trend = fit_trends(df, {'expense': {}})
+    expected = df.groupby('right_ts')['expense'].mean()
+    np.testing.assert_allclose(trend['expense_mean'].values, expected.values)
+
+
+def test_clip_continuous_f_sketch(panel):
+    se = panel['expense'].fillna(0.)
+    # sketches are exact below their buffer size
+    sketches = fit_sketches(panel.fillna(0.), ['expense'])
+    assert clip_continuous_f(se, q2cl=.05, q2cu=.95, return_lu=True,
+                             sketch=sketches['expense']) \
+        == pytest.approx(clip_continuous_f(se, q2cl=.05, q2cu=.95,
+                                           return_lu=True))
+
+    # merged chunk sketches give the same bounds
+    chunks = [panel.iloc[i:i + 100].fillna(0.)
+              for i in range(0, len(panel), 100)]
+    merged = merge_sketches([fit_sketches(c, ['expense']) for c in chunks])
+    bounds = sketch_bounds(merged, {'expense': {'q2cu': .95},
+                                    'visits': None})
+    assert bounds['visits'] == (None, None)
+    assert bounds['expense'] == pytest.approx(
+        clip_continuous_f(se, q2cu=.95, return_lu=True))
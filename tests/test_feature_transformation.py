@@ -0,0 +1,59 @@
+import warnings
+import numpy as np
+import pytest
+from TFM.feature_transformation import pivoting_events, pivoting_events_sparse
+
+
+@pytest.mark.parametrize('agg_function', ['count', 'sum', 'mean'])
+def test_pivoting_events_sparse(events, agg_function):
+    events['value'] = np.random.RandomState(0).randint(1, 5, len(events))
+    vocabulary = sorted(events['code'].unique())
+    dense = pivoting_events(events, agg_function, verbose=False)
+    input_data, index = pivoting_events_sparse(events, agg_function,
+                                               vocabulary, verbose=False)
+    assert index.equals(dense.index)
+    # implicit entries are the NaN cells of the dense pivot
+    dense = dense.reindex(columns=vocabulary)
+    np.testing.assert_array_equal(input_data.toarray() != 0,
+                                  dense.notnull().values)
+    np.testing.assert_allclose(input_data.toarray(),
+                               dense.fillna(0.).values)
+
+
+def test_pivoting_events_sparse_vocabulary(events):
+    vocabulary = ['d_Z00', 'd_C50', 'd_unseen']
+    with warnings.catch_warnings():
+        # codes out of the vocabulary are dropped without warnings
+        warnings.simplefilter('error')
+        input_data, index = pivoting_events_sparse(events, 'count',
+                                                   vocabulary, verbose=False)
+    known = events.loc[events['code'].isin(vocabulary)]
+    dense = pivoting_events(known, 'count', verbose=False) \
+        .reindex(columns=vocabulary)
+    assert index.equals(dense.index)
+    np.testing.assert_allclose(input_data.toarray(),
+                               dense.fillna(0.).values)
+
+
+def test_pivoting_events_sparse_nulls(events):
+    events['value'] = np.where(np.arange(len(events)) % 3 == 0, np.nan,
+                               np.arange(len(events)))
+    vocabulary = sorted(events['code'].unique())
+    dense = pivoting_events(events, 'mean', verbose=False) \
+        .reindex(columns=vocabulary)
+    input_data, index = pivoting_events_sparse(events, 'mean', vocabulary,
+                                               verbose=False)
+    # user-periods whose values are all null are dropped
+    keys = events.set_index(['user_id', 'right_ts']).index
+    assert len(index) < len(keys.unique())
+    assert index.equals(dense.index)
+    np.testing.assert_allclose(input_data.toarray(),
+                               dense.fillna(0.).values)
+
+
+def test_pivoting_events_sparse_errors(events):
+    with pytest.raises(ValueError):
+        pivoting_events_sparse(events, 'max', ['d_Z00'], verbose=False)
+    events['other'] = 1
+    with pytest.raises(ValueError):
+        pivoting_events_sparse(events, 'count', ['d_Z00'], verbose=False)
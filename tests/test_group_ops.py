@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+from TFM.group_ops import group_bfill, group_ffill, group_lags, group_shift, user_offsets
+
+
+COLS = ['visits', 'expense']
+
+
+def test_user_offsets(panel):
+    offsets = user_offsets(panel)
+    sizes = panel.groupby('user_id', sort=False).size().values
+    np.testing.assert_array_equal(np.diff(offsets), sizes)
+    assert user_offsets(panel.sample(frac=1, random_state=0)) is None
+
+
+def test_group_ffill_bfill(panel):
+    expected = panel.groupby('user_id')[COLS].ffill()
+    pd.testing.assert_frame_equal(group_ffill(panel, COLS), expected)
+    expected = panel.groupby('user_id')[COLS].bfill()
+    pd.testing.assert_frame_equal(group_bfill(panel, COLS), expected)
+
+
+def test_group_fill_inplace(panel):
+    expected = panel.groupby('user_id')[COLS].ffill()
+    out = group_ffill(panel, COLS, inplace=True)
+    assert out is panel
+    pd.testing.assert_frame_equal(panel[COLS], expected)
+
+
+@pytest.mark.parametrize('periods', [1, 3, -2])
+def test_group_shift(panel, periods):
+    expected = panel.groupby('user_id')['expense'].shift(periods)
+    pd.testing.assert_series_equal(group_shift(panel, 'expense',
+                                               periods=periods), expected)
+
+
+def test_group_lags(panel):
+    out = group_lags(panel, COLS, lags=(1, 2), fill_value=-1.)
+    step = panel.groupby('user_id').cumcount().values
+    for col in COLS:
+        for lag in (1, 2):
+            expected = panel.groupby('user_id')[col].shift(lag) \
+                .where(step >= lag, -1.)
+            np.testing.assert_array_equal(
+                out['{}_lag{}'.format(col, lag)].values, expected.values)
+
+
+def test_not_contiguous(panel):
+    with pytest.raises(ValueError):
+        group_ffill(panel.sample(frac=1, random_state=0), COLS)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from TFM import instrumentation
+from TFM.instrumentation import disable, enable, stage
+
+
+@pytest.fixture
+def records():
+    records = []
+    enable(records.append, trace_memory=True)
+    yield records
+    disable()
+
+
+@pytest.mark.skipif(not instrumentation._RESET_PEAK,
+                    reason='tracemalloc.reset_peak needs Python 3.9+')
+def test_nested_peaks(records):
+    with stage('outer'):
+        x = np.ones(2 * 10 ** 6)
+        with stage('inner'):
+            y = np.ones(10 ** 6)
+            del y
+        del x
+    inner, outer = records
+    assert 7 < inner['alloc_peak_mb'] < 9
+    # the peak of the outer stage includes its inner stages
+    assert outer['alloc_peak_mb'] > 22
+    assert abs(outer['alloc_delta_mb']) < 1
+
+
+def test_peak_without_reset_peak(records, monkeypatch):
+    monkeypatch.setattr(instrumentation, '_RESET_PEAK', False)
+    with stage('stage'):
+        x = np.ones(10 ** 6)
+    assert records[0]['alloc_peak_mb'] is None
+    assert records[0]['alloc_delta_mb'] > 7
+    del x
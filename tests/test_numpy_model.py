@@ -0,0 +1,102 @@
+import os
+import numpy as np
+import pytest
+from TFM.numpy_model import NumpyModel, compare_with_keras
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+FEAT_DICT = {'con_feats': ['age'], 'lstm_feats': ['visits', 'expense'],
+             'cat_feats': ['gender', 'region'], 'M': [(3, 2), (6, 5)]}
+
+
+def _random_model(static=False, random_s=0):
+    rng = np.random.RandomState(random_s)
+
+    def w(*shape):
+        return rng.normal(0., .3, shape)
+    n_in = 2 + 5 + 1
+    return NumpyModel([w(3, 2), w(6, 5)],
+                      [(w(2, 4 * 8), w(8, 4 * 8), w(4 * 8)),
+                       (w(8, 4 * 4), w(4, 4 * 4), w(4 * 4))],
+                      [(w(n_in + 4, 6), w(6)), (w(6, 3), w(3)), (w(3, 1), w(1))],
+                      static=static, feat_dict=FEAT_DICT)
+
+
+def _inputs(n, T, static=False, random_s=0):
+    rng = np.random.RandomState(random_s)
+    shape = (n, 1) if static else (n, T, 1)
+    X_cat = [rng.randint(0, 3, shape), rng.randint(0, 6, shape)]
+    X_con = rng.normal(size=shape[:-1] + (1,))
+    return X_cat + [X_con, rng.normal(size=(n, T, 2))]
+
+
+@pytest.mark.parametrize('static', [False, True])
+def test_batches_states_and_last_only(static):
+    model = _random_model(static=static)
+    X = _inputs(10, 6, static=static)
+    y, states = model.predict(X, return_states=True)
+    assert y.shape == (10, 6, 1)
+    assert [s.shape for s in states] == [(10, 8), (10, 8), (10, 4), (10, 4)]
+    assert model.state_dims == (8, 8, 4, 4)
+
+    np.testing.assert_allclose(model.predict(X, batch_size=3), y, rtol=1e-5)
+    np.testing.assert_allclose(model.predict(X, last_only=True), y[:, -1:],
+                               rtol=1e-5)
+
+    # a sequence scored in two halves, carrying the LSTM states
+    def half(x, steps):
+        return x if static and x.ndim == 2 else x[:, steps]
+    y1, s1 = model.predict([half(x, slice(None, 3)) for x in X],
+                           return_states=True)
+    y2 = model.predict([half(x, slice(3, None)) for x in X], states=s1)
+    np.testing.assert_allclose(np.concatenate([y1, y2], axis=1), y,
+                               rtol=1e-4, atol=1e-6)
+
+
+def test_save_load(tmpdir):
+    model = _random_model()
+    path = str(tmpdir.join('model.npz'))
+    model.save(path)
+    loaded = NumpyModel.load(path)
+    assert loaded.feat_dict['lstm_feats'] == FEAT_DICT['lstm_feats']
+    X = _inputs(5, 4)
+    np.testing.assert_array_equal(loaded.predict(X), model.predict(X))
+
+
+def test_save_load_feat_dict(tmpdir):
+    model = _random_model()
+    model.feat_dict = {'con_feats': ['age']}
+    with pytest.raises(ValueError):
+        model.save(str(tmpdir.join('model.npz')))
+
+    # files saved without the feature lists
+    path = str(tmpdir.join('old.npz'))
+    np.savez(path, **{k: v for k, v in np.load(os.path.join(
+        DATA, 'keras_model.npz')).items() if not k.endswith('_feats')})
+    with pytest.raises(ValueError):
+        NumpyModel.load(path)
+
+
+@pytest.mark.parametrize('name', ['keras', 'keras_static'])
+def test_numpy_model_vs_keras_fixture(name):
+    # weights and predictions of a Keras model (see data/make_keras_fixture)
+    numpy_model = NumpyModel.load(os.path.join(DATA, name + '_model.npz'))
+    io = np.load(os.path.join(DATA, name + '_io.npz'))
+    X = [io['X_{}'.format(i)] for i in range(len(io.files) - 1)]
+    assert numpy_model.static == (name == 'keras_static')
+    assert io['y'].std() > .1
+    np.testing.assert_allclose(numpy_model.predict(X), io['y'], atol=1e-5)
+    np.testing.assert_allclose(numpy_model.predict(X, last_only=True),
+                               io['y'][:, -1:], atol=1e-5)
+
+
+@pytest.mark.parametrize('static', [False, True])
+def test_numpy_model_vs_keras(static):
+    pytest.importorskip('keras')
+    from TFM.generate_model import generate_model
+
+    model = generate_model(FEAT_DICT, static=static)
+    numpy_model = NumpyModel.from_keras(model, feat_dict=FEAT_DICT)
+    assert numpy_model.static == static
+    X = _inputs(16, 7, static=static)
+    assert compare_with_keras(model, numpy_model, X) < 1e-4
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+from TFM.quantile_sketch import TDigest
+
+
+Q = [0., .01, .05, .25, .5, .75, .95, .99, 1.]
+
+
+def _rank_error(values, q, x):
+    'Absolute difference between q and the rank of x in values.'
+    values = np.sort(values)
+    rank = (np.searchsorted(values, x, side='left')
+            + np.searchsorted(values, x, side='right')) / 2.
+    return np.abs(rank / len(values) - np.asarray(q))
+
+
+def test_exact_below_buffer_size():
+    values = np.random.RandomState(0).lognormal(3., 1., 5000)
+    sketch = TDigest(values)
+    np.testing.assert_allclose(sketch.quantile(Q),
+                               pd.Series(values).quantile(Q).values)
+    assert sketch.n == len(values)
+
+
+def test_nulls_and_empty():
+    sketch = TDigest()
+    assert np.isnan(sketch.quantile(.5))
+    sketch.update([np.nan, 1., 3., np.nan])
+    assert sketch.n == 2
+    assert sketch.quantile(.5) == 2.
+
+
+@pytest.mark.parametrize('n_chunks', [1, 8])
+def test_rank_error(n_chunks):
+    values = np.random.RandomState(1).lognormal(3., 1., 200000)
+    chunks = np.array_split(values, n_chunks)
+    sketch = TDigest.merge_all(TDigest(c, delta=200) for c in chunks)
+    assert len(sketch) <= 200
+    assert sketch.n == len(values)
+    assert sketch.quantile(0.) == values.min()
+    assert sketch.quantile(1.) == values.max()
+
+    err = _rank_error(values, Q, sketch.quantile(Q))
+    assert err.max() < 1. / 200
+    # tails are more accurate than the median
+    assert err[[1, -2]].max() < 1e-3
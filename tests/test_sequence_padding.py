@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+from TFM.sequence_padding import presequence_padding
+
+
+def _reference_padding(df, val):
+    'Per-user loop of the original presequence_padding.'
+
+    ts_list = sorted(df['right_ts'].unique())
+    time_i = df['right_ts'].map(dict(zip(ts_list, range(len(ts_list)))))
+    user_len = df['user_id'].value_counts().to_frame(name='len0')
+    len1 = val*(((user_len['len0'] - 1)//val) + 1)
+    user_len['len1'] = np.minimum(len1, user_len['len0'].max())
+
+    user_ts = []
+    for length in sorted(user_len['len1'].unique()):
+        for uid in user_len.loc[user_len['len1'] == length].index:
+            mti = time_i[df['user_id'] == uid].max()
+            ts = ts_list[(mti - length + 1):(mti + 1)]
+            ts = pd.Series(ts, dtype=df['right_ts'].dtype)
+            user_ts.append(pd.DataFrame({'user_id': uid, 'right_ts': ts}))
+    out = pd.concat(user_ts).merge(df, on=['right_ts', 'user_id'],
+                                   how='left')
+    out['weight'] = out['target'].notnull().astype(int)
+    return out
+
+
+@pytest.mark.parametrize('val', [1, 3, 5])
+def test_presequence_padding(panel, val):
+    # some users without target values in the middle of their history
+    panel.loc[panel.index % 7 == 3, 'target'] = np.nan
+    out = presequence_padding(panel, val, verbose=False)
+    expected = _reference_padding(panel, val)
+    pd.testing.assert_frame_equal(out.reset_index(drop=True),
+                                  expected.reset_index(drop=True),
+                                  check_dtype=False)
+
+
+def test_presequence_padding_partition(panel):
+    # a partition padded with the periods and the maximum length of the
+    # whole data gets the same rows as in the whole padded data
+    whole = presequence_padding(panel, 4, verbose=False)
+    part = panel.loc[panel['user_id'] % 2 == 0]
+    out = presequence_padding(part, 4, periods=panel['right_ts'].unique(),
+                              max_len=panel['user_id'].value_counts().max(),
+                              verbose=False)
+    expected = whole.loc[whole['user_id'] % 2 == 0]
+    key = ['user_id', 'right_ts']
+    pd.testing.assert_frame_equal(
+        out.sort_values(key).reset_index(drop=True),
+        expected.sort_values(key).reset_index(drop=True))
@@ -0,0 +1,55 @@
+import numpy as np
+from TFM.stateful_scoring import StateStore
+
+
+DIMS = (3, 3, 2, 2)
+
+
+def _states(n, value):
+    return [np.full((n, d), value, dtype=np.float32) for d in DIMS]
+
+
+def test_state_store(tmpdir):
+    store = StateStore(str(tmpdir), state_dims=DIMS)
+    assert len(store) == 0
+    # unseen users get zero states
+    for s, d in zip(store.get(['a', 'b']), DIMS):
+        np.testing.assert_array_equal(s, np.zeros((2, d)))
+
+    store.set(['a', 'b'], _states(2, 1.))
+    store.set(['b', 'c'], _states(2, 2.))
+    assert len(store) == 3
+    h1 = store.get(['c', 'a', 'b', 'z'])[0]
+    np.testing.assert_array_equal(h1[:, 0], [2., 1., 2., 0.])
+    store.save()
+
+    # reloaded from disk
+    store = StateStore(str(tmpdir), state_dims=DIMS)
+    assert len(store) == 3
+    np.testing.assert_array_equal(store.get(['a', 'c'])[3][:, 0], [1., 2.])
+
+
+def test_state_store_growth(tmpdir):
+    store = StateStore(str(tmpdir), state_dims=DIMS)
+    ids = np.arange(100)
+    for start in range(0, 100, 7):
+        batch = ids[start:start + 7]
+        store.set(batch, [np.repeat(batch[:, None], d, axis=1)
+                          .astype(np.float32) for d in DIMS])
+    assert len(store) == 100
+    np.testing.assert_array_equal(store.get(ids[::-1])[2][:, 1], ids[::-1])
+
+
+def test_state_store_duplicates(tmpdir):
+    store = StateStore(str(tmpdir), state_dims=DIMS)
+    store.set(['a'], _states(1, 1.))
+    # the last states of repeated users are kept
+    states = [np.arange(4, dtype=np.float32)[:, None].repeat(d, axis=1)
+              for d in DIMS]
+    store.set(['b', 'a', 'b', 'a'], states)
+    assert len(store) == 2 and store.ids.is_unique
+    np.testing.assert_array_equal(store.get(['a', 'b'])[0][:, 0], [3., 2.])
+    store.save()
+    store = StateStore(str(tmpdir), state_dims=DIMS)
+    store.set(['b', 'c'], _states(2, 5.))
+    assert list(store.ids) == ['a', 'b', 'c']
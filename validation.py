@@ -1,89 +1,313 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import numpy as np
 import pandas as pd
 from sklearn.externals import joblib
 import datetime as dt
-from sklearn.metrics import mean_squared_error, mean_absolute_error
-
-
-def test_score(model, data, only_last=False, return_y=False):
-    y_pred = np.zeros((0))
-    y = np.zeros((0))
-    if only_last:
-        for d in data:
-            indexes = d['w'][:, -1:].ravel().nonzero()[0]
-            y_pred = np.concatenate((y_pred, model.predict(d['X_cat'] + [
-                d['X_con'], d['X_lstm']
-            ])[:, -1:, :].ravel()[indexes]))
-            y = np.concatenate((y, d['y'][:, -1:, :].ravel()[indexes]))
-    else:
-        for d in data:
-            indexes = d['w'][:, :].ravel().nonzero()[0]
-            y_pred = np.concatenate((y_pred, model.predict(d['X_cat'] + [
-                d['X_con'], d['X_lstm']
-            ])[:, :, :].ravel()[indexes]))
-            y = np.concatenate((y, d['y'][:, :, :].ravel()[indexes]))
-    try:
-        rmse = np.sqrt(mean_squared_error(y, y_pred))
-        mae = mean_absolute_error(y, y_pred)
-    except:
-        rmse = -1.
-        mae = -1.
+from TFM.build_datasets import BucketView
+from TFM.instrumentation import instrument
+
+
+class StreamingScores(object):
+    '''
+    Streaming accumulators of the RMSE, the MAE and, optionally, other
+    metrics, so scores are computed batch by batch without keeping every
+    prediction in memory.
+    Parameters:
+     > metrics: dict of metric names (keys) and functions (values) that
+       return the per-observation values of the metric for (y, y_pred). The
+       metric is their mean. Ex: {'mape': lambda y, p: np.abs(p / y - 1)}
+    '''
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics or {}
+        self.n = 0
+        self.sse = 0.
+        self.sae = 0.
+        self.sums = {k: 0. for k in self.metrics}
+
+    def update(self, y, y_pred):
+        # float32 (compact policy) sums lose precision over large sets
+        y = np.asarray(y, dtype=np.float64)
+        y_pred = np.asarray(y_pred, dtype=np.float64)
+        err = y_pred - y
+        self.n += len(err)
+        self.sse += float(np.dot(err, err))
+        self.sae += float(np.abs(err).sum())
+        for k, f in self.metrics.items():
+            self.sums[k] += float(np.sum(f(y, y_pred)))
+
+    def result(self):
+        '''
+        Returns the RMSE, the MAE and the dict of the other metrics (-1 if
+        there are no observations).
+        '''
+        if not self.n:
+            return -1., -1., {k: -1. for k in self.metrics}
+        scores = {k: v / self.n for k, v in self.sums.items()}
+        return np.sqrt(self.sse / self.n), self.sae / self.n, scores
+
+
+@instrument(rows_in=lambda model, data, *args, **kwargs: len(data),
+            rows_out=lambda out: None)
+def test_score(model, data, only_last=False, return_y=False, batch_size=1024,
+               metrics=None):
+    '''
+    Returns the RMSE and MAE of the model over the observations with a
+    non-zero weight of a validation or test set.
+    Parameters:
+     > only_last: if True, only the last period of each sequence is scored,
+       and only the sequences with a weighted last period are predicted.
+     > return_y: returns the observed and predicted values as well, in
+       buffers allocated once from the bucket shapes.
+     > batch_size: batch size of model.predict.
+     > metrics: dict of other metrics (see StreamingScores). If given, their
+       dict is returned after the MAE.
+    Scores are accumulated bucket by bucket.
+    '''
+
+    scores = StreamingScores(metrics)
+    steps = slice(-1, None) if only_last else slice(None)
 
     if return_y:
-        return rmse, mae, y, y_pred
+        size = sum(np.count_nonzero(d['w'][:, steps]) for d in data)
+        y = np.empty(size)
+        y_pred = np.empty(size)
+        pos = 0
+
+    for d in data:
+        w = d['w'][:, steps]
+        X = d['X_cat'] + [d['X_con'], d['X_lstm']]
+        y_d = d['y']
+        if only_last:
+            rows = w[:, 0].nonzero()[0]
+            if not len(rows):
+                continue
+            w = w[rows]
+            X = [x[rows] for x in X]
+            y_d = y_d[rows]
+        indexes = w.ravel().nonzero()[0]
+        if not len(indexes):
+            continue
+
+        pred_d = model.predict(X, batch_size=batch_size)
+        pred_d = pred_d[:, steps, :].ravel()[indexes]
+        y_d = y_d[:, steps, :].ravel()[indexes]
+        scores.update(y_d, pred_d)
 
-    return rmse, mae
+        if return_y:
+            y[pos:pos + len(indexes)] = y_d
+            y_pred[pos:pos + len(indexes)] = pred_d
+            pos += len(indexes)
+
+    rmse, mae, other = scores.result()
+    out = (rmse, mae, other) if metrics else (rmse, mae)
+    if return_y:
+        return out + (y, y_pred)
+
+    return out
 
 
 def get_shuffle_train(data_test, bs, p2p, noise_factor=None):
+    '''
+    Returns the shuffled training batches of an epoch as BucketView, so each
+    batch gathers its rows from the bucket only when it is consumed.
+    ShuffleTrain streams and prefetches the batches instead of listing them.
+    '''
     data = []
     for d in data_test:
         train_size = len(d['train_i'])
         np.random.shuffle(d['train_i'])
         for i in range(0, train_size, bs):
-            train_i = d['train_i'][i:min(train_size, i + bs)]
+            train_i = d['train_i'][i:min(train_size, i + bs)].copy()
 
             if len(train_i) < (bs / 2):
                 continue
 
-            y_train = d['y'][train_i, :-p2p, :]
+            batch = BucketView(d, rows=train_i, steps=slice(None, -p2p))
             if noise_factor is not None:
+                y_train = batch['y']
                 noise = y_train.copy()
                 noise *= (noise_factor * ((np.random.randint(0, high=201,
                           size=y_train.shape) - 100) / 100))
                 y_train += noise
+                batch.arrays['y'] = y_train
 
-            data.append({
-                'y': y_train,
-                'w': d['w'][train_i, :-p2p],
-                'X_con': d['X_con'][train_i, :-p2p, :],
-                'X_lstm': d['X_lstm'][train_i, :-p2p, :],
-                'X_cat': [ar[train_i, :-p2p, :] for ar in d['X_cat']]})
+            data.append(batch)
 
     return data
 
 
-def get_last_period_result(y, score, seq_len):
+def _default_rng(random_s=None):
+    '''
+    Returns a numpy random generator. If no seed is given, it is drawn from the
+    global numpy state, so np.random.seed keeps results reproducible.
+    '''
+
+    if random_s is None:
+        random_s = np.random.randint(2 ** 31)
+    if hasattr(np.random, 'default_rng'):
+        return np.random.default_rng(random_s)
+    return np.random.RandomState(random_s)
+
+
+def _fill_uniform(rng, out):
+    'Fills out with uniform [0, 1) samples, in place when the RNG allows it.'
+
+    if hasattr(rng, 'random'):
+        rng.random(out=out)
+    else:
+        out[...] = rng.random_sample(out.shape)
+
+
+class ShuffleTrain(object):
+    '''
+    Iterable over the shuffled, length-bucketed training batches of an epoch.
+    Only the batch indexes are planned up front: batches are gathered on
+    demand and the next ones are prefetched in a background thread pool while
+    the current one is consumed, so the memory of an epoch stays flat. Every
+    new iteration reshuffles the batches (a new epoch).
+    Parameters:
+     > data_test: test set returned by build_datasets.
+     > bs: batch size. Batches smaller than bs / 2 are dropped.
+     > p2p: periods to predict.
+     > noise_factor: if set, the targets of each batch are multiplied in place
+       by a uniform noise in [1 - noise_factor, 1 + noise_factor].
+     > shuffle: if True, batches of different lengths are interleaved.
+     > prefetch: number of batches gathered ahead of the current one.
+     > n_jobs: number of threads gathering batches.
+     > random_s: seed of the noise generator.
+     > verbose: if True, the stats of every epoch are printed.
+    After each epoch is planned, stats holds its number of batches, training
+    samples, samples dropped in batches smaller than bs / 2 and the padding
+    overhead (share of padded steps in the batches, see build_datasets).
+    '''
+
+    def __init__(self, data_test, bs, p2p, noise_factor=None, shuffle=True,
+                 prefetch=2, n_jobs=1, random_s=None, verbose=False):
+        self.data_test = data_test
+        self.bs = bs
+        self.p2p = p2p
+        self.noise_factor = noise_factor
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+        self.stats = {}
+        self._rng = _default_rng(random_s)
+        self._noise = np.empty(0)
+
+    def __len__(self):
+        n = 0
+        for d in self.data_test:
+            train_size = len(d['train_i'])
+            n += train_size // self.bs
+            if train_size % self.bs >= (self.bs / 2):
+                n += 1
+        return n
+
+    def _plan(self):
+        plan = []
+        samples, dropped, steps, pad_steps = 0, 0, 0, 0
+        for k, d in enumerate(self.data_test):
+            train_size = len(d['train_i'])
+            length = d['w'].shape[1] - self.p2p
+            pad_len = d.get('pad_len')
+            np.random.shuffle(d['train_i'])
+            samples += train_size
+            for i in range(0, train_size, self.bs):
+                train_i = d['train_i'][i:min(train_size, i + self.bs)].copy()
+                if len(train_i) < (self.bs / 2):
+                    dropped += len(train_i)
+                    continue
+                plan.append((k, train_i))
+                steps += len(train_i) * length
+                if pad_len is not None:
+                    pad_steps += np.minimum(pad_len[train_i], length).sum()
+        if self.shuffle:
+            np.random.shuffle(plan)
+
+        self.stats = {
+            'batches': len(plan),
+            'samples': samples,
+            'dropped': dropped,
+            'padding': float(pad_steps / steps) if steps else 0.
+        }
+        if self.verbose:
+            print('> Batches: {} | Samples dropped: {} / {} | Padding: {:.1%}'
+                  .format(len(plan), dropped, samples,
+                          self.stats['padding']))
+        return plan
+
+    def _gather(self, k, train_i):
+        batch = BucketView(self.data_test[k], rows=train_i,
+                           steps=slice(None, -self.p2p))
+        return dict(batch)
+
+    def _add_noise(self, y):
+        # reuses the same buffer for the noise of every batch
+        if self._noise.size < y.size:
+            self._noise = np.empty(y.size)
+        noise = self._noise[:y.size].reshape(y.shape)
+        _fill_uniform(self._rng, noise)
+        noise *= 201
+        np.floor(noise, out=noise)
+        noise -= 100
+        noise *= self.noise_factor / 100
+        noise += 1
+        y *= noise
+
+    def __iter__(self):
+        plan = iter(self._plan())
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            queue = deque(executor.submit(self._gather, k, train_i)
+                          for k, train_i in islice(plan, self.prefetch + 1))
+            while queue:
+                batch = queue.popleft().result()
+                for k, train_i in islice(plan, 1):
+                    queue.append(executor.submit(self._gather, k, train_i))
+                if self.noise_factor is not None:
+                    self._add_noise(batch['y'])
+                yield batch
+
+
+def get_last_period_result(y, score, seq_len=None, lengths=None):
     '''
     Returns the result dataframe (y and score) for the last observation of
-    each user. It only works if the length of all sequences is the same.
+    each user, indexed by its position in the flattened y.
+    Parameters:
+     > y, score: flat arrays of the observations of consecutive sequences,
+       or lists of arrays (one per bucket, of any shape).
+     > seq_len: sequence length of all the sequences, or list of sequence
+       lengths of the buckets of y and score. Ex: [d['y'].shape[1] for d in
+       data].
+     > lengths: per-sequence lengths (ex: np.diff of the user offsets), for
+       sequences of different lengths in a flat array.
     '''
 
     def np_flatten(obj):
         if isinstance(obj, list):
-            return np.concatenate(obj)
+            return np.concatenate([np.ravel(o) for o in obj])
         else:
-            return obj
+            return np.ravel(obj)
+
+    if isinstance(seq_len, (list, tuple, np.ndarray)):
+        if not isinstance(y, list) or len(seq_len) != len(y):
+            msg = "\nseq_len has one length per bucket: y and score must be"
+            msg += " lists with one array per bucket."
+            raise ValueError(msg)
+        sizes = np.array([np.size(o) for o in y], dtype=np.int64)
+        seq_len = np.asarray(seq_len, dtype=np.int64)
+        lengths = np.repeat(seq_len, sizes // seq_len)
     y = np_flatten(y)
     score = np_flatten(score)
 
     assert len(y) == len(score)
-    result = pd.DataFrame({
-        'y': y, 'score': score
-    })
-    idx = []
-    for i in range(len(result)):
-        if (i + 1) % seq_len == 0:
-            idx.append(i)
-    return result.loc[idx]
-
+    if lengths is not None:
+        idx = np.cumsum(lengths) - 1
+    else:
+        idx = np.arange(seq_len - 1, len(y), seq_len)
+    return pd.DataFrame({
+        'y': y[idx], 'score': score[idx]
+    }, index=idx)